@@ -0,0 +1,159 @@
+import os
+import random
+import subprocess
+from logging import info
+
+# Synthetic repositories of a controlled shape, generated with git fast-import so
+# even large fixtures only take a few seconds. Every generator is deterministic for
+# a given scale, so packs are comparable between benchmark runs.
+
+COMMITTER = b"Bench <bench@example.com> 1700000000 +0000"
+
+WORDS = b"alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma tau upsilon".split()
+
+
+class FastImport:
+    """Writes a git fast-import stream for a single branch"""
+
+    def __init__(self):
+        self.out = bytearray()
+        self.mark = 0
+        self.last_commit = None
+
+    def blob(self, data: bytes) -> int:
+        self.mark += 1
+        self.out += b"blob\nmark :%d\ndata %d\n" % (self.mark, len(data)) + data + b"\n"
+        return self.mark
+
+    def commit(self, message: bytes, files: dict[bytes, int], deleteall=False):
+        self.mark += 1
+        self.out += b"commit refs/heads/main\nmark :%d\n" % self.mark
+        self.out += b"committer " + COMMITTER + b"\n"
+        self.out += b"data %d\n" % len(message) + message + b"\n"
+        if self.last_commit is not None:
+            self.out += b"from :%d\n" % self.last_commit
+        if deleteall:
+            self.out += b"deleteall\n"
+        for path, mark in files.items():
+            self.out += b"M 100644 :%d " % mark + path + b"\n"
+        self.out += b"\n"
+        self.last_commit = self.mark
+
+
+def text(rng: random.Random, lines: int) -> bytes:
+    return b"".join(
+        b" ".join(rng.choice(WORDS) for _ in range(8)) + b"\n" for _ in range(lines)
+    )
+
+
+def many_small(scale: float) -> FastImport:
+    """Lots of small files spread over a few commits"""
+    rng = random.Random(1)
+    fi = FastImport()
+    files = int(5000 * scale)
+    commits = 10
+    for c in range(commits):
+        new = {
+            b"src/dir%03d/file%05d.txt" % (i % 100, i): fi.blob(text(rng, rng.randint(1, 20)))
+            for i in range(c * files // commits, (c + 1) * files // commits)
+        }
+        fi.commit(b"commit %d\n" % c, new)
+    return fi
+
+
+def huge_blobs(scale: float) -> FastImport:
+    """A handful of multi megabyte blobs, half incompressible"""
+    rng = random.Random(2)
+    fi = FastImport()
+    size = int(8 * 1024 * 1024 * scale)
+    files = {}
+    for i in range(4):
+        data = rng.randbytes(size // 2) + text(rng, size // 2 // 64)
+        files[b"blob%d.bin" % i] = fi.blob(data)
+    fi.commit(b"huge blobs\n", files)
+    return fi
+
+
+def deep_deltas(scale: float) -> FastImport:
+    """One file edited over many commits, which packs into long delta chains"""
+    rng = random.Random(3)
+    fi = FastImport()
+    lines = text(rng, 2000).split(b"\n")
+    for c in range(int(300 * scale)):
+        for _ in range(5):
+            lines[rng.randrange(len(lines))] = text(rng, 1).rstrip(b"\n")
+        fi.commit(b"edit %d\n" % c, {b"file.txt": fi.blob(b"\n".join(lines))})
+    return fi
+
+
+def wide_trees(scale: float) -> FastImport:
+    """A single very wide directory, rewritten a few times"""
+    rng = random.Random(4)
+    fi = FastImport()
+    entries = int(20000 * scale)
+    blobs = [fi.blob(b"entry %d\n" % i) for i in range(entries)]
+    for c in range(5):
+        # each commit points a few entries somewhere else, so the trees delta against each other
+        for _ in range(10):
+            blobs[rng.randrange(entries)] = blobs[rng.randrange(entries)]
+        fi.commit(
+            b"wide %d\n" % c, {b"f%06d" % i: mark for i, mark in enumerate(blobs)}
+        )
+    return fi
+
+
+SHAPES = {
+    "many_small": many_small,
+    "huge_blobs": huge_blobs,
+    "deep_deltas": deep_deltas,
+    "wide_trees": wide_trees,
+}
+
+
+def git(repo: str, *args, input: bytes | None = None) -> bytes:
+    return subprocess.run(
+        ["git", "-C", repo, *args], input=input, capture_output=True, check=True
+    ).stdout
+
+
+def make_repo(shape: str, scale: float, workdir: str) -> str:
+    """
+    Creates (or reuses) a bare repository of the given shape
+
+    :returns: path of the repository
+    """
+    repo = os.path.join(workdir, f"{shape}-{scale}.git")
+    if os.path.exists(os.path.join(repo, "refs", "heads", "main")):
+        return repo
+
+    info("Generating %s repository (scale %s)", shape, scale)
+    subprocess.run(["git", "init", "-q", "--bare", repo], check=True)
+    git(repo, "symbolic-ref", "HEAD", "refs/heads/main")
+    git(repo, "fast-import", "--quiet", input=bytes(SHAPES[shape](scale).out))
+    return repo
+
+
+def make_pack(repo: str) -> str:
+    """
+    Packs every object of a repository the way upstream would send it: offset deltas only
+
+    :returns: path of the packfile
+    """
+    pack = repo + ".pack"
+    if os.path.exists(pack):
+        return pack
+
+    objs = git(repo, "rev-list", "--objects", "--all")
+    data = git(
+        repo,
+        "pack-objects",
+        "--stdout",
+        "--delta-base-offset",
+        "--depth=250",
+        "--window=50",
+        "-q",
+        input=objs,
+    )
+    with open(pack, "wb") as f:
+        f.write(data)
+    return pack
@@ -0,0 +1,204 @@
+"""
+Packfile ingest benchmarks
+
+Generates synthetic repositories with the local git, packs them with git pack-objects
+and measures read_packfile, read_delta, smart_decompress and gen_packfile on them.
+Every measurement runs in a fresh process so its peak RSS can be reported.
+
+    python bench/packfile_bench.py --scale 0.5 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from logging import info
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import fixtures
+
+
+def walk_entries(pf: bytes):
+    """
+    Yields every entry of a pack without resolving deltas
+
+    :returns: iterator of tuple(type, compressed data index, base index or None)
+    """
+    from util import packfile
+
+    scan = packfile.scan_pack(pf)
+    for i in range(len(scan)):
+        base = scan.bases[i] if scan.types[i] == packfile.TYPE_OFS_DELTA else None
+        yield packfile.OBJ_TYPE(scan.types[i]), scan.data_offsets[i], base
+
+
+# Each benchmark returns tuple(bytes processed, objects processed, seconds), timing
+# only its own section and not the setup it needs
+
+
+def bench_read_packfile(pf: bytes) -> tuple[int, int, float]:
+    from util import packfile
+
+    start = time.perf_counter()
+    asyncio.run(packfile.read_packfile(pf, parse=False))
+    return len(pf), int.from_bytes(pf[8:12], byteorder="big"), time.perf_counter() - start
+
+
+def bench_smart_decompress(pf: bytes) -> tuple[int, int, float]:
+    from util import packfile
+
+    entries = list(walk_entries(pf))
+    start = time.perf_counter()
+    out = 0
+    for _, data_idx, _ in entries:
+        obj, _ = packfile.smart_decompress(pf, idx=data_idx)
+        out += len(obj)
+    return out, len(entries), time.perf_counter() - start
+
+
+def bench_read_delta(pf: bytes) -> tuple[int, int, float]:
+    from util import packfile
+
+    cache = packfile.EntryCache()
+    pairs = []
+    for _, data_idx, base in walk_entries(pf):
+        if base is None:
+            continue
+        delta, _ = packfile.smart_decompress(pf, idx=data_idx)
+        base_obj, _, _ = packfile.extract_entry(pf, idx=base, cache=cache)
+        pairs.append((delta, base_obj))
+
+    start = time.perf_counter()
+    out = 0
+    for delta, base_obj in pairs:
+        out += len(packfile.read_delta(delta, base_obj))
+    return out, len(pairs), time.perf_counter() - start
+
+
+def bench_gen_packfile(pf: bytes) -> tuple[int, int, float]:
+    from util import packfile
+
+    parsed = asyncio.run(packfile.read_packfile(pf, parse=True))
+    start = time.perf_counter()
+    out = parsed.gen_packfile()
+    return len(out), len(parsed.objs), time.perf_counter() - start
+
+
+BENCHMARKS = {
+    "read_packfile": bench_read_packfile,
+    "smart_decompress": bench_smart_decompress,
+    "read_delta": bench_read_delta,
+    "gen_packfile": bench_gen_packfile,
+}
+
+
+def measure(name: str, pack: str, repeat: int) -> dict:
+    """Runs one benchmark in the current process, keeping the fastest of repeat runs"""
+    logging.basicConfig(level=logging.WARNING)
+    with open(pack, "rb") as f:
+        pf = f.read()
+
+    best = None
+    for _ in range(repeat):
+        res = BENCHMARKS[name](pf)
+        if best is None or res[2] < best[2]:
+            best = res
+
+    nbytes, nobjs, elapsed = best
+    return {
+        "seconds": elapsed,
+        "bytes": nbytes,
+        "objects": nobjs,
+        "mb_per_s": nbytes / elapsed / 1e6 if elapsed else None,
+        "objects_per_s": nobjs / elapsed if elapsed else None,
+        # KiB on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_isolated(name: str, pack: str, repeat: int) -> dict:
+    # spawn, not fork, so the peak RSS doesn't include the parent process
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(measure, (name, pack, repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark packfile ingest")
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=fixtures.SHAPES.keys(),
+        default=list(fixtures.SHAPES.keys()),
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=BENCHMARKS.keys(),
+        default=list(BENCHMARKS.keys()),
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="Fixture size factor")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "git-mitm-bench"),
+        help="Where generated repositories and packs are kept between runs",
+    )
+    parser.add_argument("--output", help="JSON results file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:\t%(message)s")
+    os.makedirs(args.workdir, exist_ok=True)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip(),
+        "python": platform.python_version(),
+        "git": subprocess.run(
+            ["git", "--version"], capture_output=True, text=True
+        ).stdout.strip(),
+        "scale": args.scale,
+        "shapes": {},
+    }
+
+    for shape in args.shapes:
+        pack = fixtures.make_pack(fixtures.make_repo(shape, args.scale, args.workdir))
+        with open(pack, "rb") as f:
+            header = f.read(12)
+        shape_res = results["shapes"][shape] = {
+            "pack_bytes": os.path.getsize(pack),
+            "pack_objects": int.from_bytes(header[8:12], byteorder="big"),
+            "benchmarks": {},
+        }
+        for name in args.benchmarks:
+            res = run_isolated(name, pack, args.repeat)
+            shape_res["benchmarks"][name] = res
+            info(
+                "%-12s %-16s %8.3fs %9.2f MB/s %10.0f obj/s %8d KiB",
+                shape,
+                name,
+                res["seconds"],
+                res["mb_per_s"] or 0,
+                res["objects_per_s"] or 0,
+                res["peak_rss_kb"],
+            )
+
+    output = args.output or f"packfile-bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+    info("Results written to %s", output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for github.com: serves every bare repository below a directory over
+# smart and dumb HTTP through git http-backend, and counts the bytes it sends.
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+
+    def add(self, nbytes: int):
+        with self.lock:
+            self.bytes_sent += nbytes
+            self.requests += 1
+
+
+class GitHttpBackend(BaseHTTPRequestHandler):
+    root: str
+    stats: Stats
+
+    def run_backend(self, body: bytes = b""):
+        path, _, query = self.path.partition("?")
+        env = dict(
+            os.environ,
+            GIT_PROJECT_ROOT=self.root,
+            GIT_HTTP_EXPORT_ALL="1",
+            PATH_INFO=path,
+            QUERY_STRING=query,
+            REQUEST_METHOD=self.command,
+            # the proxy doesn't send a content type, github doesn't mind but http-backend does
+            CONTENT_TYPE="application/x-git-upload-pack-request"
+            if self.command == "POST"
+            else "",
+            CONTENT_LENGTH=str(len(body)),
+            GIT_PROTOCOL=self.headers.get("git-protocol", ""),
+        )
+        out = subprocess.run(
+            ["git", "http-backend"], input=body, env=env, capture_output=True
+        ).stdout
+
+        # CGI response: headers, blank line, body
+        head, _, content = out.partition(b"\r\n\r\n")
+        status = 200
+        headers = []
+        for line in head.split(b"\r\n"):
+            key, _, value = line.decode().partition(":")
+            if key.lower() == "status":
+                status = int(value.split()[0])
+            elif key:
+                headers.append((key, value.strip()))
+
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        self.stats.add(len(content))
+
+    def do_GET(self):
+        self.run_backend()
+
+    def do_POST(self):
+        self.run_backend(self.rfile.read(int(self.headers.get("content-length", 0))))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(root: str, port: int = 0) -> tuple[ThreadingHTTPServer, Stats]:
+    """
+    Starts the upstream server in a background thread
+
+    :returns: tuple(server, stats). The bound port is server.server_port
+    """
+    stats = Stats()
+    handler = type(
+        "Handler", (GitHttpBackend,), {"root": os.path.abspath(root), "stats": stats}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
@@ -0,0 +1,82 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from util import eviction, graph
+from util.graph import TYPE_BLOB, TYPE_COMMIT, TYPE_TREE, GraphBuilder
+
+COMMIT, TREE, BLOB, OTHER, PROMISED = (bytes([i]) * 20 for i in range(1, 6))
+
+
+class FakeConnection:
+    """Answers the queries of delete_batch, deleting whatever it is asked to"""
+
+    def __init__(self, remotes: list[str], locked: bool = False):
+        self.remotes = remotes
+        self.locked = locked
+        self.deleted: list[str] | None = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchval(self, query: str, *args):
+        if "pg_try_advisory_xact_lock" in query:
+            return not self.locked
+        return "now"
+
+    async def fetch(self, query: str, *args):
+        if query.strip().startswith("SELECT remote FROM graphs"):
+            return [{"remote": remote} for remote in self.remotes]
+        assert "DELETE FROM objects" in query
+        self.deleted = args[0]
+        return [{"path": None} for _ in args[0]]
+
+
+@pytest.fixture
+def graphs(monkeypatch):
+    """A remote with a commit, its tree and a blob, and a promised blob"""
+    builder = GraphBuilder()
+    builder.add(COMMIT, TYPE_COMMIT, b"tree " + TREE.hex().encode() + b"\n\nmsg\n")
+    builder.add(TREE, TYPE_TREE, b"100644 a\0" + BLOB + b"100644 b\0" + PROMISED)
+    builder.add(BLOB, TYPE_BLOB, b"blob")
+    graphs = {"kept": builder.build([COMMIT]), "broken": None}
+
+    async def load(repo, db):
+        return graphs[repo]
+
+    monkeypatch.setattr(graph, "load", load)
+    return graphs
+
+
+def delete_batch(batch, db):
+    return asyncio.run(eviction.delete_batch(batch, None, db))
+
+
+def test_still_needed(graphs):
+    db = FakeConnection(["kept"])
+    candidates = [COMMIT, BLOB, OTHER, PROMISED]
+    needed = asyncio.run(eviction.still_needed(candidates, None, db))
+    # promised objects aren't stored by the remote, so they don't keep anything
+    assert needed == {COMMIT, BLOB}
+
+
+def test_delete_batch(graphs):
+    db = FakeConnection(["kept"])
+    paths, checked = delete_batch([TREE, OTHER, PROMISED], db)
+    assert sorted(db.deleted) == sorted([OTHER.hex(), PROMISED.hex()])
+    assert len(paths) == 2 and checked == "now"
+
+
+def test_delete_batch_unreadable_graph(graphs):
+    # a graph that can't be read keeps everything
+    db = FakeConnection(["kept", "broken"])
+    paths, _ = delete_batch([TREE, OTHER], db)
+    assert db.deleted == [] and paths == []
+
+
+def test_delete_batch_while_storing(graphs):
+    db = FakeConnection(["kept"], locked=True)
+    assert delete_batch([OTHER], db) is None
+    assert db.deleted is None
@@ -0,0 +1,122 @@
+import hashlib
+
+import pytest
+
+from util.graph import TYPE_BLOB, TYPE_COMMIT, TYPE_TREE, CommitGraph, GraphBuilder
+
+
+class History:
+    """Synthetic objects of a linear history, each commit adds a blob"""
+
+    def __init__(self, length: int):
+        self.objects: dict[bytes, tuple[int, bytes]] = {}
+        self.commits: list[bytes] = []
+        self.trees: list[bytes] = []
+        self.blobs: list[bytes] = []
+        for i in range(length):
+            self.blobs.append(self.add(TYPE_BLOB, b"blob %d\n" % i * (i + 1)))
+            entries = b"".join(
+                b"100644 f%d\0" % n + blob for n, blob in enumerate(self.blobs)
+            )
+            self.trees.append(self.add(TYPE_TREE, entries))
+            data = b"tree " + self.trees[-1].hex().encode() + b"\n"
+            if self.commits:
+                data += b"parent " + self.commits[-1].hex().encode() + b"\n"
+            self.commits.append(self.add(TYPE_COMMIT, data + b"\ncommit %d\n" % i))
+
+    def add(self, obj_type: int, data: bytes) -> bytes:
+        oid = hashlib.sha1(b"%d %s" % (obj_type, data)).digest()
+        self.objects[oid] = (obj_type, data)
+        return oid
+
+    def closure(self, commit: bytes) -> set[bytes]:
+        """Gets the objects reachable from a commit"""
+        graph = self.build(self.objects)
+        return set(graph.missing([commit], []))
+
+    def build(
+        self, oids, tips: list[bytes] = (), base: CommitGraph | None = None
+    ) -> CommitGraph:
+        builder = GraphBuilder(base)
+        for oid in oids:
+            builder.add(oid, *self.objects[oid])
+        return builder.build(tips)
+
+
+@pytest.fixture
+def history():
+    return History(6)
+
+
+def test_missing_everything(history):
+    graph = history.build(history.objects)
+    assert set(graph.missing([history.commits[-1]], [])) == set(history.objects)
+
+
+def test_missing_with_haves(history):
+    graph = history.build(history.objects)
+    c = history.commits
+    missing = set(graph.missing([c[-1]], [c[-2]]))
+    # the last commit, its tree and the blob it added
+    assert missing == {c[-1], history.trees[-1], history.blobs[-1]}
+    assert graph.missing([c[-2]], [c[-1]]) == []
+
+
+def test_missing_blob_limit(history):
+    graph = history.build(history.objects)
+    tip = history.commits[-1]
+    everything = set(graph.missing([tip], []))
+    blobs = set(history.blobs)
+    assert set(graph.missing([tip], [], blob_limit=0)) == everything - blobs
+    small = {oid for oid in blobs if len(history.objects[oid][1]) < 30}
+    assert small and small != blobs
+    assert set(graph.missing([tip], [], blob_limit=30)) == everything - blobs | small
+    # wanted blobs are sent no matter the filter
+    wanted = history.blobs[-1]
+    assert wanted in graph.missing([tip, wanted], [], blob_limit=0)
+
+
+def test_missing_promised(history):
+    # a filtered pack leaves out blobs, which end up as promised objects
+    oids = [oid for oid in history.objects if oid not in history.blobs]
+    graph = history.build(oids)
+    assert set(graph.promised()) == set(history.blobs)
+    tip = history.commits[-1]
+    assert set(graph.missing([tip], [], blob_limit=0)) == set(oids)
+    assert not graph.complete_of(history.blobs)
+
+
+def test_incremental_build(history):
+    c = history.commits
+    old = history.closure(c[2])
+    base = history.build(old, [c[2]])
+    # only the new objects are in the next pack
+    graph = history.build(set(history.objects) - old, [c[-1]], base)
+    full = history.build(history.objects, [c[-1]])
+    assert graph.same_objects(full)
+    assert graph.bitmaps == full.bitmaps
+    for want, have in [(c[-1], c[2]), (c[4], c[1]), (c[2], None)]:
+        haves = [have] if have else []
+        assert graph.missing([want], haves) == full.missing([want], haves)
+
+
+def test_incremental_build_fills_promised(history):
+    tip = history.commits[-1]
+    oids = [oid for oid in history.objects if oid not in history.blobs]
+    base = history.build(oids, [tip])
+    graph = history.build(history.blobs, [tip], base)
+    full = history.build(history.objects, [tip])
+    assert graph.same_objects(full)
+    assert graph.promised() == []
+    assert set(graph.missing([tip], [])) == set(history.objects)
+
+
+def test_dumps_loads(history):
+    graph = history.build(history.objects)
+    loaded = CommitGraph.loads(graph.dumps())
+    assert loaded.same_objects(graph)
+    tip = history.commits[-1]
+    assert loaded.missing([tip], [history.commits[0]]) == graph.missing(
+        [tip], [history.commits[0]]
+    )
+    assert CommitGraph.loads(b"not a graph") is None
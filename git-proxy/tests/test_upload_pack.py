@@ -0,0 +1,136 @@
+import pytest
+
+from util import remote
+from util.upload_pack import FetchArgs, UploadPackError, parse_filter, parse_request
+
+OID = "a" * 40
+
+
+def request(*lines: str, args: list[str] = ()) -> bytes:
+    out = remote.PktLineWriter()
+    out.lines(lines)
+    out.delim_pkt()
+    out.lines(args)
+    out.flush_pkt()
+    return out.getvalue()
+
+
+def test_parse_request():
+    body = request(
+        "command=fetch\n", "agent=git/2.46.0\n", args=[f"want {OID}\n", "done\n"]
+    )
+    command, capabilities, args = parse_request(body)
+    assert command == "fetch"
+    assert capabilities == {"agent": "git/2.46.0"}
+    assert args == [f"want {OID}".encode(), b"done"]
+
+
+def test_parse_request_upper_case_length():
+    line = b"agent=git/2.46.0-abcd\n"
+    body = b"%04X" % (len(line) + 4) + line + request("command=fetch\n")
+    assert b"001A" in body
+    assert parse_request(body)[:2] == ("fetch", {"agent": "git/2.46.0-abcd"})
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"",
+        b"0000",
+        request("agent=git/2.46.0\n"),
+    ],
+)
+def test_parse_request_no_command(body):
+    with pytest.raises(UploadPackError, match="No command"):
+        parse_request(body)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"00",
+        b"zzzzcommand=fetch\n",
+        b"+012command=fetch\n",
+        b"0003",
+        b"0100command=fetch\n",
+    ],
+)
+def test_parse_request_invalid_length(body):
+    with pytest.raises(UploadPackError, match="pkt-line length"):
+        parse_request(body)
+
+
+@pytest.mark.parametrize(
+    "spec, limit",
+    [
+        ("blob:none", 0),
+        ("blob:limit=0", 0),
+        ("blob:limit=100", 100),
+        ("blob:limit=2k", 2048),
+        ("blob:limit=3M", 3 * 1024**2),
+        ("blob:limit=1g", 1024**3),
+        ("tree:0", None),
+    ],
+)
+def test_parse_filter(spec, limit):
+    assert parse_filter(spec) == limit
+
+
+@pytest.mark.parametrize(
+    "spec",
+    ["blob:limit=", "blob:limit=k", "blob:limit=-1", "blob:limit=1x", "blob:limit=١"],
+)
+def test_parse_filter_invalid(spec):
+    with pytest.raises(UploadPackError, match="Invalid filter"):
+        parse_filter(spec)
+
+
+def test_fetch_args():
+    fetch = FetchArgs(
+        [
+            f"want {OID}".encode(),
+            f"have {'b' * 40}".encode(),
+            f"shallow {'c' * 40}".encode(),
+            b"deepen 3",
+            b"filter blob:none",
+            b"packfile-uris https",
+            b"no-progress",
+            b"done",
+        ]
+    )
+    assert fetch.wants == [bytes.fromhex(OID)]
+    assert fetch.haves == [bytes.fromhex("b" * 40)]
+    assert fetch.shallow == [bytes.fromhex("c" * 40)]
+    assert fetch.deepen and fetch.depth == 3
+    assert fetch.blob_limit == 0
+    assert fetch.uri_protocols == ["https"]
+    assert fetch.done and not fetch.progress
+
+
+def test_fetch_args_defaults():
+    fetch = FetchArgs([f"want {OID}".encode()])
+    assert fetch.haves == [] and fetch.shallow == []
+    assert fetch.depth is None and not fetch.deepen
+    assert fetch.blob_limit is None
+    assert not fetch.done and fetch.progress
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        ([], "No wants"),
+        ([b"have " + OID.encode()], "No wants"),
+        ([b"want " + OID[:-1].encode()], "Invalid object id"),
+        ([b"want " + b"g" * 40], "Invalid object id"),
+        ([b"want " + OID.encode() + b"aa"], "Invalid object id"),
+        ([b"want " + OID.encode(), b"have xyz"], "Invalid object id"),
+        ([b"want " + OID.encode(), b"deepen 0"], "Invalid depth"),
+        ([b"want " + OID.encode(), b"deepen -1"], "Invalid depth"),
+        ([b"want " + OID.encode(), b"deepen abc"], "Invalid depth"),
+        ([b"want " + OID.encode(), "deepen ١".encode()], "Invalid depth"),
+        ([b"want " + OID.encode(), b"want-ref refs/heads/main"], "Unsupported"),
+    ],
+)
+def test_fetch_args_invalid(args, message):
+    with pytest.raises(UploadPackError, match=message):
+        FetchArgs(args)
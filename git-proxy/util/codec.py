@@ -0,0 +1,60 @@
+import zlib
+from logging import warning
+
+from .config import OBJECT_CODEC, OBJECT_ZLIB_LEVEL, OBJECT_ZSTD_LEVEL
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# How objects are compressed in the objects table, recorded per row in its codec column.
+#
+# raw: uncompressed object with its header
+# zlib: loose object format, so it can be sent to clients as is
+# zstd: zstandard compressed object with its header, needs the zstandard package
+#
+# Objects that are served to clients directly (fetched as loose objects, injected or
+# kept in the object store) are always stored as zlib.
+
+CODECS = ("raw", "zlib", "zstd")
+
+if OBJECT_CODEC not in CODECS:
+    raise ValueError(f"Unknown OBJECT_CODEC {OBJECT_CODEC}, expected one of {CODECS}")
+
+DEFAULT_CODEC = OBJECT_CODEC
+if DEFAULT_CODEC == "zstd" and zstandard is None:
+    warning("OBJECT_CODEC is zstd but zstandard is not installed, using zlib")
+    DEFAULT_CODEC = "zlib"
+
+
+def encode(raw_obj: bytes, codec: str = DEFAULT_CODEC) -> bytes:
+    """Compresses an object (including its header) with the given codec"""
+    if codec == "zlib":
+        return zlib.compress(raw_obj, OBJECT_ZLIB_LEVEL)
+    if codec == "raw":
+        return raw_obj
+    if codec == "zstd":
+        # Compressor objects can't be shared between threads, and are cheap to create
+        return zstandard.ZstdCompressor(level=OBJECT_ZSTD_LEVEL).compress(raw_obj)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decode(blob: bytes, codec: str) -> bytes:
+    """Gets the object (including its header) back from a stored blob"""
+    if codec == "zlib":
+        return zlib.decompress(blob)
+    if codec == "raw":
+        return bytes(blob)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Object stored with zstd but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def to_loose(blob: bytes, codec: str) -> bytes:
+    """Gets a stored blob in loose object format, as sent to dumb http clients"""
+    if codec == "zlib":
+        return blob
+    return encode(decode(blob, codec), "zlib")
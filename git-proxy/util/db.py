@@ -1,28 +1,123 @@
 from .objects import GitObject, get_hash, parse_object
+from . import storage
+from .codec import decode, encode, to_loose
+from .config import LARGE_OBJECT_THRESHOLD
+from contextlib import asynccontextmanager
 from logging import debug
-import pickle
+import asyncio
 
+import asyncpg
+
+# Put in front of the table definitions, so processes starting at the same time don't
+# create the same table twice. A multi-statement query runs in one transaction, which
+# holds the lock until the end.
+SCHEMA_LOCK = "SELECT pg_advisory_xact_lock(1735289204);"
+
+OBJECT_TABLE = """
+    CREATE TABLE IF NOT EXISTS objects (
+        hash char(40) primary key,
+        blob bytea,
+        path text
+    );
+    ALTER TABLE objects ADD COLUMN IF NOT EXISTS path text;
+    ALTER TABLE objects ALTER COLUMN blob DROP NOT NULL;
+    ALTER TABLE objects ADD COLUMN IF NOT EXISTS codec text NOT NULL DEFAULT 'zlib';
+    CREATE TABLE IF NOT EXISTS refs (
+        remote text not null,
+        old text not null,
+        new text not null,
+        PRIMARY KEY (remote, old)
+    );
+"""
+
+
+async def initialize(db) -> None:
+    """
+    Creates the tables, or adds what is missing to them. Run by the HTTP workers and
+    the ingest process alike, whichever starts first.
+    """
+    from . import eviction, forks, graph, ingest, refs
 
-async def insert_raw(hash: str, content: bytes, db) -> None:
-    debug(f"Inserting {hash} into database")
     await db.execute(
-        "INSERT INTO objects (hash, blob) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING;",
+        SCHEMA_LOCK
+        + OBJECT_TABLE
+        + refs.REF_TABLE
+        + ingest.JOB_TABLE
+        + graph.GRAPH_TABLE
+        + forks.ROOT_TABLE
+        + eviction.USAGE_TABLE
+    )
+
+
+@asynccontextmanager
+async def connection(db):
+    """Gets a connection of a pool, or the given connection"""
+    if isinstance(db, asyncpg.Pool):
+        async with db.acquire() as conn:
+            yield conn
+    else:
+        yield db
+
+
+async def insert_raw(hash: str, content: bytes, db, codec: str = "zlib") -> None:
+    """
+    Insert an object that is already compressed
+
+    :param codec: How content is compressed, see util.codec. The default is the loose
+        object format, as fetched from upstream
+    """
+    debug("Inserting %s into database", hash)
+    if len(content) > LARGE_OBJECT_THRESHOLD:
+        # Large objects only keep a pointer in the database, and are sent straight
+        # from disk, so they are always stored as loose objects
+        if codec != "zlib":
+            content = await asyncio.to_thread(to_loose, content, codec)
+        path = await asyncio.to_thread(storage.write_object, hash, content)
+        await insert_path(hash, path, db)
+        return
+    await db.execute(
+        "INSERT INTO objects (hash, blob, codec) VALUES ($1, $2, $3) ON CONFLICT (hash) DO NOTHING;",
         hash,
         content,
+        codec,
     )
 
 
-async def insert_object(obj: GitObject, db) -> None:
-    debug(f"Inserting object {obj.calc_hash_new()} into database")
+async def insert_raw_many(rows: list[tuple[str, bytes]], db, codec: str = "zlib") -> None:
+    """Insert several objects that are already compressed, see insert_raw"""
+    small = []
+    for hash, content in rows:
+        if len(content) > LARGE_OBJECT_THRESHOLD:
+            await insert_raw(hash, content, db, codec)
+        else:
+            small.append((hash, content, codec))
+    if small:
+        debug("Inserting %d objects into database", len(small))
+        await db.executemany(
+            "INSERT INTO objects (hash, blob, codec) VALUES ($1, $2, $3) ON CONFLICT (hash) DO NOTHING;",
+            small,
+        )
+
+
+async def insert_path(hash: str, path: str, db) -> None:
+    """Insert a pointer to an object that is already in the object store"""
+    debug("Inserting %s into database as %s", hash, path)
     await db.execute(
-        "INSERT INTO objects (hash, blob) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING;",
-        obj.calc_hash_new(),
-        obj.export_object_new(),
+        "INSERT INTO objects (hash, path) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING;",
+        hash,
+        path,
     )
 
 
+async def insert_object(obj: GitObject, db) -> None:
+    hash = obj.calc_hash_new()
+    debug("Inserting object %s into database", hash)
+    # Injected objects are served to clients, so keep them as loose objects
+    await insert_raw(hash, encode(obj.raw_contents_new(), "zlib"), db)
+
+
 async def set_ref(repo: str, ref: str, new: str, db) -> None:
-    debug(f"Setting {repo}:{ref} to be set to {new}")
+    debug("Setting %s:%s to be set to %s", repo, ref, new)
     await db.execute(
         "INSERT INTO refs (remote, old, new) VALUES ($1, $2, $3) ON CONFLICT (remote, old) DO UPDATE SET new = $3;",
         repo,
@@ -31,28 +126,35 @@ async def set_ref(repo: str, ref: str, new: str, db) -> None:
     )
 
 
-async def get_object(hash: str, db) -> GitObject:
-    return parse_object(
-        (await db.fetchrow("SELECT blob FROM objects WHERE hash = $1;", hash))["blob"]
+async def get_raw(hash: str, db):
+    """
+    Get the stored row of an object without reading it from the object store
+
+    :returns: record with blob and path (exactly one of them is set) and the codec of
+        the blob, or None
+    """
+    return await db.fetchrow(
+        "SELECT blob, path, codec FROM objects WHERE hash = $1;", hash
     )
 
 
+async def get_object(hash: str, db, fetch=None) -> GitObject:
+    """
+    :param fetch: Optional async callback, called as fetch([hash]) to fetch the object
+        from upstream if it isn't stored, e.g. because of a filtered fetch
+    """
+    res = await get_raw(hash, db)
+    if res is None and fetch is not None:
+        await fetch([hash])
+        res = await get_raw(hash, db)
+    if res["path"] is not None:
+        return parse_object(await asyncio.to_thread(storage.read_object, res["path"]))
+    return parse_object(decode(res["blob"], res["codec"]), compressed=False)
+
+
 async def get_ref(repo: str, ref: str, db) -> str:
     return (
         await db.fetchrow(
             "SELECT new FROM refs WHERE remote = $1 AND old = $2;", repo, ref
         )
     )["new"]
-
-
-async def set_completed(repo: str, refs: bytes, db) -> None:
-    await db.execute(
-        "INSERT INTO cache (remote, ref_blob) VALUES ($1, $2) ON CONFLICT (remote) DO NOTHING;",
-        repo,
-        refs,
-    )
-
-
-async def get_ref_object(repo: str, db) -> bytes | None:
-    res = await db.fetchrow("SELECT ref_blob FROM cache WHERE remote = $1;", repo)
-    return None if res is None else res["ref_blob"]
@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import tempfile
+import zlib
+from collections import deque
+from logging import debug, info
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import codec, graph, metrics, storage
+from .config import DUMB_CONCURRENCY, PACK_SPOOL_DIR, STREAM_CHUNK_SIZE
+from .db import insert_raw_many
+
+# Upstreams that only serve dumb HTTP, i.e. the files of a bare repository, have no
+# upload-pack to build a pack. Their history is walked like git's http-fetch does it:
+# breadth first from the ref tips, DUMB_CONCURRENCY loose objects at a time over one
+# pooled connection. The walk stops at objects that a complete reachability index
+# already has, and objects that are stored already are read from the database instead
+# of being fetched. Objects that upstream only has in a pack are looked up in the pack
+# indexes listed in objects/info/packs, and the packs containing them are downloaded
+# and extracted. On the first fetch of a remote, every pack is downloaded right away.
+
+# Objects taken from the queue of the walk per round
+BATCH = 1000
+
+
+class DumbFetchError(Exception):
+    pass
+
+
+class DumbRemote:
+    """Files of a dumb HTTP upstream, fetched over a connection pool"""
+
+    def __init__(self, repo_base_url: str, headers: dict):
+        self.repo_base_url = repo_base_url
+        self.headers = headers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DUMB_CONCURRENCY)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # pack name -> object ids in it, for the packs whose index was fetched
+        self.indexes: dict[str, set[bytes]] = {}
+        self.extracted: set[str] = set()
+        self._packs = None
+
+    def close(self) -> None:
+        self.session.close()
+
+    def get(self, path: str, stream: bool = False) -> requests.Response:
+        response = self.session.get(
+            f"{self.repo_base_url}/{path}", headers=self.headers, stream=stream
+        )
+        if not stream:
+            metrics.inc("gitmitm_upstream_bytes_total", len(response.content))
+        return response
+
+    def loose(self, oid: bytes) -> bytes | None:
+        """Gets a loose object as stored upstream, None if upstream only has it packed"""
+        hash = oid.hex()
+        response = self.get(f"objects/{hash[:2]}/{hash[2:]}")
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise DumbFetchError(f"Upstream returned {response.status_code} for {hash}")
+        return response.content
+
+    def packs(self) -> list[str]:
+        """Gets the names of the packs in objects/info/packs, e.g. pack-<id>.pack"""
+        if self._packs is None:
+            response = self.get("objects/info/packs")
+            self._packs = []
+            if response.status_code == 200:
+                for line in response.content.split(b"\n"):
+                    if line.startswith(b"P "):
+                        self._packs.append(line[2:].strip().decode())
+            debug("%d packs upstream", len(self._packs))
+        return self._packs
+
+    def index(self, name: str) -> set[bytes]:
+        """Gets the object ids in a pack from its version 2 .idx file"""
+        if name not in self.indexes:
+            response = self.get(f"objects/pack/{name[:-5]}.idx")
+            if response.status_code != 200:
+                raise DumbFetchError(
+                    f"Upstream returned {response.status_code} for {name}"
+                )
+            data = response.content
+            if data[:8] != b"\377tOc\0\0\0\2":
+                raise DumbFetchError(f"Unsupported pack index {name}")
+            # the last fanout entry is the number of objects
+            count = int.from_bytes(data[8 + 255 * 4 : 8 + 256 * 4], byteorder="big")
+            oids = data[8 + 256 * 4 : 8 + 256 * 4 + count * 20]
+            self.indexes[name] = {oids[i : i + 20] for i in range(0, len(oids), 20)}
+        return self.indexes[name]
+
+    def download(self, name: str):
+        """Spools a pack into a temporary file"""
+        response = self.get(f"objects/pack/{name}", stream=True)
+        if response.status_code != 200:
+            raise DumbFetchError(f"Upstream returned {response.status_code} for {name}")
+        spool = tempfile.TemporaryFile(dir=PACK_SPOOL_DIR)
+        try:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                metrics.inc("gitmitm_upstream_bytes_total", len(chunk))
+                spool.write(chunk)
+            spool.seek(0)
+        except:
+            spool.close()
+            raise
+        finally:
+            response.close()
+        return spool
+
+
+def split_object(raw_obj: bytes) -> tuple[int, bytes]:
+    """
+    Splits an object into its type and its data without the header
+
+    :returns: tuple(TYPE_* value, data)
+    """
+    header, _, data = raw_obj.partition(b"\0")
+    return graph.TYPE_IDS[header.split(b" ", 1)[0]], data
+
+
+async def fetch(
+    repo_base_url: str,
+    tips: list[bytes],
+    headers: dict,
+    db,
+    builder: graph.GraphBuilder,
+    graphs: list[graph.CommitGraph],
+    extract,
+    progress=None,
+) -> None:
+    """
+    Fetches the history of a dumb upstream, adding every object to builder
+
+    :param tips: Binary object ids to start from
+    :param graphs: Reachability indexes without a shallow boundary, the walk stops at
+        the objects they have
+    :param extract: Async callback that extracts a spooled pack into the database and
+        builder, e.g. ingest.extract
+    :param progress: Optional async callback, called as progress(walked objects, walked
+        and queued objects)
+    """
+    remote = DumbRemote(repo_base_url, headers)
+    try:
+        if builder.base is None:
+            for name in await asyncio.to_thread(remote.packs):
+                await extract_pack(remote, name, extract)
+        await walk(remote, tips, db, builder, graphs, extract, progress)
+    finally:
+        remote.close()
+
+
+async def extract_pack(remote: DumbRemote, name: str, extract) -> None:
+    info("Downloading %s", name)
+    with metrics.timer("upstream_fetch"):
+        spool = await asyncio.to_thread(remote.download, name)
+    await extract(spool)
+    remote.extracted.add(name)
+
+
+async def walk(
+    remote: DumbRemote,
+    tips: list[bytes],
+    db,
+    builder: graph.GraphBuilder,
+    graphs: list[graph.CommitGraph],
+    extract,
+    progress=None,
+) -> None:
+    limit = asyncio.Semaphore(DUMB_CONCURRENCY)
+
+    async def fetch_loose(oid: bytes):
+        async with limit:
+            return oid, await asyncio.to_thread(remote.loose, oid)
+
+    queue = deque(tips)
+    seen = set()
+    fetched = 0
+    while queue:
+        batch = []
+        while queue and len(batch) < BATCH:
+            oid = queue.popleft()
+            if oid in seen or any(other.complete(oid) for other in graphs):
+                continue
+            seen.add(oid)
+            batch.append(oid)
+
+        missing = [oid for oid in batch if oid not in builder]
+        if missing:
+            await load_stored(missing, db, builder)
+            missing = [oid for oid in missing if oid not in builder]
+        if missing:
+            with metrics.timer("upstream_fetch"):
+                results = await asyncio.gather(*map(fetch_loose, missing))
+            rows = []
+            packed = []
+            for oid, content in results:
+                if content is None:
+                    packed.append(oid)
+                    continue
+                raw_obj = zlib.decompress(content)
+                if hashlib.sha1(raw_obj).digest() != oid:
+                    raise DumbFetchError(f"Upstream sent a corrupt object {oid.hex()}")
+                builder.add(oid, *split_object(raw_obj))
+                rows.append((oid.hex(), content))
+            await insert_raw_many(rows, db)
+            fetched += len(rows)
+            if packed:
+                await fetch_packed(remote, packed, builder, extract)
+
+        for oid in batch:
+            queue.extend(link for link, _ in builder.links(oid))
+        if progress is not None:
+            await progress(len(seen), len(seen) + len(queue))
+    info("Fetched %d loose objects", fetched)
+
+
+async def load_stored(oids: list[bytes], db, builder: graph.GraphBuilder) -> None:
+    """Adds the objects that are already stored to builder"""
+    rows = await db.fetch(
+        "SELECT hash, blob, path, codec FROM objects WHERE hash = any($1::text[]);",
+        [oid.hex() for oid in oids],
+    )
+    for row in rows:
+        if row["path"] is not None:
+            content = await asyncio.to_thread(storage.read_object, row["path"])
+            raw_obj = zlib.decompress(content)
+        else:
+            raw_obj = codec.decode(row["blob"], row["codec"])
+        builder.add(bytes.fromhex(row["hash"]), *split_object(raw_obj))
+    if rows:
+        debug("%d objects of the walk were stored already", len(rows))
+
+
+async def fetch_packed(
+    remote: DumbRemote, oids: list[bytes], builder: graph.GraphBuilder, extract
+) -> None:
+    """Extracts the packs that contain objects that aren't loose upstream"""
+    wanted = set(oids)
+    for name in await asyncio.to_thread(remote.packs):
+        if not wanted:
+            break
+        if name in remote.extracted:
+            continue
+        index = await asyncio.to_thread(remote.index, name)
+        if index & wanted:
+            await extract_pack(remote, name, extract)
+            wanted -= index
+    wanted = {oid for oid in wanted if oid not in builder}
+    if wanted:
+        raise DumbFetchError(
+            f"{len(wanted)} objects not found upstream, e.g. {min(wanted).hex()}"
+        )
@@ -0,0 +1,182 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from logging import debug, info, warning
+
+import asyncpg
+
+from . import metrics
+from .config import DATABASE_URL, LOCAL_CACHE_SIZE
+
+# Several HTTP worker processes and ingest processes share one database. Changes are
+# announced on a Postgres channel with NOTIFY, and every process keeps a connection that
+# LISTENs on it:
+#   ingest <remote>: a job finished or failed, wakes up the requests waiting for it
+#   queued <remote>: a job was queued, wakes up idle ingest workers
+#   graph <remote>: the reachability index changed or was deleted
+#   refs <remote>: the refs were stored again
+#   memory: an ingest gave back memory of the INGEST_MEMORY_BUDGET
+# Processes only keep small LocalCaches of what they load from the database, dropped on
+# the matching notification. A notification that is missed while the listening
+# connection is down can't make a cache stale, as nothing is cached then and everything
+# is dropped on reconnecting.
+
+CHANNEL = "gitmitm"
+
+# Seconds before reconnecting after the listening connection was lost
+RECONNECT_DELAY = 5
+
+# (event, remote or None for any) -> futures of the coroutines waiting for it
+waiters: dict[tuple[str, str | None], set[asyncio.Future]] = {}
+caches: list["LocalCache"] = []
+listening = False
+# Bytes taken up by the entries of all caches, which share LOCAL_CACHE_SIZE
+cached_bytes = 0
+# Counts every use of an entry, so the least recently used one of all caches is found
+uses = itertools.count()
+
+
+async def notify(event: str, remote: str, db) -> None:
+    await db.execute("SELECT pg_notify($1, $2);", CHANNEL, f"{event} {remote}")
+
+
+def dispatch(event: str | None, remote: str | None) -> None:
+    """Handles a notification, None meaning anything may have changed"""
+    for cache in caches:
+        if event in (cache.event, None):
+            cache.invalidate(remote)
+    for (waited, waited_remote), futures in list(waiters.items()):
+        if event in (waited, None) and waited_remote in (remote, None):
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+
+def on_notification(connection, pid, channel, payload: str) -> None:
+    event, _, remote = payload.partition(" ")
+    debug("Notification %s for %s", event, remote)
+    dispatch(event, remote)
+
+
+async def wait(event: str, remote: str | None, timeout: float) -> bool:
+    """
+    Waits for a notification, at most timeout seconds
+
+    :param remote: Remote the notification is for, None for any
+
+    :returns: whether it was received
+    """
+    future = asyncio.get_running_loop().create_future()
+    futures = waiters.setdefault((event, remote), set())
+    futures.add(future)
+    try:
+        await asyncio.wait_for(future, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        futures.discard(future)
+        if not futures:
+            waiters.pop((event, remote), None)
+
+
+async def listener() -> None:
+    global listening
+    while True:
+        closed = asyncio.Event()
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            conn.add_termination_listener(lambda _: closed.set())
+            await conn.add_listener(CHANNEL, on_notification)
+            listening = True
+            # anything may have changed while nobody was listening
+            dispatch(None, None)
+            info("Listening for changes on %s", CHANNEL)
+            try:
+                await closed.wait()
+            finally:
+                listening = False
+                dispatch(None, None)
+                if not conn.is_closed():
+                    await conn.close()
+            warning("Lost the connection listening for changes")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning("Could not listen for changes: %r", e)
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+def start_listener() -> list[asyncio.Task]:
+    return [asyncio.create_task(listener())]
+
+
+def shrink() -> None:
+    """
+    Drops the least recently used entries of all caches until they fit into
+    LOCAL_CACHE_SIZE. The last entry is kept even if it's larger on its own.
+    """
+    while cached_bytes > LOCAL_CACHE_SIZE:
+        used = [cache for cache in caches if cache.entries]
+        if sum(len(cache.entries) for cache in used) <= 1:
+            break
+        oldest = min(used, key=lambda cache: cache.oldest_use())
+        oldest.drop(next(iter(oldest.entries)))
+
+
+class LocalCache:
+    """
+    LRU cache of values loaded from the database, keyed by tuples starting with the
+    remote. All caches of a process take up at most LOCAL_CACHE_SIZE bytes together, see
+    shrink. Entries of a remote are dropped when event is notified for it. Nothing is
+    cached while not listening.
+    """
+
+    def __init__(self, event: str):
+        self.event = event
+        # key -> tuple(value, size, use), least recently used first
+        self.entries: OrderedDict[tuple, tuple] = OrderedDict()
+        # bumped by every invalidation, see put
+        self.generation = 0
+        caches.append(self)
+
+    def get(self, key: tuple):
+        if not listening:
+            return None
+        hit = key in self.entries
+        metrics.inc(
+            "gitmitm_cache_requests_total",
+            cache=f"local_{self.event}",
+            result="hit" if hit else "miss",
+        )
+        if not hit:
+            return None
+        value, size, _ = self.entries.pop(key)
+        self.entries[key] = (value, size, next(uses))
+        return value
+
+    def put(self, key: tuple, value, size: int, generation: int) -> None:
+        """
+        :param generation: self.generation from before the value was loaded, so a value
+            that was changed in the meantime isn't cached
+        """
+        if not listening or generation != self.generation:
+            return
+        global cached_bytes
+        self.drop(key)
+        self.entries[key] = (value, size, next(uses))
+        cached_bytes += size
+        shrink()
+
+    def drop(self, key: tuple) -> None:
+        global cached_bytes
+        if key in self.entries:
+            cached_bytes -= self.entries.pop(key)[1]
+
+    def oldest_use(self) -> int:
+        return next(iter(self.entries.values()))[2]
+
+    def invalidate(self, remote: str | None) -> None:
+        self.generation += 1
+        for key in [key for key in self.entries if remote is None or key[0] == remote]:
+            self.drop(key)
@@ -0,0 +1,343 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from logging import debug, info, warning
+
+from . import events, graph, metrics, pack_store, storage
+from .config import (
+    GC_BATCH,
+    GC_INTERVAL,
+    GC_MIN_IDLE,
+    GC_PAUSE,
+    INGEST_POLL_INTERVAL,
+    STORAGE_BUDGET,
+    WARM_REMOTES,
+)
+from .db import connection
+
+# Keeps the stored objects within STORAGE_BUDGET. Every remote has a row in
+# remote_usage with the last time it was cloned and the bytes its objects take up in
+# the database and the object store, updated after each ingest. A collector evicts the
+# remotes that were idle for the longest time until the total is back within budget:
+# first everything the proxy knows about the remote, so it isn't used as a related
+# remote or served anymore, then the objects that no other remote's reachability index
+# contains, in small batches.
+#
+# Objects a remote stores outside of its reachability index, blobs fetched by id and
+# injected objects, are recorded in remote_objects so they're counted and evicted
+# along with it. A remote that an ingest uses as a related remote is locked (see
+# forks.related_haves) and can't be evicted until the ingest is done.
+#
+# An object that is already stored isn't written again by the ingest that needs it, so
+# the collector can't tell it is in use until that ingest saves its reachability index.
+# Whatever stores objects holds STORING_LOCK_ID shared until they are in an index or
+# remote_objects (see storing), and each batch is deleted holding it exclusively.
+#
+# Objects shared by forks are counted for each of them, so the total overestimates what
+# is actually stored.
+
+USAGE_TABLE = """
+    CREATE TABLE IF NOT EXISTS remote_usage (
+        remote text primary key,
+        last_access timestamptz not null default now(),
+        bytes bigint not null default 0
+    );
+    CREATE TABLE IF NOT EXISTS remote_objects (
+        remote text not null,
+        hash char(40) not null,
+        PRIMARY KEY (remote, hash)
+    );
+    CREATE INDEX IF NOT EXISTS remote_objects_hash ON remote_objects (hash);
+"""
+
+# Only one collector runs at a time, no matter how many processes there are. Together
+# with the hashtext of a remote, also the lock that keeps a remote from being evicted.
+LOCK_ID = 0x67697467
+STORING_LOCK_ID = 0x73746F72
+
+# Per-remote tables, cleared when a remote is evicted
+REMOTE_TABLES = [
+    "refs",
+    "ref_lists",
+    "remote_refs",
+    "adverts",
+    "graphs",
+    "graph_bitmaps",
+    "remote_roots",
+    "remote_objects",
+    "ingest_jobs",
+    "ingest_job_refs",
+]
+
+
+async def touch(repo: str, db) -> None:
+    """Records that a remote was cloned, at most once a minute"""
+    await db.execute(
+        """
+        UPDATE remote_usage SET last_access = now()
+        WHERE remote = $1 AND last_access < now() - interval '1 minute';
+        """,
+        repo,
+    )
+
+
+async def owned(repo: str, index: graph.CommitGraph | None, db) -> set[str]:
+    """Gets the hashes of the stored objects of a remote"""
+    rows = await db.fetch("SELECT hash FROM remote_objects WHERE remote = $1;", repo)
+    hashes = {row["hash"] for row in rows}
+    if index is not None:
+        hashes.update(
+            index.oid(pos).hex()
+            for pos in range(len(index))
+            if index.sizes[pos] != graph.UNKNOWN_SIZE
+        )
+    return hashes
+
+
+async def stored_size(hashes: list[str], db) -> int:
+    """Works out how much the given objects take up in the database and object store"""
+    total = 0
+    paths = []
+    for i in range(0, len(hashes), GC_BATCH):
+        row = await db.fetchrow(
+            """
+            SELECT coalesce(sum(octet_length(blob)), 0) AS bytes,
+                array_remove(array_agg(path), NULL) AS paths
+            FROM objects WHERE hash = any($1::text[]);
+            """,
+            hashes[i : i + GC_BATCH],
+        )
+        total += row["bytes"]
+        paths.extend(row["paths"])
+    total += sum(await asyncio.to_thread(lambda: list(map(storage.object_size, paths))))
+    return total
+
+
+@asynccontextmanager
+async def storing(db):
+    """
+    Keeps the collector from deleting objects while they're stored and recorded, see
+    STORING_LOCK_ID
+
+    :returns: context manager giving the connection holding the lock
+    """
+    async with connection(db) as conn:
+        await conn.execute("SELECT pg_advisory_lock_shared($1);", STORING_LOCK_ID)
+        try:
+            yield conn
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock_shared($1);", STORING_LOCK_ID)
+
+
+async def record_size(repo: str, index: graph.CommitGraph, db) -> int:
+    """Works out how much the stored objects of a remote take up"""
+    total = await stored_size(sorted(await owned(repo, index, db)), db)
+    await db.execute(
+        """
+        INSERT INTO remote_usage (remote, bytes) VALUES ($1, $2)
+        ON CONFLICT (remote) DO UPDATE SET bytes = $2;
+        """,
+        repo,
+        total,
+    )
+    debug("%s takes up %d bytes", repo, total)
+    return total
+
+
+async def add_objects(repo: str, hashes: list[str], db) -> None:
+    """
+    Records objects a remote stored that its reachability index doesn't contain, e.g.
+    objects fetched by id or injected ones
+    """
+    rows = await db.fetch(
+        """
+        INSERT INTO remote_objects (remote, hash) SELECT $1, unnest($2::text[])
+        ON CONFLICT DO NOTHING RETURNING hash;
+        """,
+        repo,
+        hashes,
+    )
+    if not rows:
+        return
+    added = await stored_size([row["hash"] for row in rows], db)
+    await db.execute(
+        "UPDATE remote_usage SET bytes = bytes + $2 WHERE remote = $1;", repo, added
+    )
+
+
+async def pick_victims(db) -> list[str]:
+    """Gets the idle remotes to evict, least recently cloned first"""
+    total = await db.fetchval("SELECT coalesce(sum(bytes), 0) FROM remote_usage;")
+    if total <= STORAGE_BUDGET:
+        return []
+    info("Stored objects take up %d bytes, budget is %d", total, STORAGE_BUDGET)
+
+    rows = await db.fetch(
+        """
+        SELECT remote, bytes FROM remote_usage
+        WHERE last_access < now() - make_interval(secs => $1)
+            AND remote NOT IN (
+                SELECT remote FROM ingest_jobs WHERE status IN ('queued', 'running')
+            )
+            AND remote != all($2::text[])
+        ORDER BY last_access;
+        """,
+        GC_MIN_IDLE,
+        WARM_REMOTES,
+    )
+    victims = []
+    for row in rows:
+        if total <= STORAGE_BUDGET:
+            break
+        victims.append(row["remote"])
+        total -= row["bytes"]
+    if total > STORAGE_BUDGET:
+        warning("Not enough idle remotes to get within STORAGE_BUDGET")
+    return victims
+
+
+async def still_needed(
+    candidates: list[bytes], since: datetime | None, db
+) -> set[bytes]:
+    """
+    Gets the candidates that the reachability index of a remote contains
+
+    :param since: Only check the remotes that were ingested since then
+    """
+    needed = set()
+    remotes = await db.fetch(
+        "SELECT remote FROM graphs WHERE $1::timestamptz IS NULL OR updated >= $1;",
+        since,
+    )
+    for row in remotes:
+        index = await graph.load(row["remote"], db)
+        if index is None:
+            # a graph that can't be read keeps everything until it's rebuilt
+            return set(candidates)
+        needed |= await asyncio.to_thread(index.complete_of, candidates)
+    return needed
+
+
+async def delete_batch(batch: list[bytes], since: datetime | None, db):
+    """
+    Deletes the objects of a batch that no remote needs, once nothing is being stored
+
+    :param since: When the remotes were last checked for the objects of the batch
+    :returns: tuple(paths of the deleted objects, when the remotes were checked), or
+        None if objects are being stored
+    """
+    async with db.transaction():
+        if not await db.fetchval(
+            "SELECT pg_try_advisory_xact_lock($1);", STORING_LOCK_ID
+        ):
+            return None
+        # the database's clock, as graphs.updated is set by it
+        checked = await db.fetchval("SELECT clock_timestamp();")
+        needed = await still_needed(batch, since, db)
+        # Objects other remotes stored outside of their index are kept as well
+        rows = await db.fetch(
+            """
+            DELETE FROM objects WHERE hash = any($1::text[])
+                AND NOT EXISTS (
+                    SELECT 1 FROM remote_objects WHERE remote_objects.hash = objects.hash
+                )
+            RETURNING path;
+            """,
+            [oid.hex() for oid in batch if oid not in needed],
+        )
+    return [row["path"] for row in rows], checked
+
+
+async def evict(repo: str, db) -> int:
+    """
+    Removes a remote and the objects only it needs
+
+    :returns: number of objects deleted
+    """
+    # Ingests of related remotes hold the lock shared while they rely on its objects
+    if not await db.fetchval(
+        "SELECT pg_try_advisory_lock($1, hashtext($2));", LOCK_ID, repo
+    ):
+        info("Not evicting %s, a related remote is being ingested", repo)
+        return 0
+    try:
+        index = await graph.load(repo, db)
+        candidates = {bytes.fromhex(hash) for hash in await owned(repo, index, db)}
+        del index
+        async with db.transaction():
+            # It may have been cloned since it was picked
+            idle = await db.fetchval(
+                """
+                DELETE FROM remote_usage
+                WHERE remote = $1 AND last_access < now() - make_interval(secs => $2)
+                RETURNING remote;
+                """,
+                repo,
+                GC_MIN_IDLE,
+            )
+            if idle is None:
+                return 0
+            for table in REMOTE_TABLES:
+                await db.execute(f"DELETE FROM {table} WHERE remote = $1;", repo)
+    finally:
+        await db.execute("SELECT pg_advisory_unlock($1, hashtext($2));", LOCK_ID, repo)
+    await events.notify("graph", repo, db)
+    await events.notify("refs", repo, db)
+    if pack_store.enabled():
+        await asyncio.to_thread(pack_store.delete, repo)
+    metrics.inc("gitmitm_evicted_remotes_total")
+
+    candidates -= await still_needed(sorted(candidates), None, db)
+    pending = sorted(candidates)
+
+    deleted = 0
+    # Indexes saved before the first batch holds the lock may not have been seen yet
+    checked = None
+    for i in range(0, len(pending), GC_BATCH):
+        batch = pending[i : i + GC_BATCH]
+        # A remote ingested in the meantime may need some of the objects after all,
+        # so only the remotes ingested since the last batch are checked again
+        while (res := await delete_batch(batch, checked, db)) is None:
+            debug("Waiting for objects to be stored before deleting")
+            await events.wait("ingest", None, INGEST_POLL_INTERVAL)
+        paths, checked = res
+        await asyncio.to_thread(
+            lambda: [storage.delete_object(path) for path in paths if path is not None]
+        )
+        deleted += len(paths)
+        metrics.inc("gitmitm_evicted_objects_total", len(paths))
+        await asyncio.sleep(GC_PAUSE)
+
+    info("Evicted %s, deleted %d objects", repo, deleted)
+    return deleted
+
+
+async def collect(db) -> None:
+    """Evicts remotes until the stored objects are within STORAGE_BUDGET"""
+    if not await db.fetchval("SELECT pg_try_advisory_lock($1);", LOCK_ID):
+        debug("Another collector is running")
+        return
+    try:
+        for repo in await pick_victims(db):
+            await evict(repo, db)
+    finally:
+        await db.execute("SELECT pg_advisory_unlock($1);", LOCK_ID)
+
+
+async def collector(pool) -> None:
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try:
+            async with pool.acquire() as db:
+                await collect(db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning("Storage collector error: %r", e)
+
+
+def start_collector(pool) -> list[asyncio.Task]:
+    """Starts the collector, if there is a STORAGE_BUDGET"""
+    if not STORAGE_BUDGET:
+        return []
+    return [asyncio.create_task(collector(pool))]
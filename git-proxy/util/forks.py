@@ -0,0 +1,125 @@
+from logging import debug
+from urllib.parse import urlparse
+
+from . import eviction, graph
+from .config import FORKS
+
+# Remotes that share history, e.g. a repository and its forks, are fetched with the
+# tips of the related remotes that are already cached as haves, so upstream only sends
+# the objects unique to the remote. The objects table is shared by all remotes, so the
+# rest is already stored, and the reachability index of the remote is completed from
+# the related remote's index (see GraphBuilder.fill_from).
+#
+# Remotes are related if FORKS says so, if they have a ref pointing to the same object,
+# which is what a fresh fork looks like, or once their history is fetched, if they
+# have the same root commit.
+
+ROOT_TABLE = """
+    CREATE TABLE IF NOT EXISTS remote_roots (
+        remote text not null,
+        root char(40) not null,
+        PRIMARY KEY (remote, root)
+    );
+    CREATE INDEX IF NOT EXISTS remote_roots_root ON remote_roots (root);
+"""
+
+
+def configured(repo_base_url: str) -> list[str]:
+    """
+    Gets the remotes FORKS relates to a remote. Paths are compared without a .git
+    suffix, so both variants are returned.
+    """
+
+    def normalize(path: str) -> str:
+        path = path.strip("/")
+        return path[:-4] if path.endswith(".git") else path
+
+    url = urlparse(repo_base_url)
+    path = normalize(url.path)
+    related = set()
+    for a, b in FORKS:
+        if path in (normalize(a), normalize(b)):
+            related.update((normalize(a), normalize(b)))
+    related.discard(path)
+    return [
+        url._replace(path=f"/{other}{suffix}").geturl()
+        for other in sorted(related)
+        for suffix in ("", ".git")
+    ]
+
+
+async def related_remotes(repo_base_url: str, tips: list[bytes], db) -> list[str]:
+    """
+    Gets the cached remotes that share history with a remote
+
+    :param tips: Ref tips of the remote, as hex bytes
+    """
+    rows = await db.fetch(
+        """
+        SELECT remote FROM remote_refs WHERE oid = any($2::text[]) AND remote != $1
+        UNION
+        SELECT other.remote FROM remote_roots own
+            JOIN remote_roots other ON other.root = own.root
+            WHERE own.remote = $1 AND other.remote != $1
+        UNION
+        SELECT remote FROM ref_lists WHERE remote = any($3::text[]);
+        """,
+        repo_base_url,
+        [tip.decode() for tip in tips],
+        configured(repo_base_url),
+    )
+    return sorted(row["remote"] for row in rows)
+
+
+async def related_haves(
+    repo_base_url: str, tips: list[bytes], db
+) -> tuple[list[bytes], list[graph.CommitGraph]]:
+    """
+    Gets the haves to send upstream for the related remotes of a remote. Related
+    remotes that were fetched with a depth are skipped, a have stands for its whole
+    history. The related remotes that are used are locked against eviction until
+    release is called.
+
+    :returns: tuple(haves as hex bytes, reachability indexes of the related remotes)
+    """
+    haves = []
+    graphs = []
+    for other in await related_remotes(repo_base_url, tips, db):
+        await db.execute(
+            "SELECT pg_advisory_lock_shared($1, hashtext($2));", eviction.LOCK_ID, other
+        )
+        index = await graph.load(other, db)
+        if index is None or index.shallow:
+            await db.execute(
+                "SELECT pg_advisory_unlock_shared($1, hashtext($2));",
+                eviction.LOCK_ID,
+                other,
+            )
+            continue
+        rows = await db.fetch(
+            "SELECT DISTINCT coalesce(peeled, oid) AS oid FROM remote_refs WHERE remote = $1;",
+            other,
+        )
+        # Tips behind another tip say nothing more, so this is usually a handful
+        oids = [bytes.fromhex(row["oid"]) for row in rows]
+        oids = [oid for oid in index.independent(oids) if index.complete(oid)]
+        debug("%d haves from related remote %s", len(oids), other)
+        haves.extend(oid.hex().encode() for oid in oids)
+        graphs.append(index)
+    return haves, graphs
+
+
+async def release(db) -> None:
+    """Releases the related remotes locked by related_haves"""
+    # ingest connections hold no other advisory locks
+    await db.execute("SELECT pg_advisory_unlock_all();")
+
+
+async def save_roots(repo_base_url: str, index: graph.CommitGraph, db) -> None:
+    roots = [oid.hex() for oid in index.roots()]
+    if not roots:
+        return
+    await db.executemany(
+        "INSERT INTO remote_roots (remote, root) VALUES ($1, $2) ON CONFLICT DO NOTHING;",
+        [(repo_base_url, root) for root in roots],
+    )
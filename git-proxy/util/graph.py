@@ -0,0 +1,726 @@
+import copy
+import struct
+import sys
+import zlib
+from array import array
+from logging import debug, warning
+
+from . import events
+
+# Reachability index of a remote, similar to git's commit-graph file: every object of
+# the remote with the objects it points to, in flat arrays indexed by the position of
+# the object in the sorted object id table. Reachability bitmaps of HEAD and the first
+# GRAPH_BITMAPS branch tips are kept as ints with bit n set if object n is reachable, so
+# working out which objects a client is missing is a couple of integer operations
+# instead of a walk over every commit and tree in the database. Other tips are walked.
+#
+# Built while a pack is ingested (see read_packfile) and stored per remote in the
+# graphs table, with the bitmaps compressed in graph_bitmaps, one row per tip. A refresh
+# only merges its new objects into the previous graph, and the bitmaps of the previous
+# tips are shifted to the new positions and used as shortcuts by the walks for the new
+# ones. A refresh that brings no new objects leaves the object table alone and only
+# replaces the bitmaps of tips that moved. Objects that upstream left out of a filtered
+# pack are still in the graph, as promised objects of unknown size, so they can be
+# fetched once needed.
+# Remotes that were fetched with a depth also keep their shallow boundary: the commits
+# whose parents haven't been fetched yet.
+#
+# Loaded graphs are kept in a LocalCache, so they are shared and must not be modified.
+
+GRAPH_TABLE = """
+    CREATE TABLE IF NOT EXISTS graphs (
+        remote text primary key,
+        graph bytea not null,
+        updated timestamptz not null default now()
+    );
+    ALTER TABLE graphs ADD COLUMN IF NOT EXISTS shallow bytea not null default '';
+    CREATE TABLE IF NOT EXISTS graph_bitmaps (
+        remote text not null,
+        oid bytea not null,
+        bitmap bytea not null,
+        PRIMARY KEY (remote, oid)
+    );
+"""
+
+cache = events.LocalCache("graph")
+
+# Same values as the pack entry types
+TYPE_COMMIT = 1
+TYPE_TREE = 2
+TYPE_BLOB = 3
+TYPE_TAG = 4
+
+TYPE_IDS = {
+    b"commit": TYPE_COMMIT,
+    b"tree": TYPE_TREE,
+    b"blob": TYPE_BLOB,
+    b"tag": TYPE_TAG,
+}
+
+GITLINK_MODE = b"160000"
+TREE_MODE = b"40000"
+
+# Size of promised objects, which is only known once they are fetched
+UNKNOWN_SIZE = 2**64 - 1
+
+# Stored graphs: magic, version, number of objects, number of links, followed by the
+# arrays of CommitGraph in little endian
+HEADER = struct.Struct("<4sBxxxQQ")
+MAGIC = b"GRPH"
+VERSION = 1
+
+
+def parse_links(obj_type: int, data: bytes) -> list[tuple[bytes, int]]:
+    """
+    Gets the binary object ids and types of the objects an object points to, from the
+    object without its header. For commits, the root tree comes first and the parents
+    after it.
+    """
+    links = []
+    if obj_type == TYPE_COMMIT:
+        headers = data.split(b"\n\n", 1)[0]
+        for line in headers.split(b"\n"):
+            if line.startswith(b"tree "):
+                links.append((bytes.fromhex(line[5:].decode()), TYPE_TREE))
+            elif line.startswith(b"parent "):
+                links.append((bytes.fromhex(line[7:].decode()), TYPE_COMMIT))
+    elif obj_type == TYPE_TAG:
+        headers = dict(
+            line.split(b" ", 1) for line in data.split(b"\n\n", 1)[0].split(b"\n")
+        )
+        links.append(
+            (bytes.fromhex(headers[b"object"].decode()), TYPE_IDS[headers[b"type"]])
+        )
+    elif obj_type == TYPE_TREE:
+        # entries are "<mode> <name>\0<20 byte id>"
+        idx = 0
+        while idx < len(data):
+            space = data.index(b" ", idx)
+            nul = data.index(b"\0", space)
+            mode = data[idx:space]
+            # submodule commits live in another repository
+            if mode != GITLINK_MODE:
+                links.append(
+                    (
+                        bytes(data[nul + 1 : nul + 21]),
+                        TYPE_TREE if mode == TREE_MODE else TYPE_BLOB,
+                    )
+                )
+            idx = nul + 21
+    return links
+
+
+class CommitGraph:
+    """
+    oids: sorted 20 byte object ids, concatenated
+    fanout: number of object ids whose first byte is at most n, for quick lookups
+    types: type of each object
+    sizes: size of each object without its header, UNKNOWN_SIZE for promised objects
+    link_start, links: the positions an object points to are
+        links[link_start[n] : link_start[n + 1]]. For commits the root tree comes
+        first, followed by the parents. Objects that aren't in the graph are left out.
+    bitmaps: object id -> reachability bitmap, for the ref tips
+    shallow: object ids of the commits whose parents haven't been fetched
+    """
+
+    def __init__(
+        self, oids: bytes, types: array, sizes: array, link_start: array, links: array
+    ):
+        self.oids = oids
+        self.types = types
+        self.sizes = sizes
+        self.link_start = link_start
+        self.links = links
+        self.bitmaps: dict[bytes, int] = {}
+        self.shallow: set[bytes] = set()
+
+        self.fanout = array("I", [0] * 256)
+        for i in range(0, len(oids), 20):
+            self.fanout[oids[i]] += 1
+        total = 0
+        for i in range(256):
+            total += self.fanout[i]
+            self.fanout[i] = total
+
+    @classmethod
+    def empty(cls) -> "CommitGraph":
+        return cls(b"", array("B"), array("Q"), array("Q", [0]), array("I"))
+
+    def __len__(self):
+        return len(self.types)
+
+    def __repr__(self):
+        return f"<CommitGraph objects={len(self)} bitmaps={len(self.bitmaps)}>"
+
+    def oid(self, pos: int) -> bytes:
+        return self.oids[pos * 20 : pos * 20 + 20]
+
+    def bisect(self, oid: bytes) -> int:
+        """Gets the position a binary object id has or would be inserted at"""
+        lo = self.fanout[oid[0] - 1] if oid[0] else 0
+        hi = self.fanout[oid[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.oids[mid * 20 : mid * 20 + 20] < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def position(self, oid: bytes) -> int | None:
+        """Gets the position of a binary object id, None if it isn't in the graph"""
+        pos = self.bisect(oid)
+        return pos if self.oids[pos * 20 : pos * 20 + 20] == oid else None
+
+    def children(self, pos: int) -> array:
+        return self.links[self.link_start[pos] : self.link_start[pos + 1]]
+
+    def parents(self, pos: int) -> list[bytes]:
+        """Gets the parents of a commit"""
+        assert self.types[pos] == TYPE_COMMIT
+        return [self.oid(p) for p in self.children(pos)[1:]]
+
+    def tree(self, pos: int) -> bytes:
+        """Gets the root tree of a commit"""
+        assert self.types[pos] == TYPE_COMMIT
+        return self.oid(self.children(pos)[0])
+
+    def reachable(
+        self, oids: list[bytes], stop: int = 0, cut: set[int] = frozenset()
+    ) -> int:
+        """
+        Gets the bitmap of every object reachable from the given object ids.
+        Objects in stop (a bitmap) and anything only reachable through them are skipped.
+        The walk takes the bitmaps of the tips it comes across instead of walking past
+        them.
+
+        :param cut: Positions of commits whose parents aren't followed, e.g. the
+            shallow commits of a client
+        """
+        nbytes = (len(self) + 7) // 8
+        # Precomputed bitmaps are merged as ints, the walk itself uses bytearrays as
+        # testing a single bit of a large int copies it
+        found = 0
+        stack = []
+        shortcuts = (
+            {}
+            if cut
+            else {self.position(oid): bits for oid, bits in self.bitmaps.items()}
+        )
+        for oid in oids:
+            if oid in self.bitmaps and not cut:
+                found |= self.bitmaps[oid]
+                continue
+            pos = self.position(oid)
+            if pos is not None:
+                stack.append(pos)
+        seen = bytearray((found & ~stop).to_bytes(nbytes, "little"))
+        skip = stop.to_bytes(nbytes, "little")
+
+        link_start = self.link_start
+        links = self.links
+        while stack:
+            pos = stack.pop()
+            byte = pos >> 3
+            bit = 1 << (pos & 7)
+            if (seen[byte] | skip[byte]) & bit:
+                continue
+            if pos in shortcuts:
+                found = int.from_bytes(seen, "little") | (shortcuts.pop(pos) & ~stop)
+                seen = bytearray(found.to_bytes(nbytes, "little"))
+                continue
+            seen[byte] |= bit
+            if pos in cut:
+                # only the root tree
+                stack.append(links[link_start[pos]])
+            else:
+                stack.extend(links[link_start[pos] : link_start[pos + 1]])
+
+        return int.from_bytes(seen, "little")
+
+    def walk_commits(
+        self, oids: list[bytes], depth: int | None = None, cut: set[int] = frozenset()
+    ) -> tuple[set[int], set[int]]:
+        """
+        Gets the commits within depth of the given commits, like git's deepen.
+        The given commits have a depth of 1. Tags are peeled to their commits.
+
+        :param cut: Positions of commits whose parents aren't followed
+        :returns: tuple(positions of the commits, positions of the commits at the
+            boundary, whose parents are left out)
+        """
+        link_start = self.link_start
+        links = self.links
+        types = self.types
+
+        level = set()
+        for pos in {self.position(oid) for oid in oids} - {None}:
+            # tags count as the commit they point to
+            while types[pos] == TYPE_TAG and link_start[pos] < link_start[pos + 1]:
+                pos = links[link_start[pos]]
+            if types[pos] == TYPE_COMMIT:
+                level.add(pos)
+        commits = set(level)
+        boundary = set()
+        current = 1
+        while level:
+            next_level = set()
+            for pos in level:
+                if pos in cut:
+                    continue
+                parents = links[link_start[pos] + 1 : link_start[pos + 1]]
+                if depth is not None and current >= depth:
+                    if parents:
+                        boundary.add(pos)
+                    continue
+                next_level.update(p for p in parents if p not in commits)
+            commits |= next_level
+            level = next_level
+            current += 1
+        return commits, boundary
+
+    def complete(self, oid: bytes) -> bool:
+        """Whether an object is in the graph and isn't just promised"""
+        pos = self.position(oid)
+        return pos is not None and self.sizes[pos] != UNKNOWN_SIZE
+
+    def complete_of(self, oids: list[bytes]) -> set[bytes]:
+        """Gets the object ids that are in the graph and aren't just promised"""
+        sizes = self.sizes
+        positions = map(self.position, oids)
+        return {
+            oid
+            for oid, pos in zip(oids, positions)
+            if pos is not None and sizes[pos] != UNKNOWN_SIZE
+        }
+
+    def roots(self) -> list[bytes]:
+        """Gets the commits without parents"""
+        link_start = self.link_start
+        return [
+            self.oid(pos)
+            for pos in range(len(self))
+            if self.types[pos] == TYPE_COMMIT
+            and self.sizes[pos] != UNKNOWN_SIZE
+            and link_start[pos + 1] - link_start[pos] == 1
+        ]
+
+    def independent(self, oids: list[bytes]) -> list[bytes]:
+        """
+        Drops the object ids that are reachable from another one of them, e.g. a
+        branch that was merged or a tag on a branch's history. Object ids that aren't
+        in the graph are kept.
+        """
+        oids = list(dict.fromkeys(oids))
+        positions = [self.position(oid) for oid in oids]
+        types = self.types
+
+        # Only commits and tags can lead to another tip, so trees aren't walked
+        seen = bytearray(len(self))
+        stack = [
+            link for pos in positions if pos is not None for link in self.children(pos)
+        ]
+        while stack:
+            pos = stack.pop()
+            if seen[pos] or types[pos] not in (TYPE_COMMIT, TYPE_TAG):
+                continue
+            seen[pos] = 1
+            stack.extend(self.children(pos))
+        return [
+            oid for oid, pos in zip(oids, positions) if pos is None or not seen[pos]
+        ]
+
+    def promised(self) -> list[bytes]:
+        """Gets the object ids of the promised objects"""
+        return [
+            self.oid(pos) for pos, size in enumerate(self.sizes) if size == UNKNOWN_SIZE
+        ]
+
+    def shallow_positions(self) -> set[int]:
+        return {self.position(oid) for oid in self.shallow} - {None}
+
+    def same_objects(self, other: "CommitGraph") -> bool:
+        """Whether another graph has the same objects at the same positions"""
+        return (
+            self.oids == other.oids
+            and self.sizes == other.sizes
+            and self.link_start == other.link_start
+            and self.links == other.links
+        )
+
+    def add_bitmaps(self, tips: list[bytes]) -> None:
+        """Precomputes the bitmaps of the given tips"""
+        for oid in tips:
+            if oid not in self.bitmaps and self.position(oid) is not None:
+                self.bitmaps[oid] = self.reachable([oid])
+
+    def iter_bitmap(self, bitmap: int):
+        """Yields the position of every object in a bitmap"""
+        data = bitmap.to_bytes((len(self) + 7) // 8, "little")
+        for i, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                yield i * 8 + low.bit_length() - 1
+                byte ^= low
+
+    def missing(
+        self,
+        wants: list[bytes],
+        haves: list[bytes],
+        blob_limit: int | None = None,
+        cut: set[int] = frozenset(),
+        have_cut: set[int] = frozenset(),
+    ) -> list[bytes]:
+        """
+        Gets the objects a client needs for wants when it already has haves, as binary
+        object ids. Objects that aren't in the graph are not included.
+
+        :param blob_limit: Leave out blobs of at least this size, like the blob:limit
+            filter (0 for blob:none). Blobs of unknown size are left out as well, as the
+            client fetches whatever it turns out to need. Wanted blobs are always included.
+        :param cut, have_cut: Commits whose parents aren't followed from wants and
+            haves, see reachable
+        """
+        have_bits = self.reachable(haves, cut=have_cut)
+        want_bits = self.reachable(wants, stop=have_bits, cut=cut)
+        wanted = set(wants)
+        res = []
+        types = self.types
+        sizes = self.sizes
+        for pos in self.iter_bitmap(want_bits & ~have_bits):
+            oid = self.oid(pos)
+            if (
+                blob_limit is not None
+                and types[pos] == TYPE_BLOB
+                and sizes[pos] >= blob_limit
+                and oid not in wanted
+            ):
+                continue
+            res.append(oid)
+        debug("%d objects missing for %d wants", len(res), len(wants))
+        return res
+
+    def dumps(self) -> bytes:
+        """Serializes the object table, bitmaps are stored separately"""
+        arrays = [self.types, self.sizes, self.link_start, self.links]
+        if sys.byteorder == "big":
+            arrays = [copy.copy(a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+        header = HEADER.pack(MAGIC, VERSION, len(self), len(self.links))
+        return b"".join([header, self.oids, *(a.tobytes() for a in arrays)])
+
+    @classmethod
+    def loads(cls, data: bytes) -> "CommitGraph | None":
+        """Deserializes an object table, None if it was stored in another format"""
+        if data[:4] != MAGIC or data[4] != VERSION:
+            return None
+        _, _, count, nlinks = HEADER.unpack_from(data)
+        view = memoryview(data)[HEADER.size :]
+        oids = bytes(view[: count * 20])
+        view = view[count * 20 :]
+        arrays = []
+        for typecode, length in (
+            ("B", count),
+            ("Q", count),
+            ("Q", count + 1),
+            ("I", nlinks),
+        ):
+            a = array(typecode)
+            a.frombytes(view[: length * a.itemsize])
+            view = view[length * a.itemsize :]
+            if sys.byteorder == "big":
+                a.byteswap()
+            arrays.append(a)
+        return cls(oids, *arrays)
+
+    def dump_bitmap(self, bitmap: int) -> bytes:
+        # bitmaps are mostly runs of set or unset bits, which compress well
+        return zlib.compress(bitmap.to_bytes((len(self) + 7) // 8, "little"), 1)
+
+    @staticmethod
+    def load_bitmap(data: bytes) -> int:
+        return int.from_bytes(zlib.decompress(data), "little")
+
+
+class GraphBuilder:
+    """
+    Collects objects while a pack is extracted, see read_packfile.
+    The objects are merged into an existing graph, so a pack only needs to contain the
+    objects that are new.
+    Objects that are pointed to but never added end up in the graph as promised objects.
+    """
+
+    def __init__(self, base: CommitGraph | None = None):
+        # oid -> tuple(type, size, links) of the objects that were added
+        self.objects: dict[bytes, tuple[int, int, list[tuple[bytes, int]]]] = {}
+        self.shallow: set[bytes] = set()
+        self.base = base
+        if base is not None:
+            self.shallow = set(base.shallow)
+
+    def __contains__(self, oid: bytes) -> bool:
+        """Whether an object was added or is complete in the base graph"""
+        return oid in self.objects or (
+            self.base is not None and self.base.complete(oid)
+        )
+
+    def add(self, oid: bytes, obj_type: int, data: bytes) -> None:
+        self.objects[oid] = (obj_type, len(data), parse_links(obj_type, data))
+
+    def links(self, oid: bytes) -> list[tuple[bytes, int]]:
+        """Gets the binary object ids and types an object in the builder points to"""
+        if oid in self.objects:
+            return self.objects[oid][2]
+        base = self.base
+        return [(base.oid(p), base.types[p]) for p in base.children(base.position(oid))]
+
+    def fill_from(self, other: CommitGraph, tips: list[bytes]) -> int:
+        """
+        Adds the objects of another remote's graph that the collected objects or the
+        tips point to, i.e. what upstream left out because of the haves of the other
+        remote. Shallow commits whose history the other graph has are no longer shallow.
+
+        :returns: number of objects added
+        """
+        start = set(tips)
+        for _, _, children in self.objects.values():
+            start.update(oid for oid, _ in children)
+        if self.base is not None:
+            start.update(self.base.promised())
+        start = [oid for oid in start if oid not in self] + list(self.shallow)
+        start = [oid for oid in start if other.complete(oid)]
+
+        added = 0
+        sizes = other.sizes
+        for pos in other.iter_bitmap(other.reachable(start)):
+            oid = other.oid(pos)
+            if sizes[pos] == UNKNOWN_SIZE or oid in self:
+                continue
+            links = [(other.oid(p), other.types[p]) for p in other.children(pos)]
+            self.objects[oid] = (other.types[pos], sizes[pos], links)
+            added += 1
+        if not other.shallow:
+            self.shallow.difference_update(start)
+        return added
+
+    def update_shallow(self, shallow: list[bytes], unshallow: list[bytes]) -> None:
+        """Applies the shallow-info section of a fetch response"""
+        self.shallow.difference_update(unshallow)
+        self.shallow.update(shallow)
+
+    def build(self, tips: list[bytes] = ()) -> CommitGraph:
+        """
+        Builds the graph, with bitmaps for the given tips. The added objects are merged
+        into the base graph, whose bitmaps are moved along if no promised commit or
+        tree was added.
+        """
+        base = self.base if self.base is not None else CommitGraph.empty()
+        # objects that aren't in base, and promised objects of base that were added
+        inserts = {}
+        updates = {}
+        for oid, obj in self.objects.items():
+            pos = base.position(oid)
+            if pos is None:
+                inserts[oid] = obj
+            elif base.sizes[pos] == UNKNOWN_SIZE:
+                updates[pos] = obj
+        promised = 0
+        for _, _, children in self.objects.values():
+            for oid, obj_type in children:
+                if oid not in self.objects and oid not in inserts:
+                    if base.position(oid) is None:
+                        inserts[oid] = (obj_type, UNKNOWN_SIZE, [])
+                        promised += 1
+        if promised:
+            debug("%d promised objects", promised)
+
+        if not inserts and not updates:
+            # shares the arrays of base
+            graph = copy.copy(base)
+            bitmaps = dict(base.bitmaps)
+        else:
+            graph = merge(base, inserts, updates)
+            if any(obj_type != TYPE_BLOB for obj_type, _, _ in updates.values()):
+                # objects that were promised point to others now
+                bitmaps = {}
+            else:
+                new_oids = sorted(inserts)
+                at = [base.bisect(oid) for oid in new_oids]
+                bitmaps = {
+                    oid: shift_bitmap(bits, len(base), at)
+                    for oid, bits in base.bitmaps.items()
+                }
+            debug("Merged %d new and %d promised objects", len(inserts), len(updates))
+        graph.shallow = set(self.shallow)
+        # the bitmaps of previous tips are shortcuts for the new ones
+        graph.bitmaps = bitmaps
+        graph.add_bitmaps(tips)
+        graph.bitmaps = {
+            oid: bits for oid, bits in graph.bitmaps.items() if oid in tips
+        }
+        return graph
+
+
+def merge(
+    base: CommitGraph,
+    inserts: dict[bytes, tuple[int, int, list[tuple[bytes, int]]]],
+    updates: dict[int, tuple[int, int, list[tuple[bytes, int]]]],
+) -> CommitGraph:
+    """
+    Builds a graph from base with objects inserted and the promised objects at some
+    positions of base replaced. The rows of base are copied as array slices with their
+    links moved to the new positions.
+
+    :param inserts: oid -> tuple(type, size, links) of the objects that aren't in base
+    :param updates: position -> tuple(type, size, links) of the objects to replace
+    """
+    new_oids = sorted(inserts)
+    at = [base.bisect(oid) for oid in new_oids]
+    # new position of every position of base
+    remap = array("I")
+    prev = 0
+    for k, pos in enumerate(at):
+        remap.extend(range(prev + k, pos + k))
+        prev = pos
+    remap.extend(range(prev + len(at), len(base) + len(at)))
+    positions = {oid: k + pos for k, (oid, pos) in enumerate(zip(new_oids, at))}
+
+    def locate(oid: bytes) -> int:
+        pos = positions.get(oid)
+        return remap[base.position(oid)] if pos is None else pos
+
+    # (position in base, whether it replaces that row, oid), in the order of the rows
+    rows = sorted(
+        [(pos, 0, oid) for oid, pos in zip(new_oids, at)]
+        + [(pos, 1, base.oid(pos)) for pos in updates]
+    )
+    rows.append((len(base), 0, None))
+
+    oids = []
+    types = array("B")
+    sizes = array("Q")
+    link_start = array("Q", [0])
+    links = array("I")
+    prev = 0
+    for pos, replace, oid in rows:
+        # rows of base up to pos as they are
+        start = base.link_start[prev]
+        shift = len(links) - start
+        oids.append(base.oids[prev * 20 : pos * 20])
+        types += base.types[prev:pos]
+        sizes += base.sizes[prev:pos]
+        links.extend(map(remap.__getitem__, base.links[start : base.link_start[pos]]))
+        link_start.extend(map(shift.__add__, base.link_start[prev + 1 : pos + 1]))
+        if oid is None:
+            break
+        obj_type, size, children = updates[pos] if replace else inserts[oid]
+        oids.append(oid)
+        types.append(obj_type)
+        sizes.append(size)
+        links.extend(locate(c) for c, _ in children)
+        link_start.append(len(links))
+        prev = pos + replace
+    return CommitGraph(b"".join(oids), types, sizes, link_start, links)
+
+
+def shift_bitmap(bitmap: int, length: int, at: list[int]) -> int:
+    """
+    Moves the bits of a bitmap of a graph with length objects to where they are once
+    objects are inserted at the given positions, see merge
+    """
+    # as a string of binary digits, the lowest bit first, where it's quick to insert
+    bits = format(bitmap, f"0{length}b")[::-1]
+    parts = []
+    prev = 0
+    for pos in at:
+        parts.append(bits[prev:pos])
+        parts.append("0")
+        prev = pos
+    parts.append(bits[prev:])
+    return int("".join(parts)[::-1], 2)
+
+
+async def save(
+    repo: str, graph: CommitGraph, db, base: CommitGraph | None = None
+) -> None:
+    """
+    Stores the graph of a remote. If it has the same objects as base, the graph that
+    was loaded before the ingest, only the shallow boundary and the bitmaps of new tips
+    are written.
+    """
+    shallow = b"".join(sorted(graph.shallow))
+    async with db.transaction():
+        if base is not None and graph.same_objects(base):
+            await db.execute(
+                "UPDATE graphs SET shallow = $2, updated = now() WHERE remote = $1;",
+                repo,
+                shallow,
+            )
+            await db.execute(
+                "DELETE FROM graph_bitmaps WHERE remote = $1 AND oid != all($2::bytea[]);",
+                repo,
+                list(graph.bitmaps),
+            )
+            new = [oid for oid in graph.bitmaps if oid not in base.bitmaps]
+        else:
+            await db.execute(
+                """
+                INSERT INTO graphs (remote, graph, shallow) VALUES ($1, $2, $3)
+                ON CONFLICT (remote) DO UPDATE SET graph = $2, shallow = $3, updated = now();
+                """,
+                repo,
+                graph.dumps(),
+                shallow,
+            )
+            await db.execute("DELETE FROM graph_bitmaps WHERE remote = $1;", repo)
+            new = list(graph.bitmaps)
+        await db.executemany(
+            """
+            INSERT INTO graph_bitmaps (remote, oid, bitmap) VALUES ($1, $2, $3)
+            ON CONFLICT (remote, oid) DO UPDATE SET bitmap = $3;
+            """,
+            [(repo, oid, graph.dump_bitmap(graph.bitmaps[oid])) for oid in new],
+        )
+    await events.notify("graph", repo, db)
+
+
+def split_oids(data: bytes) -> set[bytes]:
+    return {bytes(data[i : i + 20]) for i in range(0, len(data), 20)}
+
+
+async def load(repo: str, db) -> CommitGraph | None:
+    graph = cache.get((repo,))
+    if graph is not None:
+        return graph
+    generation = cache.generation
+    # one statement, so the bitmaps match the object table
+    res = await db.fetchrow(
+        """
+        SELECT graph, shallow,
+            array(SELECT oid FROM graph_bitmaps WHERE remote = $1 ORDER BY oid) AS tips,
+            array(SELECT bitmap FROM graph_bitmaps WHERE remote = $1 ORDER BY oid)
+                AS bitmaps
+        FROM graphs WHERE remote = $1;
+        """,
+        repo,
+    )
+    if res is None:
+        return None
+    graph = CommitGraph.loads(res["graph"])
+    if graph is None:
+        # e.g. pickled by an older version, rebuilt by the next ingest of the remote
+        warning("Ignoring the graph of %s in an unknown format", repo)
+        return None
+    graph.shallow = split_oids(res["shallow"])
+    for oid, data in zip(res["tips"], res["bitmaps"]):
+        graph.bitmaps[bytes(oid)] = graph.load_bitmap(data)
+    size = len(res["graph"]) + len(graph.bitmaps) * len(graph) // 8
+    cache.put((repo,), graph, size, generation)
+    return graph
+
+
+async def load_shallow(repo: str, db) -> set[bytes] | None:
+    """Gets only the shallow boundary of a remote, None if it has no graph yet"""
+    res = await db.fetchrow("SELECT shallow FROM graphs WHERE remote = $1;", repo)
+    return None if res is None else split_oids(res["shallow"])
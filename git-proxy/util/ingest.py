@@ -0,0 +1,746 @@
+import asyncio
+import json
+import mmap
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from logging import debug, info, warning, error
+
+import asyncpg
+import requests as r
+
+from . import (
+    dumb,
+    events,
+    eviction,
+    forks,
+    graph,
+    metrics,
+    pack_store,
+    packfile,
+    refs,
+    remote,
+)
+from .config import (
+    DATABASE_URL,
+    GRAPH_BITMAPS,
+    INGEST_CACHE_BYTES,
+    INGEST_MAX_ATTEMPTS,
+    INGEST_MEMORY_BUDGET,
+    INGEST_POLL_INTERVAL,
+    INGEST_STALE_AFTER,
+    INGEST_WAIT_TIMEOUT,
+    INGEST_WORKERS,
+    LOG_LEVEL,
+    PACK_SPOOL_DIR,
+    REF_EXCLUDE,
+    REF_INCLUDE,
+    STREAM_CHUNK_SIZE,
+    UPSTREAM_FILTER,
+)
+from .db import connection
+
+# Upstream fetches run as jobs in the ingest_jobs table instead of inside the HTTP
+# request. A request for an uncached remote enqueues a job and waits for it, while
+# a limited number of workers pick jobs up, retry them on failure and resume jobs
+# that were left running by a crashed worker.
+#
+# Packs are spooled to disk and extracted from an mmap, so what an ingest takes up on the
+# heap is mostly per object and the delta bases it keeps. Ingests reserve an estimate of
+# that from the MemoryBudget before extracting, which all processes share through the
+# ingest_memory table.
+
+proxies = {
+    # "http": "http://host.docker.internal:8080",
+    # "https": "http://host.docker.internal:8080"
+}
+
+JOB_TABLE = """
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        remote text primary key,
+        status text not null,
+        attempts int not null default 0,
+        progress text,
+        error text,
+        headers text not null,
+        updated timestamptz not null default now()
+    );
+    ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS depth int;
+    ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS head text;
+    ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS prefixes text[];
+    ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS dumb boolean not null default false;
+    -- jobs that were queued with pickled refs
+    ALTER TABLE ingest_jobs DROP COLUMN IF EXISTS ref_blob;
+    DELETE FROM ingest_jobs WHERE prefixes IS NULL;
+    CREATE TABLE IF NOT EXISTS ingest_job_refs (
+        remote text not null,
+        refname text not null,
+        oid char(40) not null,
+        peeled char(40),
+        PRIMARY KEY (remote, refname)
+    );
+    CREATE TABLE IF NOT EXISTS ingest_memory (
+        id serial primary key,
+        pid int not null,
+        bytes bigint not null
+    );
+"""
+
+
+# Depth git asks for to fetch the complete history of a shallow repository
+INFINITE_DEPTH = 0x7FFFFFFF
+
+# Connections of the background pool besides the ones of the ingest workers, for the
+# storage collector, the warm-up scheduler and pack maintenance
+BACKGROUND_CONNECTIONS = 4
+
+# Rough memory taken up per object of a pack while it is extracted, by the scan arrays
+# and the reachability index being built
+OBJECT_OVERHEAD = 256
+# Delta bases kept by an ingest even when the memory budget is short
+MIN_CACHE_BYTES = 16 * 1024**2
+
+# Serializes reservations from the memory budget
+MEMORY_LOCK_ID = 0x6D656D6F
+
+
+class IngestError(Exception):
+    pass
+
+
+class AuthRequired(IngestError):
+    """Upstream wants credentials, the response is forwarded to make git ask for them"""
+
+    def __init__(self, response: r.Response):
+        super().__init__(f"Upstream returned {response.status_code}")
+        self.response = response
+
+
+class MemoryBudget:
+    """
+    Memory that the ingests of all processes may take up together, see
+    INGEST_MEMORY_BUDGET. Reservations are rows of ingest_memory with the backend pid
+    of the connection that took them, so the ones of a process that died are dropped
+    along with its connection.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+
+    async def take(self, minimum: int, wanted: int, db) -> tuple[int, int]:
+        """
+        Waits until at least minimum bytes are free, then takes up to wanted bytes
+
+        :returns: tuple(id of the reservation, number of bytes reserved)
+        """
+        while True:
+            async with db.transaction():
+                await db.execute("SELECT pg_advisory_xact_lock($1);", MEMORY_LOCK_ID)
+                await db.execute(
+                    """
+                    DELETE FROM ingest_memory
+                    WHERE pid NOT IN (SELECT pid FROM pg_stat_activity);
+                    """
+                )
+                used = await db.fetchval(
+                    "SELECT coalesce(sum(bytes), 0) FROM ingest_memory;"
+                )
+                if self.total - used >= minimum:
+                    granted = max(minimum, min(wanted, self.total - used))
+                    id = await db.fetchval(
+                        """
+                        INSERT INTO ingest_memory (pid, bytes)
+                        VALUES (pg_backend_pid(), $1) RETURNING id;
+                        """,
+                        granted,
+                    )
+                    return id, granted
+            # woken up when another ingest is done with its memory
+            await events.wait("memory", None, INGEST_POLL_INTERVAL)
+
+    @asynccontextmanager
+    async def reserve(self, minimum: int, wanted: int, db):
+        """
+        Waits until at least minimum bytes are free, then takes up to wanted bytes
+
+        :returns: context manager giving the number of bytes reserved
+        """
+        if not self.total:
+            yield wanted
+            return
+        # an ingest that is larger than the whole budget runs on its own
+        minimum = min(minimum, self.total)
+        async with connection(db) as conn:
+            with metrics.timer("admission"):
+                id, granted = await self.take(minimum, wanted, conn)
+            try:
+                yield granted
+            finally:
+                await conn.execute("DELETE FROM ingest_memory WHERE id = $1;", id)
+                await events.notify("memory", "", conn)
+
+
+memory = MemoryBudget(INGEST_MEMORY_BUDGET)
+
+
+@asynccontextmanager
+async def admitted(pf: bytes, db):
+    """
+    Reserves the memory extracting a pack takes up, estimated from the object count in
+    its header and its size
+
+    :returns: context manager giving the bytes that delta bases may take up
+    """
+    num_obj = int.from_bytes(pf[8:12], byteorder="big")
+    fixed = num_obj * OBJECT_OVERHEAD
+    # objects are several times larger inflated than in the pack
+    cache = min(INGEST_CACHE_BYTES, 4 * len(pf))
+    least = min(cache, MIN_CACHE_BYTES)
+    if memory.total and fixed + least > memory.total:
+        warning(
+            "Extracting %d objects takes about %d bytes, more than INGEST_MEMORY_BUDGET."
+            " Running it once nothing else is extracted.",
+            num_obj,
+            fixed + least,
+        )
+    async with memory.reserve(fixed + least, fixed + cache, db) as granted:
+        cache_bytes = max(granted - fixed, least)
+        if cache_bytes < cache:
+            info("Memory budget is short, keeping %d bytes of bases", cache_bytes)
+        yield cache_bytes
+
+
+def upstream_headers(repo_base_url: str, headers: dict) -> dict:
+    github_headers = headers.copy()
+    github_headers["git-protocol"] = "version=2"
+    github_headers["host"] = urlparse(repo_base_url).netloc
+    return github_headers
+
+
+def ls_refs(
+    repo_base_url: str, headers: dict, prefixes: list[bytes] = refs.DEFAULT_PREFIXES
+) -> r.Response:
+    """Asks upstream for its refs. The caller has to check for a 401 response."""
+    out = remote.command_request("ls-refs")
+    out.lines(["peel\n", "symrefs\n", "unborn\n"])
+    out.lines(b"ref-prefix " + prefix + b"\n" for prefix in prefixes)
+    out.flush_pkt()
+    payload = out.getvalue()
+
+    with metrics.timer("upstream_refs"):
+        response = r.request(
+            "POST",
+            f"{repo_base_url}/git-upload-pack",
+            headers=upstream_headers(repo_base_url, headers),
+            data=payload,
+            proxies=proxies,
+            verify=False,
+        )
+    metrics.inc("gitmitm_upstream_bytes_total", len(response.content))
+    return response
+
+
+def list_refs(
+    repo_base_url: str, headers: dict, prefixes: list[bytes] = refs.DEFAULT_PREFIXES
+) -> refs.Refs:
+    """
+    Gets the refs of upstream starting with one of the prefixes, leaving out what
+    REF_INCLUDE and REF_EXCLUDE say. Raises AuthRequired on a 401 response.
+    """
+    include = refs.patterns_for(repo_base_url, REF_INCLUDE)
+    exclude = refs.patterns_for(repo_base_url, REF_EXCLUDE)
+    response = ls_refs(repo_base_url, headers, refs.narrow_prefixes(prefixes, include))
+    if response.status_code == 401:
+        raise AuthRequired(response)
+
+    if (
+        response.status_code == 200
+        and response.headers.get("content-type") == "application/x-git-upload-pack-result"
+    ):
+        lines = remote.SmartPacket.parse_packet(response.content).lines
+        debug("Received %d refs via smart protocol", len(lines))
+        ref_list = refs.Refs.from_smart_bytes(lines)
+    else:
+        # Upstream only serves dumb HTTP, e.g. a static mirror
+        ref_list = list_dumb_refs(repo_base_url, headers).matching(prefixes)
+    ref_list = ref_list.select(include, exclude)
+    ref_list.prefixes = tuple(prefixes)
+    return ref_list
+
+
+def list_dumb_refs(repo_base_url: str, headers: dict) -> refs.Refs:
+    upstream = dumb.DumbRemote(repo_base_url, headers)
+    try:
+        response = upstream.get("info/refs")
+        if response.status_code == 401:
+            raise AuthRequired(response)
+        if response.status_code != 200:
+            raise IngestError(f"Upstream returned {response.status_code}")
+        head = upstream.get("HEAD")
+    finally:
+        upstream.close()
+    ref_list = refs.Refs.from_dumb_bytes(
+        response.content, head.content if head.status_code == 200 else None
+    )
+    debug("Received %d refs via dumb protocol", len(ref_list.refs))
+    ref_list.dumb = True
+    return ref_list
+
+
+def counted(chunks):
+    for chunk in chunks:
+        metrics.inc("gitmitm_upstream_bytes_total", len(chunk))
+        yield chunk
+
+
+def download_pack(repo_base_url: str, payload: bytes, headers: dict):
+    """
+    Sends a fetch command to upstream and spools the pack into a temporary file
+
+    :returns: tuple(open file containing only the packfile, shallow commits, commits
+        that are no longer shallow), the commits as binary object ids
+    """
+    debug("Sending upload-pack request")
+    response = r.request(
+        "POST",
+        f"{repo_base_url}/git-upload-pack",
+        headers=upstream_headers(repo_base_url, headers),
+        data=payload,
+        stream=True,
+    )
+    if response.status_code != 200:
+        raise IngestError(f"Upstream returned {response.status_code}")
+
+    spool = tempfile.TemporaryFile(dir=PACK_SPOOL_DIR)
+    shallow = []
+    unshallow = []
+    in_pack = False
+    try:
+        chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        for line in remote.iter_lines(counted(chunks)):
+            if not in_pack:
+                # sections before the pack, only shallow-info is of interest
+                if line == b"packfile\n":
+                    in_pack = True
+                elif line.startswith(b"shallow "):
+                    shallow.append(bytes.fromhex(line[8:48].decode()))
+                elif line.startswith(b"unshallow "):
+                    unshallow.append(bytes.fromhex(line[10:50].decode()))
+                elif line.startswith(b"ERR "):
+                    raise IngestError(f"Upstream error: {line[4:].strip()}")
+                continue
+            # sideband 1 is pack data, 2 is progress and 3 is a fatal error
+            match line[0]:
+                case 1:
+                    spool.write(line[1:])
+                case 2:
+                    debug("Upstream: %s", line[1:].strip())
+                case 3:
+                    raise IngestError(f"Upstream error: {line[1:].strip()}")
+    except:
+        spool.close()
+        raise
+    finally:
+        response.close()
+
+    debug("Done downloading file")
+    spool.flush()
+    if spool.tell() == 0:
+        spool.close()
+        raise IngestError("Upstream sent no pack")
+    return spool, shallow, unshallow
+
+
+def bitmap_tips(ref_list: refs.Refs) -> list[bytes]:
+    """Gets the tips that get a bitmap, HEAD first and then the branches"""
+    names = [b"HEAD", ref_list.HEAD]
+    names.extend(sorted(ref for ref in ref_list.refs if ref.startswith(b"refs/heads/")))
+    tips = []
+    for name in names:
+        hash = ref_list.refs.get(name)
+        if hash is None:
+            continue
+        oid = bytes.fromhex(hash.decode())
+        if oid not in tips:
+            tips.append(oid)
+    return tips[:GRAPH_BITMAPS]
+
+
+async def ingest(
+    repo_base_url: str, ref_list: refs.Refs, headers: dict, db, depth: int | None = None
+) -> None:
+    """
+    Downloads the pack of a remote and stores all of its objects.
+    If the remote was fetched before, only what is new or beyond its shallow boundary
+    is downloaded.
+
+    :param depth: Number of commits of history to fetch, None for all of it
+    """
+
+    async def progress(i: int, num_obj: int):
+        await db.execute(
+            "UPDATE ingest_jobs SET progress = $2, updated = now() WHERE remote = $1;",
+            repo_base_url,
+            f"{i}/{num_obj}",
+        )
+
+    # Objects that were ingested before stay in the reachability index
+    base = await graph.load(repo_base_url, db)
+    builder = graph.GraphBuilder(base)
+
+    haves = []
+    shallow = []
+    if base is not None:
+        for hash in set(ref_list.refs.values()):
+            pos = base.position(bytes.fromhex(hash.decode()))
+            if pos is not None and base.sizes[pos] != graph.UNKNOWN_SIZE:
+                haves.append(hash)
+        shallow = [oid.hex().encode() for oid in sorted(base.shallow)]
+    if base is not None and not shallow:
+        # the full history is already there, only new commits are missing
+        depth = None
+    elif depth is None and shallow:
+        # git's way of asking for the rest of the history
+        depth = INFINITE_DEPTH
+
+    wants = sorted(set(ref_list.refs.values()))
+    # Shared history of forks is already stored, see util.forks
+    related_haves, related = await forks.related_haves(repo_base_url, wants, db)
+    haves.extend(hash for hash in related_haves if hash not in haves)
+
+    if base is not None and (depth is None or depth == INFINITE_DEPTH):
+        # Tips behind another tip come along anyway. With a depth they don't, as
+        # the depth counts from each want.
+        oids = [bytes.fromhex(hash.decode()) for hash in wants]
+        wants = [oid.hex().encode() for oid in base.independent(oids)]
+        debug("Sending %d wants for %d refs", len(wants), len(ref_list.refs))
+
+    if ref_list.dumb:
+        # Dumb upstreams are walked down to the root commits, there is no depth
+        tips = [bytes.fromhex(hash.decode()) for hash in set(ref_list.refs.values())]
+        complete = [g for g in (base, *related) if g is not None and not g.shallow]
+
+        async def extract_into_graph(spool):
+            await extract(spool, db, repo_base_url, progress=progress, graph=builder)
+
+        await dumb.fetch(
+            repo_base_url,
+            tips,
+            headers,
+            db,
+            builder,
+            complete,
+            extract_into_graph,
+            progress,
+        )
+        builder.update_shallow([], list(builder.shallow))
+    else:
+        payload = ref_list.export_smart_request(
+            UPSTREAM_FILTER, depth, shallow, haves, wants
+        )
+        # requests is blocking, so keep the download off the event loop
+        with metrics.timer("upstream_fetch"):
+            spool, new_shallow, unshallow = await asyncio.to_thread(
+                download_pack, repo_base_url, payload, headers
+            )
+        builder.update_shallow(new_shallow, unshallow)
+        if new_shallow or unshallow:
+            info(
+                "Shallow boundary of %s: %d commits", repo_base_url, len(builder.shallow)
+            )
+        await extract(spool, db, repo_base_url, progress=progress, graph=builder)
+
+    with metrics.timer("graph"):
+        tips = [bytes.fromhex(oid.decode()) for oid in set(ref_list.refs.values())]
+        for other in related:
+            added = await asyncio.to_thread(builder.fill_from, other, tips)
+            metrics.inc("gitmitm_related_objects_total", added)
+            if added:
+                info("Took %d objects from a related remote", added)
+        index = await asyncio.to_thread(builder.build, bitmap_tips(ref_list))
+    info("Built reachability index %s", index)
+    await graph.save(repo_base_url, index, db, base)
+    await forks.save_roots(repo_base_url, index, db)
+    await eviction.record_size(repo_base_url, index, db)
+
+    await refs.save(repo_base_url, ref_list, db)
+
+
+async def extract(
+    spool, db, repo_base_url: str | None = None, **kwargs
+) -> packfile.PackScan:
+    """
+    Extracts a spooled pack into the objects table within the memory budget, see
+    packfile.read_packfile for the arguments
+
+    :param repo_base_url: Remote the pack came from, to keep it in the pack store
+    :returns: the scan of the pack, with the hashes of its objects
+    """
+    # The pack is parsed straight from the page cache instead of the Python heap
+    with spool, mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as pf:
+            scan = packfile.PackScan()
+            async with admitted(pf, db) as cache_bytes:
+                info("Extracting packfile")
+                await packfile.read_packfile(
+                    pf,
+                    database=db,
+                    parse=False,
+                    scan=scan,
+                    cache_bytes=cache_bytes,
+                    **kwargs,
+                )
+            if repo_base_url is not None and pack_store.enabled():
+                await asyncio.to_thread(pack_store.add, repo_base_url, pf, scan)
+    return scan
+
+
+async def fetch_objects(repo_base_url: str, hashes: list[str], headers: dict, db) -> None:
+    """
+    Fetches single objects by id, e.g. blobs that were left out by UPSTREAM_FILTER.
+    Upstream has to allow wants of objects that aren't ref tips, as github does.
+    """
+    info("Fetching %d missing objects from %s", len(hashes), repo_base_url)
+    metrics.inc("gitmitm_lazy_fetch_objects_total", len(hashes))
+    out = remote.command_request("fetch")
+    out.lines(["ofs-delta\n", "no-progress\n"])
+    out.lines(f"want {hash}\n" for hash in hashes)
+    out.line("done\n")
+    out.flush_pkt()
+    payload = out.getvalue()
+    with metrics.timer("upstream_fetch"):
+        spool, _, _ = await asyncio.to_thread(
+            download_pack, repo_base_url, payload, headers
+        )
+    async with eviction.storing(db) as conn:
+        scan = await extract(spool, conn, repo_base_url)
+        # they aren't complete objects of the remote's reachability index
+        await eviction.add_objects(
+            repo_base_url,
+            [scan.hashes[i : i + 20].hex() for i in range(0, len(scan.hashes), 20)],
+            conn,
+        )
+
+
+async def enqueue(
+    repo_base_url: str, ref_list: refs.Refs, headers: dict, db, depth: int | None = None
+) -> None:
+    """
+    Adds a job for a remote, unless one is already queued or running
+
+    :param depth: Number of commits of history to fetch, None for all of it
+    """
+    # The refs are stored like util.refs stores them, in their own table
+    async with connection(db) as conn, conn.transaction():
+        queued = await conn.fetchval(
+            """
+            INSERT INTO ingest_jobs (remote, status, head, prefixes, dumb, headers, depth)
+            VALUES ($1, 'queued', $2, $3, $4, $5, $6)
+            ON CONFLICT (remote) DO UPDATE SET status = 'queued', attempts = 0,
+                progress = NULL, error = NULL, head = $2, prefixes = $3, dumb = $4,
+                headers = $5, depth = $6, updated = now()
+            WHERE ingest_jobs.status IN ('done', 'failed')
+            RETURNING remote;
+            """,
+            repo_base_url,
+            None if ref_list.HEAD is None else ref_list.HEAD.decode(),
+            [prefix.decode() for prefix in ref_list.prefixes],
+            ref_list.dumb,
+            json.dumps(headers),
+            depth,
+        )
+        if queued is None:
+            return
+        await conn.execute(
+            "DELETE FROM ingest_job_refs WHERE remote = $1;", repo_base_url
+        )
+        await conn.copy_records_to_table(
+            "ingest_job_refs",
+            records=refs.to_records(repo_base_url, ref_list),
+            columns=["remote", "refname", "oid", "peeled"],
+        )
+    await events.notify("queued", repo_base_url, db)
+
+
+async def wait_for(repo_base_url: str, db, progress=None) -> None:
+    """
+    Waits until the job of a remote is done. Raises IngestError if it failed or takes
+    longer than INGEST_WAIT_TIMEOUT.
+
+    :param db: Best the pool, so no connection is held while waiting
+    :param progress: Optional async callback, called with a progress message for the
+        client whenever the job makes progress, see upload_pack.fetch_response
+    """
+    last_progress = None
+    deadline = time.monotonic() + INGEST_WAIT_TIMEOUT
+    while True:
+        job = await db.fetchrow(
+            "SELECT status, progress, error FROM ingest_jobs WHERE remote = $1;",
+            repo_base_url,
+        )
+        if job is None:
+            raise IngestError(f"No ingest job for {repo_base_url}")
+        if job["status"] == "done":
+            if progress is not None:
+                await progress("Fetching from upstream: done.\n")
+            return
+        if job["status"] == "failed":
+            raise IngestError(job["error"])
+        if job["progress"] != last_progress:
+            info("Waiting on %s: %s (%s)", repo_base_url, job["status"], job["progress"])
+            last_progress = job["progress"]
+            if progress is not None:
+                await progress(
+                    f"Fetching from upstream: {job['progress'] or job['status']}\r"
+                )
+        if time.monotonic() >= deadline:
+            raise IngestError(f"Timed out waiting for {repo_base_url}")
+        # Woken up as soon as the job finishes, the timeout is for progress and for
+        # when the notification is missed
+        await events.wait("ingest", repo_base_url, INGEST_POLL_INTERVAL)
+
+
+async def claim_job(db):
+    return await db.fetchrow(
+        """
+        UPDATE ingest_jobs SET status = 'running', attempts = attempts + 1, updated = now()
+        WHERE remote = (
+            SELECT remote FROM ingest_jobs
+            WHERE status = 'queued'
+                OR (status = 'running' AND updated < now() - make_interval(secs => $1))
+            ORDER BY updated
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING remote, attempts, head, prefixes, dumb, headers, depth;
+        """,
+        INGEST_STALE_AFTER,
+    )
+
+
+async def heartbeat(repo_base_url: str, pool) -> None:
+    """
+    Keeps a running job from being taken over as stale while it makes no visible
+    progress, e.g. during a long download. Uses the pool, as the job's connection is
+    busy with the ingest.
+    """
+    while True:
+        await asyncio.sleep(INGEST_STALE_AFTER / 3)
+        await pool.execute(
+            "UPDATE ingest_jobs SET updated = now() WHERE remote = $1 AND status = 'running';",
+            repo_base_url,
+        )
+
+
+async def run_job(job, db, pool) -> None:
+    repo_base_url = job["remote"]
+    info("Ingesting %s (attempt %d)", repo_base_url, job["attempts"])
+    timings = metrics.start_timings()
+    beat = asyncio.create_task(heartbeat(repo_base_url, pool))
+    try:
+        rows = await db.fetch(
+            "SELECT refname, oid, peeled FROM ingest_job_refs WHERE remote = $1;",
+            repo_base_url,
+        )
+        async with eviction.storing(db):
+            await ingest(
+                repo_base_url,
+                refs.from_records(job, rows),
+                json.loads(job["headers"]),
+                db,
+                job["depth"],
+            )
+    except Exception as e:
+        error("Ingest of %s failed: %r", repo_base_url, e)
+        # Objects that were already inserted are kept, so a retry resumes cheaply
+        failed = job["attempts"] >= INGEST_MAX_ATTEMPTS
+        # Retries still need the client's credentials, a finished job doesn't
+        await db.execute(
+            """
+            UPDATE ingest_jobs SET status = $2, error = $3, updated = now(),
+                headers = CASE WHEN $2 = 'failed' THEN '{}' ELSE headers END
+            WHERE remote = $1;
+            """,
+            repo_base_url,
+            "failed" if failed else "queued",
+            repr(e),
+        )
+        await events.notify("ingest" if failed else "queued", repo_base_url, db)
+        return
+    finally:
+        beat.cancel()
+        await forks.release(db)
+        metrics.record_timings(timings)
+
+    await db.execute(
+        """
+        UPDATE ingest_jobs SET status = 'done', headers = '{}', updated = now()
+        WHERE remote = $1;
+        """,
+        repo_base_url,
+    )
+    # they are in remote_refs now
+    await db.execute("DELETE FROM ingest_job_refs WHERE remote = $1;", repo_base_url)
+    await events.notify("ingest", repo_base_url, db)
+    info("Finished ingesting %s", repo_base_url)
+
+
+async def worker(pool) -> None:
+    while True:
+        try:
+            async with pool.acquire() as db:
+                job = await claim_job(db)
+                if job is not None:
+                    await run_job(job, db, pool)
+                    continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning("Ingest worker error: %r", e)
+        await events.wait("queued", None, INGEST_POLL_INTERVAL)
+
+
+def start_workers(pool, count: int = INGEST_WORKERS) -> list[asyncio.Task]:
+    return [asyncio.create_task(worker(pool)) for _ in range(count)]
+
+
+async def create_pool(workers: int = INGEST_WORKERS):
+    """
+    Creates the pool of the ingest workers and other background tasks. It is kept apart
+    from the one requests use, so requests waiting for jobs can't take up every
+    connection the workers need to finish them.
+    """
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        init=metrics.instrument_connection,
+        min_size=1,
+        max_size=workers + BACKGROUND_CONNECTIONS,
+    )
+
+
+async def main():
+    """
+    Runs ingest workers, the storage collector, the warm-up scheduler and pack
+    maintenance in their own process, apart from the HTTP workers
+    """
+    import logging
+    from . import warmup
+    from .db import initialize
+
+    logging.basicConfig(level=LOG_LEVEL, format="%(levelname)s:\t%(message)s")
+
+    pool = await create_pool()
+    async with pool.acquire() as db:
+        await initialize(db)
+    await asyncio.gather(
+        *events.start_listener(),
+        *start_workers(pool),
+        *eviction.start_collector(pool),
+        *warmup.start_scheduler(pool),
+        *pack_store.start_maintenance(pool),
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
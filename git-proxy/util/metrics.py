@@ -0,0 +1,169 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from starlette.datastructures import MutableHeaders
+
+# Process wide counters and histograms, exposed on /metrics in the Prometheus text format.
+#
+# Time spent in each stage (upstream fetch, inflate, delta apply, ...) is added up per
+# request or ingest job in a context local dict. When the request or job finishes, the
+# totals are recorded in the gitmitm_stage_seconds histogram and, if enabled, sent to
+# the client in a Server-Timing header.
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+DESCRIPTIONS = {
+    "gitmitm_db_queries_total": "Database round trips",
+    "gitmitm_upstream_bytes_total": "Bytes received from upstream",
+    "gitmitm_cache_requests_total": "Cache lookups by cache and result (hit or miss)",
+    "gitmitm_lazy_fetch_objects_total": "Objects fetched by id after a filtered fetch",
+    "gitmitm_related_objects_total": "Objects of an ingest taken from a related remote",
+    "gitmitm_evicted_remotes_total": "Remotes evicted to stay within STORAGE_BUDGET",
+    "gitmitm_evicted_objects_total": "Objects deleted along with evicted remotes",
+    "gitmitm_warmed_remotes_total": "Fetches of WARM_REMOTES by the warm-up scheduler",
+    "gitmitm_repacked_packs_total": "Stored packs merged into larger ones",
+    "gitmitm_offloaded_packs_total": "Stored packs sent to clients as packfile-uris",
+    "gitmitm_db_query_seconds": "Database query latency by operation",
+    "gitmitm_stage_seconds": "Time spent per request or ingest job in each stage",
+    "gitmitm_request_seconds": "HTTP request duration by handler",
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Both are keyed by (name, labels), labels being a sorted tuple of (key, value)
+counters: dict[tuple, float] = defaultdict(float)
+histograms: dict[tuple, Histogram] = defaultdict(Histogram)
+
+_timings: ContextVar[dict | None] = ContextVar("timings", default=None)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    counters[name, tuple(sorted(labels.items()))] += value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    histograms[name, tuple(sorted(labels.items()))].observe(value)
+
+
+def start_timings() -> dict[str, float]:
+    """Starts collecting stage times for the current request or job"""
+    timings = defaultdict(float)
+    _timings.set(timings)
+    return timings
+
+
+def add_time(stage: str, seconds: float) -> None:
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] += seconds
+
+
+@contextmanager
+def timer(stage: str):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, perf_counter() - start)
+
+
+def record_timings(timings: dict[str, float]) -> None:
+    for stage, seconds in timings.items():
+        observe("gitmitm_stage_seconds", seconds, stage=stage)
+
+
+def server_timing(timings: dict[str, float], total: float) -> str:
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    families = defaultdict(list)
+    for (name, labels), value in counters.items():
+        families[name, "counter"].append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), hist in histograms.items():
+        lines = families[name, "histogram"]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), hist.buckets):
+            cumulative += count
+            lines.append(
+                f"{name}_bucket{format_labels(labels, (('le', bound),))} {cumulative}"
+            )
+        lines.append(f"{name}_sum{format_labels(labels)} {hist.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {hist.count}")
+
+    out = []
+    for (name, kind), lines in sorted(families.items()):
+        if name in DESCRIPTIONS:
+            out.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+def count_query(record) -> None:
+    inc("gitmitm_db_queries_total")
+    words = record.query.split(None, 1)
+    op = words[0].rstrip(";").lower() if words else "unknown"
+    observe("gitmitm_db_query_seconds", record.elapsed, op=op)
+    # asyncpg calls loggers with the context of the querying task
+    add_time("db", record.elapsed)
+
+
+async def instrument_connection(conn) -> None:
+    """Pool init hook, so every query on every pooled connection is counted"""
+    conn.add_query_logger(count_query)
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware that times every request and collects its stage times.
+    A plain ASGI middleware rather than BaseHTTPMiddleware so streamed responses pass
+    through untouched.
+    """
+
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = start_timings()
+        start = perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and self.server_timing:
+                headers = MutableHeaders(scope=message)
+                headers.append("server-timing", server_timing(timings, perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            handler = getattr(scope.get("endpoint"), "__name__", "unknown")
+            observe("gitmitm_request_seconds", perf_counter() - start, handler=handler)
+            record_timings(timings)
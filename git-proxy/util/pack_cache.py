@@ -0,0 +1,103 @@
+import hashlib
+import os
+import tempfile
+from logging import debug, info
+
+from .config import PACK_CACHE_DIR, PACK_CACHE_SIZE
+
+# Responses to fetch commands, kept on local disk so identical clones of the same tips,
+# e.g. from a fleet of CI machines, are served with sendfile instead of being generated
+# again. A response is keyed by the remote, the version of its refs and every argument
+# and capability of the request that changes what is sent. Least recently used
+# responses are deleted once the cache grows past PACK_CACHE_SIZE. Files are only
+# renamed into place when complete, so several processes can share the directory.
+
+# Capabilities that don't change the response
+IGNORED_CAPABILITIES = {"agent"}
+
+
+def enabled() -> bool:
+    return PACK_CACHE_SIZE > 0
+
+
+def cache_key(
+    repo: str, version: int | None, capabilities: dict[str, str], args: list[bytes]
+) -> str:
+    h = hashlib.sha256()
+    h.update(f"{repo}\n{version}\n".encode())
+    for key in sorted(capabilities.keys() - IGNORED_CAPABILITIES):
+        h.update(f"{key}={capabilities[key]}\n".encode())
+    h.update(b"\n".join(sorted(args)))
+    return h.hexdigest()
+
+
+def path_for(key: str) -> str:
+    return os.path.join(PACK_CACHE_DIR, key[:2], key[2:] + ".pack")
+
+
+def lookup(key: str) -> str | None:
+    """Gets the path of a cached response, None if there is none"""
+    path = path_for(key)
+    try:
+        # the modification time is what LRU order goes by
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+class Entry:
+    """A response that is being written to the cache while it is sent"""
+
+    def __init__(self, key: str):
+        self.key = key
+        os.makedirs(PACK_CACHE_DIR, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=PACK_CACHE_DIR, delete=False)
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+
+    def commit(self) -> None:
+        self.file.close()
+        dest = path_for(self.key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(self.file.name, dest)
+        debug("Cached pack %s", self.key)
+        prune()
+
+    def discard(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+            os.unlink(self.file.name)
+
+
+def prune(limit: int = PACK_CACHE_SIZE) -> None:
+    """Deletes the least recently used responses until the cache fits in limit bytes"""
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(PACK_CACHE_DIR):
+        for name in filenames:
+            if not name.endswith(".pack"):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= limit:
+        return
+
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    info("Removed %d cached packs, %d bytes left", removed, total)
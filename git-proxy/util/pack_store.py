@@ -0,0 +1,540 @@
+import asyncio
+import fcntl
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from logging import debug, info, warning
+
+from . import metrics
+from .config import PACK_STORE_DIR, REPACK_FACTOR, REPACK_INTERVAL
+from .packfile import (
+    TYPE_OFS_DELTA,
+    decode_size_type_encoding,
+    encode_offset,
+    get_offset_val,
+)
+
+# Upstream packs of each remote, kept on disk after they are extracted, in a directory
+# per remote laid out like .git/objects/pack: pack-<checksum>.pack, its version 2 .idx
+# and a multi-pack-index in git's format over all of them, so looking up an object takes
+# one binary search no matter how many packs there are. Every refresh adds a small pack,
+# so a maintenance task merges packs geometrically like git repack --geometric: packs
+# are sorted by object count and the small ones are rolled up until each pack has at
+# least REPACK_FACTOR times as many objects as all smaller ones together. Entries are
+# copied as they are, so deltas are reused and nothing is compressed again.
+#
+# Readers never wait for maintenance. New packs and multi-pack-indexes are written to
+# temporary files and renamed into place, and merged packs stay on disk for another
+# REPACK_INTERVAL after they are dropped from the multi-pack-index, so requests that
+# are still reading them aren't cut off. Writers of a directory take a file lock.
+
+IDX_SIGNATURE = b"\377tOc\0\0\0\2"
+MIDX_SIGNATURE = b"MIDX"
+MIDX_NAME = "multi-pack-index"
+
+# Only one maintenance task runs at a time, no matter how many processes there are
+LOCK_ID = 0x7061636B
+
+# Offsets from this on are kept in the large offset table of an index
+LARGE_OFFSET = 0x80000000
+
+
+def enabled() -> bool:
+    return PACK_STORE_DIR is not None
+
+
+def remote_dir(repo: str) -> str:
+    return os.path.join(PACK_STORE_DIR, hashlib.sha256(repo.encode()).hexdigest()[:32])
+
+
+@contextmanager
+def locked(directory: str):
+    with open(os.path.join(directory, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def find(data, start: int, lo: int, hi: int, oid: bytes) -> int | None:
+    """Binary search for oid in the sorted table of 20 byte ids at start"""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = start + mid * 20
+        current = data[pos : pos + 20]
+        if current == oid:
+            return mid
+        if current < oid:
+            lo = mid + 1
+        else:
+            hi = mid
+    return None
+
+
+def fanout_range(data, start: int, oid: bytes) -> tuple[int, int]:
+    """Gets the positions of the ids starting with the first byte of oid"""
+    (hi,) = struct.unpack_from(">I", data, start + oid[0] * 4)
+    lo = struct.unpack_from(">I", data, start + (oid[0] - 1) * 4)[0] if oid[0] else 0
+    return lo, hi
+
+
+def map_file(path: str) -> mmap.mmap:
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PackIndex:
+    """A version 2 .idx file"""
+
+    def __init__(self, path: str):
+        self.data = map_file(path)
+        if self.data[:8] != IDX_SIGNATURE:
+            raise ValueError(f"Unsupported pack index {path}")
+        (self.count,) = struct.unpack_from(">I", self.data, 8 + 255 * 4)
+        self.oids_at = 8 + 256 * 4
+        self.crcs_at = self.oids_at + self.count * 20
+        self.offsets_at = self.crcs_at + self.count * 4
+        self.large_at = self.offsets_at + self.count * 4
+
+    def __len__(self):
+        return self.count
+
+    def oid(self, i: int) -> bytes:
+        return self.data[self.oids_at + i * 20 : self.oids_at + i * 20 + 20]
+
+    def offset(self, i: int) -> int:
+        (offset,) = struct.unpack_from(">I", self.data, self.offsets_at + i * 4)
+        if offset & LARGE_OFFSET:
+            pos = self.large_at + (offset & ~LARGE_OFFSET) * 8
+            (offset,) = struct.unpack_from(">Q", self.data, pos)
+        return offset
+
+    def __iter__(self):
+        """Iterates over tuple(object id, offset) in object id order"""
+        for i in range(self.count):
+            yield self.oid(i), self.offset(i)
+
+    def __contains__(self, oid: bytes) -> bool:
+        lo, hi = fanout_range(self.data, 8, oid)
+        return find(self.data, self.oids_at, lo, hi, oid) is not None
+
+
+class MultiPackIndex:
+    """A multi-pack-index file, see gitformat-pack"""
+
+    def __init__(self, path: str):
+        self.data = map_file(path)
+        if self.data[:4] != MIDX_SIGNATURE or self.data[4:6] != b"\1\1":
+            raise ValueError(f"Unsupported multi-pack-index {path}")
+        num_chunks = self.data[6]
+        chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = struct.unpack_from(">4sQ", self.data, 12 + i * 12)
+            chunks[chunk_id] = offset
+        names = self.data[chunks[b"PNAM"] : chunks[b"OIDF"]].split(b"\0")
+        self.packs = [name.decode()[:-4] + ".pack" for name in names if name]
+        self.fanout_at = chunks[b"OIDF"]
+        self.oids_at = chunks[b"OIDL"]
+        self.offsets_at = chunks[b"OOFF"]
+        self.large_at = chunks.get(b"LOFF")
+        (self.count,) = struct.unpack_from(">I", self.data, self.fanout_at + 255 * 4)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, oid: bytes) -> bool:
+        return self.position(oid) is not None
+
+    def position(self, oid: bytes) -> int | None:
+        lo, hi = fanout_range(self.data, self.fanout_at, oid)
+        return find(self.data, self.oids_at, lo, hi, oid)
+
+    def locate(self, oid: bytes) -> tuple[str, int] | None:
+        """Gets the name of the pack holding an object and its offset in there"""
+        pos = self.position(oid)
+        if pos is None:
+            return None
+        pack, offset = struct.unpack_from(">II", self.data, self.offsets_at + pos * 8)
+        if offset & LARGE_OFFSET:
+            pos = self.large_at + (offset & ~LARGE_OFFSET) * 8
+            (offset,) = struct.unpack_from(">Q", self.data, pos)
+        return self.packs[pack], offset
+
+
+# path -> tuple(inode and modification time, MultiPackIndex) of the loaded indexes
+loaded: dict[str, tuple[tuple, MultiPackIndex]] = {}
+
+
+def load(repo: str) -> MultiPackIndex | None:
+    """Gets the multi-pack-index of a remote, None if it has no stored packs"""
+    path = os.path.join(remote_dir(repo), MIDX_NAME)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        loaded.pop(path, None)
+        return None
+    version = (stat.st_ino, stat.st_mtime_ns)
+    if path not in loaded or loaded[path][0] != version:
+        loaded[path] = (version, MultiPackIndex(path))
+    return loaded[path][1]
+
+
+def write_file(directory: str, name: str, parts) -> None:
+    """Writes a file from chunks of bytes and renames it into place"""
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="tmp-")
+    try:
+        # readable by the static file server, see PACKFILE_URI_BASE
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(tmp, os.path.join(directory, name))
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def index_parts(entries: list[tuple[bytes, int, int]], checksum: bytes):
+    """
+    Generates a version 2 .idx file
+
+    :param entries: tuple(object id, crc32 of the entry, offset) of every entry
+    :param checksum: trailer of the pack
+    """
+    entries.sort()
+    sha1 = hashlib.sha1()
+    fanout = [0] * 256
+    for oid, _, _ in entries:
+        fanout[oid[0]] += 1
+    offsets = bytearray()
+    large = bytearray()
+    for _, _, offset in entries:
+        if offset >= LARGE_OFFSET:
+            offsets += struct.pack(">I", LARGE_OFFSET | len(large) // 8)
+            large += struct.pack(">Q", offset)
+        else:
+            offsets += struct.pack(">I", offset)
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    for part in (
+        IDX_SIGNATURE + struct.pack(">256I", *fanout),
+        b"".join(oid for oid, _, _ in entries),
+        b"".join(struct.pack(">I", crc) for _, crc, _ in entries),
+        offsets,
+        large,
+        checksum,
+    ):
+        sha1.update(part)
+        yield part
+    yield sha1.digest()
+
+
+def add(repo: str, pf, scan) -> None:
+    """
+    Keeps a pack that was just extracted
+
+    :param pf: Packfile contents
+    :param scan: packfile.PackScan that read_packfile filled in while extracting it
+    """
+    if not len(scan):
+        return
+    end = scan.ends[-1]
+    checksum = bytes(pf[end : end + 20])
+    name = f"pack-{checksum.hex()}"
+    directory = remote_dir(repo)
+    os.makedirs(directory, exist_ok=True)
+
+    with locked(directory):
+        if not os.path.exists(os.path.join(directory, name + ".idx")):
+            entries = [
+                (
+                    bytes(scan.hashes[i * 20 : i * 20 + 20]),
+                    zlib.crc32(pf[scan.offsets[i] : scan.ends[i]]),
+                    scan.offsets[i],
+                )
+                for i in range(len(scan))
+            ]
+            write_file(directory, name + ".pack", [pf[: end + 20]])
+            write_file(directory, name + ".idx", index_parts(entries, checksum))
+        write_midx(directory)
+    info("Stored %s of %s (%d objects)", name, repo, len(scan))
+
+
+def pack_path(repo: str, name: str) -> str:
+    """Gets the path of a stored pack relative to PACK_STORE_DIR"""
+    return os.path.relpath(os.path.join(remote_dir(repo), name), PACK_STORE_DIR)
+
+
+def list_packs(directory: str) -> list[str]:
+    """Gets the names of the indexed packs, without an extension"""
+    return sorted(
+        name[:-4]
+        for name in os.listdir(directory)
+        if name.startswith("pack-") and name.endswith(".idx")
+    )
+
+
+def tagged(idx: PackIndex, pack: int):
+    for oid, offset in idx:
+        yield oid, pack, offset
+
+
+def write_midx(directory: str) -> None:
+    """Writes the multi-pack-index of the packs in a directory, holding its lock"""
+    names = list_packs(directory)
+    if not names:
+        try:
+            os.unlink(os.path.join(directory, MIDX_NAME))
+        except FileNotFoundError:
+            pass
+        return
+    indexes = [PackIndex(os.path.join(directory, name + ".idx")) for name in names]
+
+    fanout = [0] * 256
+    oids = bytearray()
+    offsets = bytearray()
+    large = bytearray()
+    last = None
+    # Objects that are in several packs are taken from the first one
+    merged = heapq.merge(*(tagged(idx, i) for i, idx in enumerate(indexes)))
+    for oid, pack, offset in merged:
+        if oid == last:
+            continue
+        last = oid
+        fanout[oid[0]] += 1
+        oids += oid
+        if offset >= LARGE_OFFSET:
+            large += struct.pack(">Q", offset)
+            offset = LARGE_OFFSET | (len(large) // 8 - 1)
+        offsets += struct.pack(">II", pack, offset)
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+
+    pnam = b"".join(name.encode() + b".idx\0" for name in names)
+    pnam += b"\0" * (-len(pnam) % 4)
+    chunks = [
+        (b"PNAM", pnam),
+        (b"OIDF", struct.pack(">256I", *fanout)),
+        (b"OIDL", oids),
+        (b"OOFF", offsets),
+    ]
+    if large:
+        chunks.append((b"LOFF", large))
+
+    header = MIDX_SIGNATURE + bytes([1, 1, len(chunks), 0])
+    header += struct.pack(">I", len(names))
+    position = len(header) + (len(chunks) + 1) * 12
+    for chunk_id, chunk in chunks:
+        header += struct.pack(">4sQ", chunk_id, position)
+        position += len(chunk)
+    header += struct.pack(">4sQ", b"\0\0\0\0", position)
+
+    sha1 = hashlib.sha1(header)
+    for _, chunk in chunks:
+        sha1.update(chunk)
+    parts = [header, *(chunk for _, chunk in chunks), sha1.digest()]
+    write_file(directory, MIDX_NAME, parts)
+
+
+def geometric_rollup(counts: dict[str, int], factor: int) -> list[str]:
+    """
+    Picks the packs to merge so the rest forms a geometric progression, as git repack
+    --geometric does
+
+    :param counts: pack name -> object count
+    """
+    packs = sorted(counts, key=counts.get)
+    split = 0
+    for i in range(len(packs) - 1, 0, -1):
+        if counts[packs[i]] < factor * counts[packs[i - 1]]:
+            split = i
+            break
+    rollup = packs[:split]
+    total = sum(counts[name] for name in rollup)
+    for name in packs[split:]:
+        # the merged pack has to keep its distance to the next larger one
+        if counts[name] >= factor * total:
+            break
+        rollup.append(name)
+        total += counts[name]
+    return rollup if len(rollup) > 1 else []
+
+
+def merge_parts(directory: str, names: list[str], written: dict, entries: list):
+    """
+    Generates a pack of all objects in the given packs, copying their entries. Offset
+    deltas are pointed at where their base ends up.
+
+    :param written: Empty dict, filled in with object id -> offset in the new pack
+    :param entries: Empty list, filled in for index_parts
+    """
+    indexes = [PackIndex(os.path.join(directory, name + ".idx")) for name in names]
+    count = len({oid for idx in indexes for oid, _ in idx})
+    sha1 = hashlib.sha1()
+    header = b"PACK\0\0\0\2" + struct.pack(">I", count)
+    sha1.update(header)
+    yield header
+    position = len(header)
+
+    for name, idx in zip(names, indexes):
+        pf = map_file(os.path.join(directory, name + ".pack"))
+        try:
+            by_offset = sorted((offset, oid) for oid, offset in idx)
+            oid_at = {offset: oid for offset, oid in by_offset}
+            ends = [offset for offset, _ in by_offset[1:]] + [len(pf) - 20]
+            for (offset, oid), end in zip(by_offset, ends):
+                if oid in written:
+                    continue
+                _, obj_type, data_at = decode_size_type_encoding(pf, offset)
+                if obj_type.value == TYPE_OFS_DELTA:
+                    relative, base_at = get_offset_val(pf, data_at)
+                    base = written[oid_at[offset - relative]]
+                    entry = pf[offset:data_at] + encode_offset(position - base)
+                    entry += pf[base_at:end]
+                else:
+                    entry = pf[offset:end]
+                written[oid] = position
+                entries.append((oid, zlib.crc32(entry), position))
+                sha1.update(entry)
+                yield entry
+                position += len(entry)
+        finally:
+            pf.close()
+    yield sha1.digest()
+
+
+def repack(directory: str) -> bool:
+    """
+    Merges the small packs of a remote, see geometric_rollup
+
+    :returns: whether anything was merged
+    """
+    names = list_packs(directory)
+    counts = {
+        name: len(PackIndex(os.path.join(directory, name + ".idx"))) for name in names
+    }
+    rollup = geometric_rollup(counts, REPACK_FACTOR)
+    if not rollup:
+        return False
+
+    # Merged into a temporary file without the lock, so ingests can add packs meanwhile
+    written = {}
+    entries = []
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="tmp-")
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            for part in merge_parts(directory, rollup, written, entries):
+                f.write(part)
+        # the last part is the trailer
+        checksum = part
+        name = f"pack-{checksum.hex()}"
+        with locked(directory):
+            if set(rollup) - set(list_packs(directory)):
+                debug("Packs of %s were dropped while merging", directory)
+                os.unlink(tmp)
+                return False
+            os.replace(tmp, os.path.join(directory, name + ".pack"))
+            write_file(directory, name + ".idx", index_parts(entries, checksum))
+            for old in rollup:
+                # kept for a while for readers that are still using it, see cleanup
+                os.unlink(os.path.join(directory, old + ".idx"))
+                os.utime(os.path.join(directory, old + ".pack"))
+            write_midx(directory)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    info(
+        "Merged %d packs of %s into %s (%d objects)",
+        len(rollup),
+        directory,
+        name,
+        len(written),
+    )
+    metrics.inc("gitmitm_repacked_packs_total", len(rollup))
+    return True
+
+
+def cleanup(directory: str, grace: float = REPACK_INTERVAL) -> None:
+    """Deletes merged packs and left over temporary files older than grace seconds"""
+    indexed = set(list_packs(directory))
+    cutoff = time.time() - grace
+    for name in os.listdir(directory):
+        stem = name.rsplit(".", 1)[0]
+        stale = name.startswith("tmp-") or (
+            name.startswith("pack-") and name.endswith(".pack") and stem not in indexed
+        )
+        if not stale:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                debug("Deleted %s", path)
+        except FileNotFoundError:
+            pass
+
+
+def delete(repo: str) -> None:
+    """Drops the stored packs of a remote, e.g. when it is evicted"""
+    directory = remote_dir(repo)
+    if not os.path.isdir(directory):
+        return
+    with locked(directory):
+        for name in list_packs(directory):
+            os.unlink(os.path.join(directory, name + ".idx"))
+            os.utime(os.path.join(directory, name + ".pack"))
+        write_midx(directory)
+
+
+def maintain_all() -> None:
+    if not os.path.isdir(PACK_STORE_DIR):
+        return
+    for name in os.listdir(PACK_STORE_DIR):
+        directory = os.path.join(PACK_STORE_DIR, name)
+        if not os.path.isdir(directory):
+            continue
+        try:
+            repack(directory)
+            cleanup(directory)
+        except Exception as e:
+            warning("Could not repack %s: %r", directory, e)
+
+
+async def maintenance(pool) -> None:
+    while True:
+        await asyncio.sleep(REPACK_INTERVAL)
+        try:
+            async with pool.acquire() as db:
+                if not await db.fetchval("SELECT pg_try_advisory_lock($1);", LOCK_ID):
+                    debug("Another pack maintenance task is running")
+                    continue
+                try:
+                    await asyncio.to_thread(maintain_all)
+                finally:
+                    await db.execute("SELECT pg_advisory_unlock($1);", LOCK_ID)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning("Pack maintenance error: %r", e)
+
+
+def start_maintenance(pool) -> list[asyncio.Task]:
+    """Starts the maintenance task, if there is a PACK_STORE_DIR"""
+    if not enabled():
+        return []
+    return [asyncio.create_task(maintenance(pool))]
@@ -1,13 +1,21 @@
 import zlib
+import hashlib
+from array import array
+from bisect import bisect_left
 from enum import Enum
-from functools import lru_cache, wraps
+from collections import OrderedDict
+from functools import wraps
 import struct
+import logging
 from logging import debug, info
+from time import perf_counter
 
 if __name__ == "__main__":  # allows running the file directly for testing
-    import objects
+    import objects, metrics
+    from config import PROGRESS_INTERVAL
 else:
-    from . import objects, db
+    from . import codec, objects, db, metrics
+    from .config import PROGRESS_INTERVAL
 
 
 class OBJ_TYPE(Enum):
@@ -101,6 +109,17 @@ def get_offset_val(packfile: bytes, idx=0) -> tuple[int, int]:
     return num, num_bytes + idx
 
 
+def encode_offset(num: int) -> bytes:
+    """Encodes the base offset of an offset delta, the reverse of get_offset_val"""
+    res = bytearray([num & 0b0111_1111])
+    num >>= 7
+    while num:
+        num -= 1
+        res.insert(0, 0b1000_0000 | (num & 0b0111_1111))
+        num >>= 7
+    return bytes(res)
+
+
 def smart_decompress(pf: bytes, idx=0, max_length=250) -> tuple[bytes, int]:
     """
     Provided some bytes, extracts the bytes using zlib,
@@ -109,7 +128,7 @@ def smart_decompress(pf: bytes, idx=0, max_length=250) -> tuple[bytes, int]:
     :returns: tuple(object, length of consumed bytes)
 
     """
-    debug("Idx %d Length %d", idx, len(pf))
+    start = perf_counter()
     d = zlib.decompressobj()
     res = b""
     while not d.eof:
@@ -117,9 +136,6 @@ def smart_decompress(pf: bytes, idx=0, max_length=250) -> tuple[bytes, int]:
         idx += max_length
 
     idx = min(idx, len(pf))
-    debug("Finished decompressing")
-    debug(idx)
-    debug(len(d.unused_data))
     # if max_length is None:
     #     res = d.decompress(cut)
     # else:
@@ -130,6 +146,7 @@ def smart_decompress(pf: bytes, idx=0, max_length=250) -> tuple[bytes, int]:
     #     debug("EOF")
     if not d.eof:
         raise ValueError("Incomplete decompression object given")
+    metrics.add_time("inflate", perf_counter() - start)
 
     # print(res)
 
@@ -147,50 +164,111 @@ def read_delta(delta: bytes, base_content: bytes) -> bytes:
     :returns: new object
     """
 
+    start = perf_counter()
     base_object_size, bytes_used = decode_size_encoding(delta)
     reconstructed_object_size, bytes_used = decode_size_encoding(delta, idx=bytes_used)
-    new_object = b""
-    debug(f"Base size: {reconstructed_object_size}, delta: {delta}")
+    # copies from the base go through a memoryview so they aren't sliced twice
+    base = memoryview(base_content)
+    new_object = bytearray()
+    delta_len = len(delta)
 
-    while len(new_object) < reconstructed_object_size:
+    while bytes_used < delta_len:
         bitmap = delta[bytes_used]
+        bytes_used += 1
         if bitmap & 0b1000_0000:
-            # copy from base instruction
-
+            # copy from base instruction, bits 0-3 select offset bytes and 4-6 size bytes
             offset = 0
             size = 0
-
-            for i in range(0, 4):
-                if bitmap & (0b1 << i):
-                    bytes_used += 1
-                    offset += delta[bytes_used] << (i * 8)
-            for i in range(4, 7):
-                if bitmap & (0b1 << i):
-                    bytes_used += 1
-                    size += delta[bytes_used] << ((i - 4) * 8)
+            if bitmap & 0b0000_0001:
+                offset = delta[bytes_used]
+                bytes_used += 1
+            if bitmap & 0b0000_0010:
+                offset |= delta[bytes_used] << 8
+                bytes_used += 1
+            if bitmap & 0b0000_0100:
+                offset |= delta[bytes_used] << 16
+                bytes_used += 1
+            if bitmap & 0b0000_1000:
+                offset |= delta[bytes_used] << 24
+                bytes_used += 1
+            if bitmap & 0b0001_0000:
+                size = delta[bytes_used]
+                bytes_used += 1
+            if bitmap & 0b0010_0000:
+                size |= delta[bytes_used] << 8
+                bytes_used += 1
+            if bitmap & 0b0100_0000:
+                size |= delta[bytes_used] << 16
+                bytes_used += 1
 
             if size == 0:
                 size = 0x10000
 
-            new_object += base_content[offset : offset + size]
-            bytes_used += 1
+            new_object += base[offset : offset + size]
         else:
+            # insert instruction, the bitmap is the number of literal bytes
             assert bitmap != 0
-            size = bitmap & 0b0111_1111
-            new_object += delta[bytes_used + 1 : bytes_used + 1 + size]
-            bytes_used += size + 1
+            new_object += delta[bytes_used : bytes_used + bitmap]
+            bytes_used += bitmap
+
+    if len(new_object) != reconstructed_object_size:
+        raise ValueError("Delta produced an object of the wrong size")
 
-    return new_object
+    metrics.add_time("delta", perf_counter() - start)
+    return bytes(new_object)
 
 
-# Caching to allow for efficient delta entry extraction
-@lru_cache(maxsize=500_000)
-def extract_entry(pf: bytes, idx=0) -> tuple[bytes, OBJ_TYPE, int]:
+class EntryCache(OrderedDict):
+    """
+    LRU cache of extracted entries of one packfile, keyed by byte index.
+    Allows for efficient delta entry extraction. Kept per packfile instead of an
+    lru_cache on extract_entry, since the packfile may be an (unhashable) memoryview
+    of an mmap that has to be closed afterwards.
+
+    :param maxbytes: Optional limit on the summed size of the cached data. Entries that
+        were dropped are inflated again from the packfile when needed.
+    """
+
+    def __init__(self, maxsize=500_000, maxbytes: int | None = None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.bytes = 0
+
+    def get(self, idx):
+        res = super().get(idx)
+        if res is not None:
+            self.move_to_end(idx)
+        return res
+
+    def put(self, idx, entry):
+        old = super().get(idx)
+        if old is not None:
+            self.bytes -= len(old[0])
+        self[idx] = entry
+        self.bytes += len(entry[0])
+        while len(self) > self.maxsize or (
+            self.maxbytes is not None and self.bytes > self.maxbytes and len(self) > 1
+        ):
+            _, dropped = self.popitem(last=False)
+            self.bytes -= len(dropped[0])
+
+
+def extract_entry(pf: bytes, idx=0, cache: EntryCache = None) -> tuple[bytes, OBJ_TYPE, int]:
     """
     Extracts an entry in a packfile given the byte index
 
+    :param pf: Packfile contents, bytes or anything supporting the buffer protocol (e.g. a memoryview of an mmap)
+    :param cache: Optional cache of already extracted entries of this packfile
+
     :returns: tuple(decompressed object, type, index of next entry)
     """
+    start = idx
+    if cache is not None:
+        res = cache.get(start)
+        if res is not None:
+            return res
+
     l, type_num, new_idx = decode_size_type_encoding(pf, idx=idx)
     if type_num not in OBJ_TYPE.TYPE_DELTA:
         ex_obj, idx = smart_decompress(pf, idx=new_idx)
@@ -202,23 +280,30 @@ def extract_entry(pf: bytes, idx=0) -> tuple[bytes, OBJ_TYPE, int]:
     else:
         if type_num == OBJ_TYPE.OBJ_REF_DELTA.value:
             raise NotImplementedError("Ref deltas are not yet implemented")
-        debug(f"Extracting delta size {l}")
         # print(pf[idx:idx+100])
-        ex_obj, type_num, idx = extract_delta_ofs(pf, idx=new_idx, base_idx=idx)
+        ex_obj, type_num, idx = extract_delta_ofs(
+            pf, idx=new_idx, base_idx=idx, cache=cache
+        )
         # print(contents[:200])
         # print(l)
         # print(type_num)
-    return ex_obj, OBJ_TYPE(type_num), idx
+    res = ex_obj, OBJ_TYPE(type_num), idx
+    if cache is not None:
+        # bases of deltas end up in the cache as well, through extract_delta_ofs
+        cache.put(start, res)
+    return res
 
 
-def extract_object(pf: bytes, idx=0) -> tuple[bytes, OBJ_TYPE, int]:
+def extract_object(
+    pf: bytes, idx=0, cache: EntryCache = None
+) -> tuple[bytes, OBJ_TYPE, int]:
     """
     Extracts an entry in a packfile and reforms object to disk format, including header
 
     :returns: tuple(decompressed object with header, type, index of next entry)
     """
 
-    ex_obj, obj_type, idx = extract_entry(pf, idx=idx)
+    ex_obj, obj_type, idx = extract_entry(pf, idx=idx, cache=cache)
 
     len_data = len(ex_obj)
 
@@ -237,7 +322,9 @@ def extract_object(pf: bytes, idx=0) -> tuple[bytes, OBJ_TYPE, int]:
     return complete_obj, obj_type, idx
 
 
-def extract_delta_ofs(pf: bytes, idx=0, base_idx=0) -> tuple[bytes, OBJ_TYPE, bytes]:
+def extract_delta_ofs(
+    pf: bytes, idx=0, base_idx=0, cache: EntryCache = None
+) -> tuple[bytes, OBJ_TYPE, bytes]:
     """
     Provided some bytes that represent an offset delta, extracts the bytes using zlib,
     returns the extracted object and new idx after consuming data
@@ -245,7 +332,7 @@ def extract_delta_ofs(pf: bytes, idx=0, base_idx=0) -> tuple[bytes, OBJ_TYPE, by
     offset, new_idx = get_offset_val(pf, idx=idx)
     # print("Offset:", offset)
     # print("Base:", base_idx)
-    base_object, obj_type, _ = extract_entry(pf, idx=base_idx - offset)
+    base_object, obj_type, _ = extract_entry(pf, idx=base_idx - offset, cache=cache)
     delta_obj, used_bytes = smart_decompress(pf, idx=new_idx)
     reconstructed_object = read_delta(delta_obj, base_object)
     # print("Object:", reconstructed_object)
@@ -253,6 +340,190 @@ def extract_delta_ofs(pf: bytes, idx=0, base_idx=0) -> tuple[bytes, OBJ_TYPE, by
     return reconstructed_object, obj_type, used_bytes
 
 
+# Plain ints of the entry types, to avoid building an OBJ_TYPE for every entry
+TYPE_COMMIT = OBJ_TYPE.OBJ_COMMIT.value
+TYPE_TREE = OBJ_TYPE.OBJ_TREE.value
+TYPE_BLOB = OBJ_TYPE.OBJ_BLOB.value
+TYPE_TAG = OBJ_TYPE.OBJ_TAG.value
+TYPE_OFS_DELTA = OBJ_TYPE.OBJ_OFS_DELTA.value
+TYPE_REF_DELTA = OBJ_TYPE.OBJ_REF_DELTA.value
+
+TYPE_NAMES = {
+    TYPE_COMMIT: b"commit",
+    TYPE_TREE: b"tree",
+    TYPE_BLOB: b"blob",
+    TYPE_TAG: b"tag",
+}
+
+# Extracted objects are inserted this many at a time, or once they take up this many
+# bytes, so the database round trip isn't paid per object
+INSERT_BATCH = 500
+INSERT_BATCH_BYTES = 16 * 1024**2
+
+
+class PackScan:
+    """
+    Header information of every entry of a packfile, in pack order, kept in compact
+    arrays instead of a Python object per entry. Filled in by iter_pack.
+
+    offsets: byte index of the entry
+    types: entry type (TYPE_* value, deltas are not resolved)
+    sizes: inflated size of the entry data (the delta itself for deltas)
+    data_offsets: byte index of the compressed data
+    ends: byte index right after the compressed data, which is where the next entry starts
+    bases: byte index of the base entry for offset deltas, 0 otherwise
+    hashes: object ids of the resolved entries, 20 bytes each, only filled in by read_packfile
+    """
+
+    def __init__(self):
+        self.offsets = array("Q")
+        self.types = array("B")
+        self.sizes = array("Q")
+        self.data_offsets = array("Q")
+        self.ends = array("Q")
+        self.bases = array("Q")
+        self.hashes = bytearray()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return f"<PackScan entries={len(self)}>"
+
+    def entry_at(self, offset: int) -> int:
+        """Gets the entry number of the entry starting at the given byte index"""
+        i = bisect_left(self.offsets, offset)
+        if i == len(self.offsets) or self.offsets[i] != offset:
+            raise ValueError(f"No entry at offset {offset}")
+        return i
+
+    def hash(self, i: int) -> str:
+        return self.hashes[i * 20 : i * 20 + 20].hex()
+
+
+def iter_pack(pf: bytes, scan: PackScan):
+    """
+    Walks a packfile once, adding the header of every entry to scan and inflating its data
+
+    :returns: iterator of tuple(entry number, inflated entry data)
+    """
+    assert pf[0:4] == b"PACK"
+    assert pf[4:8] == b"\0\0\0\x02"
+    num_obj = int.from_bytes(pf[8:12], byteorder="big")
+    idx = 12
+
+    for i in range(num_obj):
+        offset = idx
+
+        # size and type, see decode_size_type_encoding
+        c = pf[idx]
+        idx += 1
+        obj_type = (c >> 4) & 0b0111
+        size = c & 0b1111
+        shift = 4
+        while c & 0b1000_0000:
+            c = pf[idx]
+            idx += 1
+            size |= (c & 0b0111_1111) << shift
+            shift += 7
+
+        base = 0
+        if obj_type == TYPE_OFS_DELTA:
+            # see get_offset_val
+            c = pf[idx]
+            idx += 1
+            base_offset = c & 0b0111_1111
+            while c & 0b1000_0000:
+                c = pf[idx]
+                idx += 1
+                base_offset = ((base_offset + 1) << 7) | (c & 0b0111_1111)
+            base = offset - base_offset
+        elif obj_type == TYPE_REF_DELTA:
+            raise NotImplementedError("Ref deltas are not yet implemented")
+
+        data, end = inflate_at(pf, idx, size)
+
+        scan.offsets.append(offset)
+        scan.types.append(obj_type)
+        scan.sizes.append(size)
+        scan.data_offsets.append(idx)
+        scan.ends.append(end)
+        scan.bases.append(base)
+
+        idx = end
+        yield i, data
+
+
+def inflate_at(pf: bytes, idx: int, size: int) -> tuple[bytes, int]:
+    """
+    Inflates the zlib stream at idx, knowing its inflated size from the entry header.
+    Unlike smart_decompress this normally takes a single call into zlib.
+
+    :returns: tuple(inflated data, index right after the zlib stream)
+    """
+    start = perf_counter()
+    d = zlib.decompressobj()
+    # deflate never grows data by more than a few bytes per block, so this is almost always enough
+    chunk = size + size // 1000 + 64
+    res = d.decompress(pf[idx : idx + chunk])
+    consumed = idx + chunk
+    while not d.eof:
+        if consumed >= len(pf):
+            raise ValueError("Incomplete decompression object given")
+        res += d.decompress(pf[consumed : consumed + chunk])
+        consumed += chunk
+    metrics.add_time("inflate", perf_counter() - start)
+
+    if len(res) != size:
+        raise ValueError("Entry inflated to the wrong size")
+    return res, min(consumed, len(pf)) - len(d.unused_data)
+
+
+def scan_pack(pf: bytes) -> PackScan:
+    """Gets the header information of every entry without resolving any deltas"""
+    scan = PackScan()
+    for _ in iter_pack(pf, scan):
+        pass
+    return scan
+
+
+def resolve_entry(
+    pf: bytes, scan: PackScan, i: int, data: bytes, cache: EntryCache
+) -> tuple[bytes, int]:
+    """
+    Resolves an entry that was just read by iter_pack, applying deltas if needed.
+    Bases that are no longer in the cache are inflated again using the scan arrays.
+
+    :returns: tuple(object data, TYPE_* value of the object)
+    """
+    obj_type = scan.types[i]
+    if obj_type != TYPE_OFS_DELTA:
+        cache.put(scan.offsets[i], (data, obj_type))
+        return data, obj_type
+
+    # walk down the delta chain until a cached or non-delta base is found
+    chain = [data]
+    j = scan.entry_at(scan.bases[i])
+    while True:
+        cached = cache.get(scan.offsets[j])
+        if cached is not None:
+            base, obj_type = cached
+            break
+        entry, _ = inflate_at(pf, scan.data_offsets[j], scan.sizes[j])
+        if scan.types[j] != TYPE_OFS_DELTA:
+            base, obj_type = entry, scan.types[j]
+            cache.put(scan.offsets[j], (base, obj_type))
+            break
+        chain.append(entry)
+        j = scan.entry_at(scan.bases[j])
+
+    # then apply the deltas back up
+    for delta in reversed(chain):
+        base = read_delta(delta, base)
+    cache.put(scan.offsets[i], (base, obj_type))
+    return base, obj_type
+
+
 class Packfile:
 
     objs: list[objects.GitObject]
@@ -261,9 +532,18 @@ class Packfile:
         self.objs = objs
 
     def gen_packfile(self):
-        pf = b"PACK\0\0\0\2" + struct.pack(
+        return b"".join(self.iter_packfile())
+
+    def iter_packfile(self):
+        """Generates the packfile one object at a time, so it can be streamed"""
+        sha1 = hashlib.sha1()
+
+        header = b"PACK\0\0\0\2" + struct.pack(
             ">I", len(self.objs)
         )  # file signature, version 2, 4 byte file count
+        sha1.update(header)
+        yield header
+
         for obj in self.objs:
             match type(obj):
                 case objects.CommitObject:
@@ -278,12 +558,13 @@ class Packfile:
                     raise ValueError("Invalid object")
 
             stripped_object = obj.raw_contents_new().split(b"\0", 1)[1]
-            pf += self.create_var_length(len(stripped_object), obj_type.value)
-            pf += zlib.compress(stripped_object)
-
-        pf += bytes.fromhex(objects.get_hash(pf))
+            entry = self.create_var_length(
+                len(stripped_object), obj_type.value
+            ) + zlib.compress(stripped_object)
+            sha1.update(entry)
+            yield entry
 
-        return pf
+        yield sha1.digest()
 
     @staticmethod
     def create_var_length(val: int, obj_type: int) -> bytes:
@@ -305,44 +586,100 @@ class Packfile:
         return bytes(res)
 
 
-async def read_packfile(contents: bytes, database=None, parse=True):
-    idx = 0
-
-    assert contents[0:4] == b"PACK"
-    assert contents[4:8] == b"\0\0\0\x02"
+async def read_packfile(
+    contents: bytes,
+    database=None,
+    parse=True,
+    progress=None,
+    scan: PackScan = None,
+    graph=None,
+    cache_bytes: int | None = None,
+):
+    """
+    Extracts all objects of a packfile
+
+    :param database: If given, every object is inserted into it
+    :param progress: Optional async callback, called as progress(extracted objects, total)
+    :param scan: Optional empty PackScan, filled in with the offsets, types and hashes of
+        all entries for building an index of the pack
+    :param graph: Optional graph.GraphBuilder every object is added to
+    :param cache_bytes: Optional limit on the memory taken up by delta bases, see
+        EntryCache
+    """
     num_obj = int.from_bytes(contents[8:12], byteorder="big")
-    idx += 12
+    if scan is None:
+        scan = PackScan()
 
-    new_packfile = Packfile()
+    new_packfile = Packfile([])
+    cache = EntryCache(maxbytes=cache_bytes)
 
     info("Number of objects to extract: %d", num_obj)
 
-    for i in range(num_obj):
-
-        raw_obj, obj_type, idx = extract_object(contents, idx=idx)
-
-        debug("%d: %s", i, obj_type)
+    # Checked once instead of formatting a message for every object
+    verbose = logging.getLogger().isEnabledFor(logging.DEBUG)
+    last_progress = perf_counter()
+
+    # Stage times are summed up and recorded per batch, like the inserts
+    pending = []
+    pending_bytes = 0
+    hash_time = 0.0
+    compress_time = 0.0
+
+    async def flush():
+        nonlocal pending, pending_bytes, hash_time, compress_time
+        metrics.add_time("hash", hash_time)
+        metrics.add_time("compress", compress_time)
+        hash_time = compress_time = 0.0
+        if pending:
+            await db.insert_raw_many(pending, database, codec.DEFAULT_CODEC)
+        pending = []
+        pending_bytes = 0
+
+    for i, data in iter_pack(contents, scan):
+
+        data, obj_type = resolve_entry(contents, scan, i, data, cache)
+        raw_obj = TYPE_NAMES[obj_type] + b" %d\0" % len(data) + data
+
+        if verbose:
+            debug("%d: %s", i, OBJ_TYPE(obj_type))
         if parse:
             git_obj = objects.parse_object(raw_obj, compressed=False)
 
-            debug(git_obj)
+            if verbose:
+                debug(git_obj)
             new_packfile.objs.append(git_obj)
 
-        if database is not None:
-            debug(f"Inserting {objects.get_hash(raw_obj)} into db")
-            await db.insert_raw(
-                objects.get_hash(raw_obj), zlib.compress(raw_obj), database
-            )
-
-        # print("Current idx:", idx)
-        # print(contents[idx:idx+4])
-        # print()
-        if i % 100 == 0:
-            info(f"Object {i}/{num_obj} extracted")
+        start = perf_counter()
+        hash = hashlib.sha1(raw_obj).digest()
+        hash_time += perf_counter() - start
+        scan.hashes += hash
+        if graph is not None:
+            graph.add(hash, obj_type, data)
 
-    print("Remains:", contents[idx:])
-
-    print("Hash:", objects.get_hash(contents[:idx]))
+        if database is not None:
+            start = perf_counter()
+            stored = codec.encode(raw_obj)
+            compress_time += perf_counter() - start
+            pending.append((hash.hex(), stored))
+            pending_bytes += len(stored)
+            if len(pending) >= INSERT_BATCH or pending_bytes >= INSERT_BATCH_BYTES:
+                await flush()
+
+        if perf_counter() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = perf_counter()
+            info("Object %d/%d extracted", i, num_obj)
+            if progress is not None:
+                await progress(i, num_obj)
+
+    await flush()
+    info("Extracted %d objects", num_obj)
+    if progress is not None:
+        await progress(num_obj, num_obj)
+
+    # Trailer is the SHA-1 of everything before it
+    idx = scan.ends[-1] if len(scan) else 12
+    if bytes(contents[idx : idx + 20]) != bytes.fromhex(objects.get_hash(contents[:idx])):
+        raise ValueError("Packfile checksum mismatch")
 
     return new_packfile if parse else None
 
@@ -1,58 +1,347 @@
+import re
+from fnmatch import fnmatchcase
 from logging import debug
+from urllib.parse import urlparse
+
+from . import events, remote
+
+# Refs of the cached remotes, one row per ref so listing them is a single index scan.
+# ref_lists holds what applies to the list as a whole, and a version that changes
+# every time the refs are stored. It comes from a sequence, so it isn't reused when an
+# evicted remote is fetched again. Ref advertisements are built once per version and
+# kept in adverts, so a warm advertisement is a single row lookup. Versions and
+# advertisements are also kept in a LocalCache until the refs are stored again.
+REF_TABLE = """
+    CREATE SEQUENCE IF NOT EXISTS ref_versions;
+    CREATE TABLE IF NOT EXISTS ref_lists (
+        remote text primary key,
+        head text,
+        prefixes text[] not null,
+        version bigint not null default 1,
+        updated timestamptz not null default now()
+    );
+    ALTER TABLE ref_lists ADD COLUMN IF NOT EXISTS dumb boolean not null default false;
+    CREATE TABLE IF NOT EXISTS remote_refs (
+        remote text not null,
+        refname text not null,
+        oid char(40) not null,
+        peeled char(40),
+        PRIMARY KEY (remote, refname)
+    );
+    CREATE INDEX IF NOT EXISTS remote_refs_oid ON remote_refs (oid);
+    CREATE TABLE IF NOT EXISTS adverts (
+        remote text not null,
+        key text not null,
+        version bigint not null,
+        body bytea not null,
+        PRIMARY KEY (remote, key)
+    );
+"""
+
+# What is listed from upstream unless a client asks for something else, as git clone does
+DEFAULT_PREFIXES = (b"HEAD", b"refs/heads/", b"refs/tags/")
+
+cache = events.LocalCache("refs")
+
+
+def patterns_for(repo_base_url: str, patterns: list[str]) -> list[bytes]:
+    """Gets the ref patterns that apply to a remote, see REF_INCLUDE in util.config"""
+    path = urlparse(repo_base_url).path.strip("/")
+    out = []
+    for pattern in patterns:
+        remote_pattern, _, ref_pattern = pattern.rpartition(":")
+        if not remote_pattern or fnmatchcase(path, remote_pattern):
+            out.append(ref_pattern.encode())
+    return out
+
+
+def pattern_prefix(pattern: bytes) -> bytes:
+    """Gets the part of a pattern before its first wildcard"""
+    match = re.search(rb"[*?\[]", pattern)
+    return pattern if match is None else pattern[: match.start()]
+
+
+def narrow_prefixes(prefixes: list[bytes], include: list[bytes]) -> list[bytes]:
+    """
+    Gets the ref-prefixes to send upstream so that only refs matching both the
+    requested prefixes and the include patterns are listed
+    """
+    if not include:
+        return sorted(set(prefixes))
+    out = {b"HEAD"}
+    for prefix in prefixes:
+        for literal in map(pattern_prefix, include):
+            if prefix.startswith(literal):
+                out.add(prefix)
+            elif literal.startswith(prefix):
+                out.add(literal)
+    return sorted(out)
 
 
 class Refs:
-    def __init__(self, refs: dict = {}, HEAD: bytes = None):
+    # ref-prefixes the refs were listed with, see covers
+    prefixes = DEFAULT_PREFIXES
+
+    # version of the stored refs these were loaded from, see load
+    version = None
+
+    # whether upstream only serves dumb HTTP, see util.dumb
+    dumb = False
+
+    def __init__(self, refs: dict = {}, HEAD: bytes = None, peeled: dict = None):
         self.refs = refs
         self.HEAD = HEAD
+        # ref -> object id an annotated tag points to
+        self.peeled = {} if peeled is None else peeled
 
     def __repr__(self):
-        return f"<Refs {self.refs}>"
+        return f"<Refs count={len(self.refs)} HEAD={self.HEAD}>"
 
-    def export_dumb(self):
-        res = b""
-        for ref, hash in self.refs.items():
-            if ref == b"HEAD":
-                continue
-            res += hash + b"\t" + ref + b"\n"
-        return res
+    def covers(self, prefixes: list[bytes]) -> bool:
+        """Whether every ref starting with one of the prefixes was listed"""
+        return all(
+            any(prefix.startswith(listed) for listed in self.prefixes)
+            for prefix in prefixes
+        )
 
-    def export_smart_request(self) -> bytes:
+    def matching(self, prefixes: list[bytes]) -> "Refs":
+        """Drops the refs that don't start with one of the prefixes, like ls-refs does"""
+        kept = {
+            ref: hash
+            for ref, hash in self.refs.items()
+            if any(ref.startswith(prefix) for prefix in prefixes)
+        }
+        matching = Refs(kept, self.HEAD, self.peeled)
+        matching.dumb = self.dumb
+        return matching
 
-        # payload = "0011command=fetch0014agent=git/2.46.00016object-format=sha10001000dthin-pack000dofs-delta0032want 7b4f66bd8f17d10b399aa55f34ef734a6ce3d992\n0032want 7b4f66bd8f17d10b399aa55f34ef734a6ce3d992\n0009done\n0000"
+    def select(self, include: list[bytes], exclude: list[bytes]) -> "Refs":
+        """
+        Drops the refs that don't match any include pattern or match an exclude
+        pattern. HEAD and the branch it points to are always kept.
+        """
+        kept = {}
+        for ref, hash in self.refs.items():
+            if ref not in (b"HEAD", self.HEAD) and (
+                (include and not any(fnmatchcase(ref, p) for p in include))
+                or any(fnmatchcase(ref, p) for p in exclude)
+            ):
+                continue
+            kept[ref] = hash
+        if len(kept) != len(self.refs):
+            debug("Kept %d of %d refs", len(kept), len(self.refs))
+        selected = Refs(kept, self.HEAD, self.peeled)
+        selected.prefixes = self.prefixes
+        selected.dumb = self.dumb
+        return selected
 
-        res = b"0011command=fetch0014agent=git/2.46.00016object-format=sha10001000dofs-delta"
-        # add HEAD as command
-        res += b"0032want " + self.refs[b"HEAD"] + b"\n"
+    def export_dumb(self) -> bytes:
+        """Gets the refs in the format of a dumb HTTP info/refs file"""
+        return b"".join(
+            hash + b"\t" + ref + b"\n" for ref, hash in self.refs.items() if ref != b"HEAD"
+        )
 
-        for ref in set(self.refs.values()):
-            res += b"0032want " + ref + b"\n"
+    def export_smart_request(
+        self,
+        filter: str | None = None,
+        depth: int | None = None,
+        shallow: list[bytes] = (),
+        haves: list[bytes] = (),
+        wants: list[bytes] | None = None,
+    ) -> bytes:
+        """
+        :param depth: Only fetch this many commits of history, see git fetch --depth
+        :param shallow: Commits already fetched without their parents, as hex bytes
+        :param haves: Commits that are already fetched, as hex bytes
+        :param wants: Objects to fetch as hex bytes, defaults to every ref
+        """
 
-        res += b"0009done\n0000"
-        return res
+        out = remote.command_request("fetch")
+        out.line("ofs-delta\n")
+        if wants is None:
+            wants = sorted(set(self.refs.values()))
+        out.lines(b"want " + hash + b"\n" for hash in wants)
+        out.lines(b"have " + hash + b"\n" for hash in haves)
+        out.lines(b"shallow " + hash + b"\n" for hash in shallow)
+        if depth is not None:
+            out.line(f"deepen {depth}\n")
+        if filter is not None:
+            # objects left out by the filter are fetched once they are needed
+            out.line(f"filter {filter}\n")
+        out.line("done\n")
+        out.flush_pkt()
+        return out.getvalue()
 
     @classmethod
-    def from_dumb_bytes(cls, init: bytes):
+    def from_dumb_bytes(cls, init: bytes, head: bytes | None = None):
+        """
+        :param head: Contents of the HEAD file, either a symbolic ref or an object id
+        """
         refs = {}
+        peeled = {}
         for refline in init.split(b"\n"):
             if b"\t" in refline:
                 hash, ref = refline.split(b"\t", 1)
-                refs[ref] = hash
+                if ref.endswith(b"^{}"):
+                    peeled[ref[:-3]] = hash
+                else:
+                    refs[ref] = hash
 
-        return cls(refs)
+        target = None
+        if head is not None:
+            head = head.strip()
+            if head.startswith(b"ref: "):
+                target = head[5:]
+                if target in refs:
+                    refs = {b"HEAD": refs[target], **refs}
+            else:
+                refs = {b"HEAD": head, **refs}
+        return cls(refs, HEAD=target, peeled=peeled)
 
     @classmethod
     def from_smart_bytes(cls, init_content: list[bytes]):
         refs = {}
+        peeled = {}
         head = None
         for line in init_content:
-            debug(line)
-
             if line == b"packfile\n":
                 raise ValueError("Packfile found in refs?")
-            s = line.split(b" ")
-            refs[s[1].strip()] = s[0]
-            if s[1].strip() == b"HEAD":
-                assert s[2].startswith(b"symref-target:")
-                head = s[2][14:].strip()
-        return cls(refs, HEAD=head)
+            hash, ref, *attributes = line.rstrip(b"\n").split(b" ")
+            refs[ref] = hash
+            for attribute in attributes:
+                if attribute.startswith(b"peeled:"):
+                    peeled[ref] = attribute[7:]
+                elif ref == b"HEAD" and attribute.startswith(b"symref-target:"):
+                    head = attribute[14:]
+            if ref == b"HEAD":
+                assert head is not None
+        return cls(refs, HEAD=head, peeled=peeled)
+
+
+def to_records(repo: str, ref_list: Refs) -> list[tuple]:
+    """Gets the rows of the refs, as stored in remote_refs"""
+    return [
+        (
+            repo,
+            ref.decode(),
+            hash.decode(),
+            ref_list.peeled[ref].decode() if ref in ref_list.peeled else None,
+        )
+        for ref, hash in ref_list.refs.items()
+    ]
+
+
+def from_records(meta, rows) -> Refs:
+    """
+    Builds refs from stored rows
+
+    :param meta: Row with head, prefixes and dumb, as stored in ref_lists
+    :param rows: Rows with refname, oid and peeled, as stored in remote_refs
+    """
+    ref_list = Refs(
+        {row["refname"].encode(): row["oid"].encode() for row in rows},
+        HEAD=None if meta["head"] is None else meta["head"].encode(),
+        peeled={
+            row["refname"].encode(): row["peeled"].encode()
+            for row in rows
+            if row["peeled"] is not None
+        },
+    )
+    ref_list.prefixes = tuple(prefix.encode() for prefix in meta["prefixes"])
+    ref_list.dumb = meta["dumb"]
+    return ref_list
+
+
+async def save(repo: str, ref_list: Refs, db) -> None:
+    """Stores the refs of a remote, replacing the ones stored before"""
+    records = to_records(repo, ref_list)
+    async with db.transaction():
+        await db.execute(
+            """
+            INSERT INTO ref_lists (remote, head, prefixes, dumb, version)
+            VALUES ($1, $2, $3, $4, nextval('ref_versions'))
+            ON CONFLICT (remote) DO UPDATE SET head = $2, prefixes = $3, dumb = $4,
+                version = nextval('ref_versions'), updated = now();
+            """,
+            repo,
+            None if ref_list.HEAD is None else ref_list.HEAD.decode(),
+            [prefix.decode() for prefix in ref_list.prefixes],
+            ref_list.dumb,
+        )
+        await db.execute("DELETE FROM remote_refs WHERE remote = $1;", repo)
+        await db.copy_records_to_table(
+            "remote_refs",
+            records=records,
+            columns=["remote", "refname", "oid", "peeled"],
+        )
+    await events.notify("refs", repo, db)
+    debug("Stored %d refs of %s", len(records), repo)
+
+
+async def load(repo: str, db) -> Refs | None:
+    """Gets the stored refs of a remote, None if it wasn't fetched yet"""
+    meta = await db.fetchrow(
+        "SELECT head, prefixes, dumb, version FROM ref_lists WHERE remote = $1;", repo
+    )
+    if meta is None:
+        return None
+    rows = await db.fetch(
+        'SELECT refname, oid, peeled FROM remote_refs WHERE remote = $1 ORDER BY refname COLLATE "C";',
+        repo,
+    )
+    ref_list = from_records(meta, rows)
+    ref_list.version = meta["version"]
+    return ref_list
+
+
+async def is_cached(repo: str, db) -> bool:
+    return await db.fetchval("SELECT 1 FROM ref_lists WHERE remote = $1;", repo) is not None
+
+
+async def current_version(repo: str, db) -> int | None:
+    """Gets the version of the stored refs, None if there are none"""
+    version = cache.get((repo, "version"))
+    if version is not None:
+        return version
+    generation = cache.generation
+    version = await db.fetchval("SELECT version FROM ref_lists WHERE remote = $1;", repo)
+    if version is not None:
+        cache.put((repo, "version"), version, len(repo), generation)
+    return version
+
+
+async def load_advert(repo: str, key: str, db) -> bytes | None:
+    """Gets a ref advertisement that was built from the current version of the refs"""
+    body = cache.get((repo, "advert", key))
+    if body is not None:
+        return body
+    generation = cache.generation
+    body = await db.fetchval(
+        """
+        SELECT adverts.body FROM adverts JOIN ref_lists USING (remote)
+        WHERE adverts.remote = $1 AND adverts.key = $2
+            AND adverts.version = ref_lists.version;
+        """,
+        repo,
+        key,
+    )
+    if body is not None:
+        cache.put((repo, "advert", key), body, len(body), generation)
+    return body
+
+
+async def save_advert(repo: str, key: str, version: int, body: bytes, db) -> None:
+    """
+    :param key: What the advertisement is for, e.g. the protocol and its arguments
+    :param version: Version of the refs the advertisement was built from
+    """
+    await db.execute(
+        """
+        INSERT INTO adverts (remote, key, version, body) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (remote, key) DO UPDATE SET version = $3, body = $4;
+        """,
+        repo,
+        key,
+        version,
+        body,
+    )
@@ -1,21 +1,132 @@
-from . import objects
-from .db import insert_raw
-import requests
+from . import metrics
+from .config import STREAM_CHUNK_SIZE
 from logging import debug, error
-from functools import lru_cache
+from time import perf_counter
 
 
-async def dumb_fetch_object(
-    hash: bytes, base_url: str, db=None, headers=None
-) -> objects.GitObject:
-    debug(f"Fetching {base_url}/objects/{hash[0:2].decode()}/{hash[2:].decode()}")
-    res = requests.get(
-        f"{base_url}/objects/{hash[0:2].decode()}/{hash[2:].decode()}", headers=headers
-    ).content
-    if db is not None:
-        debug("Attempting to insert into database")
-        await insert_raw(hash.decode(), res, db)
-    return objects.parse_object(res)
+FLUSH = b"0000"
+DELIM = b"0001"
+
+# git never sends or accepts lines longer than 65520 bytes, including the length
+MAX_PKT_DATA = 0xFFF0 - 4
+
+
+def pkt_line(data: bytes | str) -> bytes:
+    """Encodes a single pkt-line, see PktLineWriter.line"""
+    out = PktLineWriter()
+    out.line(data)
+    return out.getvalue()
+
+
+def sideband(band: int, data: bytes) -> bytes:
+    """Encodes data as pkt-lines on a sideband, see PktLineWriter.sideband"""
+    out = PktLineWriter()
+    out.sideband(band, data)
+    return out.getvalue()
+
+
+AGENT = "git/2.46.0"
+
+
+def command_request(command: str) -> "PktLineWriter":
+    """Starts a protocol v2 command request, the arguments are written to it next"""
+    out = PktLineWriter()
+    out.line(f"command={command}\n")
+    out.line(f"agent={AGENT}\n")
+    out.line("object-format=sha1\n")
+    out.delim_pkt()
+    return out
+
+
+class PktLineWriter:
+    """
+    Encodes pkt-lines into a single buffer, which is handed out in chunks of about
+    chunk_size bytes with take().
+    Long lists of lines never get copied over and over, as building them with
+    bytes += would.
+    """
+
+    def __init__(self, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+
+    def __len__(self):
+        return len(self.buf)
+
+    def line(self, data: bytes | str) -> None:
+        """Adds a single pkt-line, the length prefix includes its own 4 bytes"""
+        if isinstance(data, str):
+            data = data.encode()
+        assert len(data) <= MAX_PKT_DATA
+        self.buf += b"%04x" % (len(data) + 4)
+        self.buf += data
+
+    def lines(self, lines) -> None:
+        for data in lines:
+            self.line(data)
+
+    def flush_pkt(self) -> None:
+        self.buf += FLUSH
+
+    def delim_pkt(self) -> None:
+        self.buf += DELIM
+
+    def sideband(self, band: int, data: bytes) -> None:
+        """Adds data on a sideband, split into as many lines as needed"""
+        band = bytes((band,))
+        with memoryview(data) as view:
+            for i in range(0, len(view), MAX_PKT_DATA - 1):
+                part = view[i : i + MAX_PKT_DATA - 1]
+                self.buf += b"%04x" % (len(part) + 5)
+                self.buf += band
+                self.buf += part
+
+    def take(self, force: bool = False) -> bytes | None:
+        """
+        Gets everything written so far once at least chunk_size bytes are pending,
+        or whatever is pending if force is set. None if there is nothing to send yet.
+        """
+        if not self.buf or (not force and len(self.buf) < self.chunk_size):
+            return None
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+    def getvalue(self) -> bytes:
+        """Gets everything written so far"""
+        return self.take(force=True) or b""
+
+
+def iter_lines(chunks):
+    """
+    Splits a stream of pkt-lines as it arrives, without holding the whole response.
+    Like SmartPacket.parse_packet, flush and delimiter packets are skipped.
+
+    :param chunks: Iterable of bytes, e.g. requests' iter_content()
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        # only the splitting is timed, not the network or the consumer of the lines
+        start = perf_counter()
+        buf.extend(chunk)
+        idx = 0
+        while len(buf) - idx >= 4:
+            line_len = int(buf[idx : idx + 4], 16)
+            if line_len <= 3:
+                idx += 4
+                continue
+            if len(buf) - idx < line_len:
+                break  # rest of the line is in the next chunk
+            line = bytes(buf[idx + 4 : idx + line_len])
+            idx += line_len
+            metrics.add_time("pktline", perf_counter() - start)
+            yield line
+            start = perf_counter()
+        del buf[:idx]
+        metrics.add_time("pktline", perf_counter() - start)
+
+    if buf:
+        raise ValueError("Truncated pkt-line stream")
 
 
 class SmartPacket:
@@ -27,12 +138,11 @@ class SmartPacket:
         assert len(line) < 0x10000 - 4
         self.lines.append(line)
 
-    def generate_payload(self):
-        out = b""
-        for line in self.lines:
-            out += f"{len(line):0>4x}".encode()
-            out += line
-            out += b"0000"
+    def generate_payload(self) -> bytes:
+        out = PktLineWriter()
+        out.lines(self.lines)
+        out.flush_pkt()
+        return out.getvalue()
 
     def __repr__(self):
         return f"<SmartPacket line_conut={len(self.lines)}>"
@@ -46,9 +156,9 @@ class SmartPacket:
         return bytes(pf)
 
     @classmethod
-    @lru_cache(maxsize=None)
     def parse_packet(cls, packet: bytes):
         debug("Parsing packet")
+        start = perf_counter()
         curr_idx = 0
         new_packet = []
         while curr_idx < len(packet):
@@ -59,4 +169,5 @@ class SmartPacket:
                 continue
             new_packet.append(packet[4 + curr_idx : line_len + curr_idx])
             curr_idx += line_len
+        metrics.add_time("pktline", perf_counter() - start)
         return cls(lines=new_packet)
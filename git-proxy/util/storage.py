@@ -0,0 +1,130 @@
+import hashlib
+import os
+import tempfile
+import zlib
+from logging import debug
+
+from .config import LARGE_OBJECT_THRESHOLD, OBJECT_STORE_DIR
+
+
+# Content addressed store for large objects. Files are laid out the same way as
+# .git/objects (ab/cdef...) and hold the compressed loose object, so they can be
+# sent to the client as-is.
+
+
+def object_path(hash: str) -> str:
+    """Get the store path of an object, relative to OBJECT_STORE_DIR"""
+    return os.path.join(hash[0:2], hash[2:])
+
+
+def full_path(path: str) -> str:
+    return os.path.join(OBJECT_STORE_DIR, path)
+
+
+def write_object(hash: str, content: bytes) -> str:
+    """
+    Writes an object into the store if it isn't already there
+
+    :returns: path relative to OBJECT_STORE_DIR, to be kept in the database
+    """
+    path = object_path(hash)
+    dest = full_path(path)
+    if os.path.exists(dest):
+        return path
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # write to a temporary file first so a crash never leaves a partial object behind
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp, dest)
+    except:
+        os.unlink(tmp)
+        raise
+
+    debug("Stored %s on disk (%d bytes)", hash, len(content))
+    return path
+
+
+def read_object(path: str) -> bytes:
+    with open(full_path(path), "rb") as f:
+        return f.read()
+
+
+def object_size(path: str) -> int:
+    try:
+        return os.path.getsize(full_path(path))
+    except FileNotFoundError:
+        return 0
+
+
+def delete_object(path: str) -> None:
+    try:
+        os.unlink(full_path(path))
+    except FileNotFoundError:
+        pass
+
+
+class ObjectSpool:
+    """
+    Collects an object that arrives in chunks. It is kept in memory while small and
+    moved to a temporary file in the store once it grows past LARGE_OBJECT_THRESHOLD,
+    so memory use stays bounded no matter how big the object is. The object is inflated
+    and hashed as it arrives, so finish can verify it without reading it back.
+    """
+
+    def __init__(self, hash: str):
+        self.hash = hash
+        self.buffer = bytearray()
+        self.file = None
+        self.inflate = zlib.decompressobj()
+        self.sha1 = hashlib.sha1()
+
+    def write(self, chunk: bytes):
+        if self.inflate is not None:
+            try:
+                self.sha1.update(self.inflate.decompress(chunk))
+            except zlib.error:
+                # not a loose object, finish rejects it
+                self.inflate = None
+        if self.file is None and len(self.buffer) + len(chunk) > LARGE_OBJECT_THRESHOLD:
+            os.makedirs(OBJECT_STORE_DIR, exist_ok=True)
+            self.file = tempfile.NamedTemporaryFile(dir=OBJECT_STORE_DIR, delete=False)
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer.extend(chunk)
+
+    def finish(self) -> tuple[bytes | None, str | None]:
+        """
+        Raises ValueError, after discarding the object, if it isn't the loose object
+        with the expected hash
+
+        :returns: tuple(contents, None) for small objects, or tuple(None, path relative to
+            OBJECT_STORE_DIR) for objects that were moved into the store
+        """
+        if (
+            self.inflate is None
+            or not self.inflate.eof
+            or self.sha1.hexdigest() != self.hash
+        ):
+            self.discard()
+            raise ValueError(f"Object {self.hash} does not match its hash")
+
+        if self.file is None:
+            return bytes(self.buffer), None
+
+        self.file.close()
+        path = object_path(self.hash)
+        os.makedirs(os.path.dirname(full_path(path)), exist_ok=True)
+        os.replace(self.file.name, full_path(path))
+        return None, path
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            os.unlink(self.file.name)
+        self.buffer = bytearray()
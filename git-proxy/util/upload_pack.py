@@ -0,0 +1,529 @@
+import asyncio
+import hashlib
+import os
+import struct
+import zlib
+from logging import debug, info
+from urllib.parse import urlparse
+
+from . import codec, events, graph, metrics, pack_store, refs, remote, storage
+from .config import PACKFILE_URI_BASE, PROGRESS_INTERVAL, STREAM_CHUNK_SIZE
+from .ingest import INFINITE_DEPTH
+from .packfile import Packfile
+
+# Server side of protocol v2 over smart HTTP (see gitprotocol-v2), for clients that
+# ask for it. Only ls-refs and fetch are supported. Which objects a client needs is
+# worked out with the remote's reachability index, and packs are built from the
+# stored objects without deltas. The blob:none and blob:limit filters are honoured,
+# so partial clones only get the blobs they actually check out, and so is deepen, so
+# shallow clones only need as much history from upstream as they ask for. Clients that
+# accept packfile-uris get the stored packs of a remote from a static file server
+# instead, see offload_packs.
+
+# Number of objects read from the database at a time while a pack is generated
+PACK_BATCH = 500
+
+# Packs offloaded for a full clone, keyed by remote, multi-pack-index checksum and the
+# wants, as the objects to send only change with those or the reachability index
+offloads = events.LocalCache("graph")
+
+
+class UploadPackError(Exception):
+    pass
+
+
+def offload_enabled() -> bool:
+    return PACKFILE_URI_BASE is not None and pack_store.enabled()
+
+
+def advertise() -> bytes:
+    """Capability advertisement, sent in response to info/refs"""
+    out = remote.PktLineWriter()
+    out.lines(
+        [
+            "version 2\n",
+            f"agent={remote.AGENT}\n",
+            "ls-refs\n",
+            (
+                "fetch=shallow filter packfile-uris\n"
+                if offload_enabled()
+                else "fetch=shallow filter\n"
+            ),
+            "object-format=sha1\n",
+        ]
+    )
+    out.flush_pkt()
+    return out.getvalue()
+
+
+def parse_request(body: bytes) -> tuple[str, dict[str, str], list[bytes]]:
+    """
+    Splits a command request into its parts
+
+    :returns: tuple(command, capabilities, arguments)
+    """
+    command = None
+    capabilities = {}
+    args = []
+    in_args = False
+    idx = 0
+    while idx < len(body):
+        length = body[idx : idx + 4]
+        if len(length) != 4 or not all(c in b"0123456789abcdefABCDEF" for c in length):
+            raise UploadPackError("Invalid pkt-line length")
+        line_len = int(length, 16)
+        if line_len == 0:
+            break
+        if line_len == 1:
+            # delimiter between the capabilities and the arguments
+            in_args = True
+            idx += 4
+            continue
+        if line_len < 4 or idx + line_len > len(body):
+            raise UploadPackError("Invalid pkt-line length")
+        line = body[idx + 4 : idx + line_len].rstrip(b"\n")
+        idx += line_len
+
+        if in_args:
+            args.append(line)
+        elif line.startswith(b"command="):
+            command = line[8:].decode(errors="replace")
+        else:
+            key, _, value = line.decode(errors="replace").partition("=")
+            capabilities[key] = value
+
+    if command is None:
+        raise UploadPackError("No command given")
+    return command, capabilities, args
+
+
+def ref_prefixes(args: list[bytes]) -> list[bytes]:
+    """Gets the ref-prefix arguments of an ls-refs command"""
+    return [arg[11:] for arg in args if arg.startswith(b"ref-prefix ")]
+
+
+def ls_refs_key(args: list[bytes]) -> str:
+    """Gets the key an ls-refs response is cached under, see refs.save_advert"""
+    normalized = b"\n".join(sorted(set(args)))
+    return "ls-refs " + hashlib.sha1(normalized).hexdigest()
+
+
+def ls_refs(ref_list: refs.Refs, args: list[bytes]) -> bytes:
+    symrefs = b"symrefs" in args
+    peel = b"peel" in args
+    prefixes = ref_prefixes(args)
+
+    out = remote.PktLineWriter()
+    for ref, hash in ref_list.refs.items():
+        if prefixes and not any(ref.startswith(prefix) for prefix in prefixes):
+            continue
+        line = hash + b" " + ref
+        if symrefs and ref == b"HEAD" and ref_list.HEAD is not None:
+            line += b" symref-target:" + ref_list.HEAD
+        if peel and ref in ref_list.peeled:
+            line += b" peeled:" + ref_list.peeled[ref]
+        out.line(line + b"\n")
+    out.flush_pkt()
+    return out.getvalue()
+
+
+def parse_filter(spec: str) -> int | None:
+    """
+    Gets the blob size limit of a filter spec, see CommitGraph.missing.
+    Filters that aren't supported are ignored, a client can deal with getting more
+    objects than it asked for.
+    """
+    if spec == "blob:none":
+        return 0
+    if spec.startswith("blob:limit="):
+        value = spec[11:].lower()
+        units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+        unit = 1
+        if value[-1:] in units:
+            unit = units[value[-1]]
+            value = value[:-1]
+        if not (value.isascii() and value.isdigit()):
+            raise UploadPackError(f"Invalid filter {spec}")
+        return int(value) * unit
+    info("Ignoring unsupported filter %s", spec)
+    return None
+
+
+async def read_raw(row) -> bytes:
+    """Gets an object including its header from its row in the objects table"""
+    if row["path"] is not None:
+        stored = await asyncio.to_thread(storage.read_object, row["path"])
+        return zlib.decompress(stored)
+    return codec.decode(row["blob"], row["codec"])
+
+
+async def walk_unindexed(
+    index: graph.CommitGraph | None, oids: list[bytes], stop: set, db
+) -> tuple[dict[bytes, tuple[int, int]], list[bytes]]:
+    """
+    Walks the objects that aren't in the reachability index, i.e. the ones added by
+    the proxy itself, through the database until indexed objects are reached
+
+    :returns: tuple(unindexed object id -> tuple(type, size), indexed object ids)
+    """
+    unindexed = {}
+    indexed = []
+    seen = set(stop)
+    stack = list(oids)
+    while stack:
+        oid = stack.pop()
+        if oid in seen:
+            continue
+        seen.add(oid)
+        if index is not None and index.position(oid) is not None:
+            indexed.append(oid)
+            continue
+
+        row = await db.fetchrow(
+            "SELECT blob, path, codec FROM objects WHERE hash = $1;", oid.hex()
+        )
+        if row is None:
+            # e.g. a have of something the proxy never saw
+            debug("Unknown object %s", oid.hex())
+            continue
+        header, data = (await read_raw(row)).split(b"\0", 1)
+        obj_type = graph.TYPE_IDS[header.split(b" ", 1)[0]]
+        unindexed[oid] = (obj_type, len(data))
+        stack.extend(link for link, _ in graph.parse_links(obj_type, data))
+    return unindexed, indexed
+
+
+def parse_oid(value: bytes) -> bytes:
+    """Gets the binary object id of a hex one in an argument"""
+    try:
+        oid = bytes.fromhex(value.decode())
+    except ValueError:
+        oid = b""
+    if len(oid) != 20:
+        raise UploadPackError(f"Invalid object id {value.decode(errors='replace')}")
+    return oid
+
+
+class FetchArgs:
+    """Arguments of a fetch command"""
+
+    def __init__(self, args: list[bytes]):
+        self.wants: list[bytes] = []
+        self.haves: list[bytes] = []
+        # commits the client has without their parents
+        self.shallow: list[bytes] = []
+        self.depth: int | None = None
+        self.deepen = False
+        self.blob_limit: int | None = None
+        # protocols of the packfile-uris the client accepts
+        self.uri_protocols: list[str] = []
+        self.done = False
+        # whether the client shows progress messages
+        self.progress = True
+
+        for arg in args:
+            if arg.startswith(b"want "):
+                self.wants.append(parse_oid(arg[5:]))
+            elif arg.startswith(b"have "):
+                self.haves.append(parse_oid(arg[5:]))
+            elif arg.startswith(b"shallow "):
+                self.shallow.append(parse_oid(arg[8:]))
+            elif arg.startswith(b"deepen "):
+                self.deepen = True
+                value = arg[7:]
+                if not (value.isascii() and value.isdigit()) or int(value) < 1:
+                    raise UploadPackError(
+                        f"Invalid depth {value.decode(errors='replace')}"
+                    )
+                depth = int(value)
+                self.depth = None if depth >= INFINITE_DEPTH else depth
+            elif arg.startswith(b"deepen-"):
+                # deepen-since, deepen-not and deepen-relative get the full history,
+                # which is more than they asked for but never less
+                info("Ignoring %s", arg.decode())
+                self.deepen = True
+            elif arg.startswith(b"filter "):
+                self.blob_limit = parse_filter(arg[7:].decode())
+            elif arg.startswith(b"packfile-uris "):
+                self.uri_protocols = arg[14:].decode().split(",")
+            elif arg == b"done":
+                self.done = True
+            elif arg == b"no-progress":
+                self.progress = False
+            elif arg.startswith(b"want-ref "):
+                raise UploadPackError(f"Unsupported argument {arg.decode()}")
+        if not self.wants:
+            raise UploadPackError("No wants given")
+
+
+class FetchPlan:
+    """
+    hashes: ids of the objects to send
+    shallow, unshallow: binary ids of the commits for the shallow-info section
+    packfile_uris: tuple(pack checksum, URI) of the packs the client downloads itself
+    needs_history: the proxy doesn't have enough history yet, upstream has to be
+        fetched with upstream_depth (None for all of it) first
+    """
+
+    def __init__(self):
+        self.hashes: list[str] = []
+        self.shallow: list[bytes] = []
+        self.unshallow: list[bytes] = []
+        self.packfile_uris: list[tuple[str, str]] = []
+        self.needs_history = False
+        self.upstream_depth: int | None = None
+
+
+async def collect_objects(
+    index: graph.CommitGraph | None, fetch: FetchArgs, db
+) -> FetchPlan:
+    """Works out which objects to send for a fetch"""
+    plan = FetchPlan()
+    have_unindexed, have_indexed = await walk_unindexed(index, fetch.haves, set(), db)
+    # Not stopped at the haves, as the indexed commits are needed for deepen
+    want_unindexed, want_indexed = await walk_unindexed(index, fetch.wants, set(), db)
+
+    plan.hashes = [
+        oid.hex()
+        for oid, (obj_type, size) in want_unindexed.items()
+        if oid not in have_unindexed
+        and (
+            fetch.blob_limit is None
+            or obj_type != graph.TYPE_BLOB
+            or size < fetch.blob_limit
+            or oid in fetch.wants
+        )
+    ]
+    if index is None:
+        return plan
+
+    client_shallow = {index.position(oid) for oid in fetch.shallow} - {None}
+    if fetch.deepen:
+        deepen_from = want_indexed
+        if fetch.depth is None:
+            # as git does, all of the client's shallow commits get their history
+            deepen_from = want_indexed + fetch.shallow
+        commits, boundary = index.walk_commits(deepen_from, fetch.depth)
+        cut = boundary | (client_shallow - commits)
+        plan.shallow = [index.oid(pos) for pos in boundary]
+        unshallow = (client_shallow & commits) - boundary
+        plan.unshallow = [index.oid(pos) for pos in unshallow]
+        # The client has these commits already, but not what is behind them
+        for pos in unshallow:
+            want_indexed.extend(index.oid(p) for p in index.children(pos)[1:])
+    else:
+        commits, _ = index.walk_commits(want_indexed, cut=client_shallow)
+        cut = client_shallow
+
+    # Commits the proxy hasn't fetched yet, or only has without their parents
+    promised = {pos for pos in commits if index.sizes[pos] == graph.UNKNOWN_SIZE}
+    if promised or index.shallow_positions() & (commits - cut):
+        plan.needs_history = True
+        # The client's depth counts from the modified HEAD commit, which is one more
+        # than from the upstream tips
+        if fetch.depth is not None:
+            plan.upstream_depth = fetch.depth + 1
+        return plan
+
+    plan.hashes.extend(
+        oid.hex()
+        for oid in index.missing(
+            want_indexed, have_indexed, fetch.blob_limit, cut, client_shallow
+        )
+    )
+    return plan
+
+
+def offloadable(
+    repo: str,
+    index: graph.CommitGraph,
+    midx: pack_store.MultiPackIndex,
+    hashes: list[str],
+) -> tuple[list[tuple[str, str]], list[str]]:
+    """
+    Gets the stored packs that hold nothing but objects the client gets and other
+    objects of the remote. Those are the objects the proxy replaced, e.g. the original
+    HEAD commit, which end up unreachable on the client, where they do no harm. Only
+    their replacements are sent on top. Packs with objects that aren't in the
+    reachability index anymore, e.g. of refs that were rewritten since, are left out.
+
+    :param hashes: objects the client needs
+    :returns: tuple(packfile-uris, hashes that aren't in the offloaded packs)
+    """
+    sent = {bytes.fromhex(hash) for hash in hashes}
+    offloaded = set()
+    uris = []
+    directory = pack_store.remote_dir(repo)
+    for name in midx.packs:
+        try:
+            idx = pack_store.PackIndex(os.path.join(directory, name[:-5] + ".idx"))
+        except FileNotFoundError:
+            # merged away since the multi-pack-index was loaded
+            continue
+        oids = [oid for oid, _ in idx]
+        if all(oid in sent or index.position(oid) is not None for oid in oids):
+            offloaded.update(oids)
+            uris.append(
+                (name[5:-5], f"{PACKFILE_URI_BASE}/{pack_store.pack_path(repo, name)}")
+            )
+    return uris, [hash for hash in hashes if bytes.fromhex(hash) not in offloaded]
+
+
+async def offload_packs(
+    repo: str, index: graph.CommitGraph | None, plan: FetchPlan, fetch: FetchArgs
+) -> None:
+    """
+    Moves the objects of the stored packs of a remote out of plan, into packfile-uris,
+    see offloadable. Only full clones are offloaded, as a stored pack holds more than a
+    shallow, filtered or incremental fetch needs.
+    """
+    if urlparse(PACKFILE_URI_BASE).scheme not in fetch.uri_protocols:
+        return
+    if fetch.haves or fetch.shallow or fetch.deepen or fetch.blob_limit is not None:
+        return
+    midx = await asyncio.to_thread(pack_store.load, repo)
+    if midx is None or index is None:
+        return
+
+    # the multi-pack-index ends with its checksum
+    key = (
+        repo,
+        bytes(midx.data[-20:]),
+        hashlib.sha1(b"".join(sorted(fetch.wants))).digest(),
+    )
+    cached = offloads.get(key)
+    if cached is None:
+        generation = offloads.generation
+        cached = await asyncio.to_thread(offloadable, repo, index, midx, plan.hashes)
+        offloads.put(
+            key, cached, 100 * len(cached[0]) + 50 * len(cached[1]), generation
+        )
+    uris, hashes = cached
+    if not uris:
+        return
+
+    plan.packfile_uris = list(uris)
+    plan.hashes = hashes
+    metrics.inc("gitmitm_offloaded_packs_total", len(uris))
+    info("Offloading %d stored packs, %d objects left to send", len(uris), len(hashes))
+
+
+async def missing_hashes(hashes: list[str], db) -> list[str]:
+    """Gets the objects that aren't stored yet, e.g. because of UPSTREAM_FILTER"""
+    found = set()
+    for i in range(0, len(hashes), PACK_BATCH):
+        rows = await db.fetch(
+            "SELECT hash FROM objects WHERE hash = any($1::text[]);",
+            hashes[i : i + PACK_BATCH],
+        )
+        found.update(row["hash"] for row in rows)
+    return [hash for hash in hashes if hash not in found]
+
+
+async def iter_pack(hashes: list[str], db):
+    """Generates a pack of the given objects, reading them in batches"""
+    sha1 = hashlib.sha1()
+    header = b"PACK\0\0\0\2" + struct.pack(">I", len(hashes))
+    sha1.update(header)
+    yield header
+
+    for i in range(0, len(hashes), PACK_BATCH):
+        batch = hashes[i : i + PACK_BATCH]
+        rows = {
+            row["hash"]: row
+            for row in await db.fetch(
+                "SELECT hash, blob, path, codec FROM objects WHERE hash = any($1::text[]);",
+                batch,
+            )
+        }
+        for hash in batch:
+            if hash not in rows:
+                raise UploadPackError(f"Object {hash} is not stored")
+            header, data = (await read_raw(rows[hash])).split(b"\0", 1)
+            with metrics.timer("compress"):
+                entry = Packfile.create_var_length(
+                    len(data), graph.TYPE_IDS[header.split(b" ", 1)[0]]
+                ) + zlib.compress(data, 1)
+            sha1.update(entry)
+            yield entry
+
+    yield sha1.digest()
+
+
+def settled(fetch: FetchArgs) -> bool:
+    """
+    Whether the sections in front of the packfile don't depend on the objects that are
+    sent, so the packfile section can start while they are still fetched from upstream
+    """
+    if fetch.deepen or fetch.shallow:
+        return False
+    return not offload_enabled() or (
+        urlparse(PACKFILE_URI_BASE).scheme not in fetch.uri_protocols
+    )
+
+
+async def fetch_response(plan: FetchPlan, fetch: FetchArgs, db, prepare=None):
+    """
+    Generates the response to a fetch command. The objects all have to be stored.
+
+    :param prepare: Optional async callback that stores the objects once the packfile
+        section has started, see settled. Called as prepare(progress) with an async
+        callback for progress messages, it returns the final plan. The client gets the
+        messages on sideband 2 and keepalives while there are none.
+    """
+    out = remote.PktLineWriter()
+    if not fetch.done:
+        # Never negotiate further, the haves that were sent are good enough
+        haves = [oid.hex() for oid in fetch.haves]
+        unknown = set(await missing_hashes(haves, db))
+        out.line("acknowledgments\n")
+        acks = [hash for hash in haves if hash not in unknown]
+        out.lines(f"ACK {hash}\n" for hash in acks)
+        if not acks:
+            out.line("NAK\n")
+        out.line("ready\n")
+        out.delim_pkt()
+
+    if fetch.deepen or fetch.shallow:
+        out.line("shallow-info\n")
+        out.lines(f"shallow {oid.hex()}\n" for oid in plan.shallow)
+        out.lines(f"unshallow {oid.hex()}\n" for oid in plan.unshallow)
+        out.delim_pkt()
+
+    if plan.packfile_uris:
+        out.line("packfile-uris\n")
+        out.lines(f"{checksum} {uri}\n" for checksum, uri in plan.packfile_uris)
+        out.delim_pkt()
+
+    out.line("packfile\n")
+    if prepare is not None:
+        yield out.take(force=True)
+        messages = asyncio.Queue()
+        task = asyncio.ensure_future(prepare(messages.put))
+        task.add_done_callback(lambda _: messages.put_nowait(None))
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(messages.get(), PROGRESS_INTERVAL)
+                except asyncio.TimeoutError:
+                    # empty pack data, like git's keepalive
+                    yield remote.pkt_line(b"\1")
+                    continue
+                if message is None:
+                    break
+                if fetch.progress:
+                    yield remote.sideband(2, message.encode())
+            plan = task.result()
+        finally:
+            task.cancel()
+    # Pack entries are collected first, so they go out in as few lines as possible
+    buf = bytearray()
+    async for chunk in iter_pack(plan.hashes, db):
+        buf += chunk
+        if len(buf) >= STREAM_CHUNK_SIZE:
+            out.sideband(1, buf)
+            buf.clear()
+            yield out.take(force=True)
+    out.sideband(1, buf)
+    out.flush_pkt()
+    yield out.getvalue()
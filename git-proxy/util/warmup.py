@@ -0,0 +1,81 @@
+import asyncio
+from logging import debug, info, warning
+
+from . import graph, ingest, metrics, refs
+from .config import WARM_CONCURRENCY, WARM_INTERVAL, WARM_REMOTES
+
+# Keeps the remotes in WARM_REMOTES fetched, so clones of them don't wait for upstream.
+# On startup and every WARM_INTERVAL seconds, a scheduler lists the refs of each warm
+# remote and, if they changed or the full history isn't there yet, queues an ingest job
+# the way the first clone of a remote does. Remotes that are up to date only cost the
+# ls-refs request.
+
+# Only one scheduler runs at a time, no matter how many processes there are
+LOCK_ID = 0x7761726D
+
+
+async def warm(repo: str, db) -> bool:
+    """
+    Fetches the full history of a remote and whatever is new upstream
+
+    :param db: Best the pool, so no connection is held while the job runs
+    :returns: whether anything had to be fetched
+    """
+    stored = await refs.load(repo, db)
+    prefixes = refs.DEFAULT_PREFIXES if stored is None else list(stored.prefixes)
+    ref_list = await asyncio.to_thread(ingest.list_refs, repo, {}, prefixes)
+
+    shallow = await graph.load_shallow(repo, db)
+    if (
+        stored is not None
+        and (stored.refs, stored.HEAD) == (ref_list.refs, ref_list.HEAD)
+        and shallow is not None
+        and not shallow
+    ):
+        debug("%s is up to date", repo)
+        return False
+
+    info("Warming up %s", repo)
+    await ingest.enqueue(repo, ref_list, {}, db)
+    await ingest.wait_for(repo, db)
+    metrics.inc("gitmitm_warmed_remotes_total")
+    return True
+
+
+async def warm_all(pool) -> None:
+    """Warms up every remote in WARM_REMOTES, WARM_CONCURRENCY at a time"""
+    limit = asyncio.Semaphore(WARM_CONCURRENCY)
+
+    async def run(repo: str):
+        async with limit:
+            try:
+                await warm(repo, pool)
+            except Exception as e:
+                warning("Could not warm up %s: %r", repo, e)
+
+    await asyncio.gather(*map(run, WARM_REMOTES))
+
+
+async def scheduler(pool) -> None:
+    while True:
+        try:
+            async with pool.acquire() as db:
+                if await db.fetchval("SELECT pg_try_advisory_lock($1);", LOCK_ID):
+                    try:
+                        await warm_all(pool)
+                    finally:
+                        await db.execute("SELECT pg_advisory_unlock($1);", LOCK_ID)
+                else:
+                    debug("Another warm-up scheduler is running")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warning("Warm-up scheduler error: %r", e)
+        await asyncio.sleep(WARM_INTERVAL)
+
+
+def start_scheduler(pool) -> list[asyncio.Task]:
+    """Starts the scheduler, if there are WARM_REMOTES"""
+    if not WARM_REMOTES:
+        return []
+    return [asyncio.create_task(scheduler(pool))]